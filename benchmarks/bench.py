@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for the image processing and storage hot paths.
+
+Replays the frames of the annotated HDF5 archive through the LED parsers,
+measures database insert throughput on a temporary SQLite file and drives
+the service sampling loop from a fake camera. Results are written as JSON.
+
+When given a baseline (the JSON output of a previous run), median latencies
+and throughputs are compared against it and the script exits with a non-zero
+status if any regressed by more than the tolerance.
+
+Example:
+    python benchmarks/bench.py -o before.json
+    python benchmarks/bench.py -o after.json --baseline before.json
+"""
+
+import sys
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import cv2
+
+# Import the package from this checkout, without installing it
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hvacmon.camera
+import hvacmon.dataset
+import hvacmon.db
+import hvacmon.imgproc
+import hvacmon.service
+import hvacmon.weather
+
+def load_frames(filename, groups=('annotated', 'errors')):
+    """
+    Loads the frames of the given archive groups.
+
+    Returns
+    -------
+    list of (group, name, image)
+    """
+    frames = []
+    with hvacmon.dataset.FrameDataset(filename) as data:
+        for group in groups:
+            for name, _, im, _ in data.iter_frames(group):
+                frames.append((group, name, im))
+    return frames
+
+def summarize(latencies):
+    """
+    Summarizes per-call latencies (seconds) in milliseconds.
+    """
+    ms = np.asarray(latencies)*1e3
+    return {
+        'n': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max())}
+
+def time_calls(func, items, repeat):
+    """
+    Times `func(item)` for every item, `repeat` times over.
+
+    Calls raising RuntimeError (e.g. parse failures on the error frames) are
+    timed and counted as errors.
+    """
+    latencies = []
+    errors = 0
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            try:
+                func(item)
+            except RuntimeError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+    result = summarize(latencies)
+    result['errors'] = errors
+    return result
+
+def measure_allocations(func, items):
+    """
+    Measures the memory allocated by `func(item)` for every item.
+
+    Runs separately from the timing pass since tracing slows allocations.
+    Reports the peak traced memory of a call above what was allocated before
+    it, averaged and maximized over items.
+    """
+    peaks = []
+    tracemalloc.start()
+    try:
+        for item in items:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            try:
+                func(item)
+            except RuntimeError:
+                pass
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return {
+        'alloc_peak_mean_bytes': float(np.mean(peaks)),
+        'alloc_peak_max_bytes': int(np.max(peaks))}
+
+def bench_imgproc(frames, repeat):
+    """
+    Benchmarks the LED parsers on the archived frames.
+    """
+    images = [im for _, _, im in frames]
+    roi = hvacmon.imgproc.DEFAULT_ROI
+
+    #
+    # find_leds() works on thresholded images; threshold the region the same
+    # way the parser does ahead of time so only blob detection is timed.
+    #
+    detector = hvacmon.imgproc.create_detector()
+    masks = []
+    for im in images:
+        value = cv2.cvtColor(roi.crop(im), cv2.COLOR_BGR2HSV)[:, :, 2]
+        masks.append(cv2.threshold(value, 75, 255, cv2.THRESH_BINARY)[1])
+
+    #
+    # The calibrated parser only skips blob detection on steady frames. The
+    # archive cycles through distinct frames, so that fast path is timed
+    # separately on one frame seen over and over, as while the HVAC state
+    # holds.
+    #
+    annotated = [im for group, _, im in frames if group == 'annotated']
+    steady = [annotated[0]]*len(images)
+    calibration = hvacmon.imgproc.LedCalibration()
+    steady_calibration = hvacmon.imgproc.LedCalibration()
+    cases = {
+        'parse_image': (hvacmon.imgproc.parse_image, images),
+        'parse_image_calibrated': (
+            lambda im: hvacmon.imgproc.parse_image(im,
+                                                   calibration=calibration),
+            images),
+        'parse_image_calibrated_steady': (
+            lambda im: hvacmon.imgproc.parse_image(
+                im, calibration=steady_calibration),
+            steady),
+        'find_leds': (lambda m: hvacmon.imgproc.find_leds(m, detector), masks),
+        'parse_image_hardcoded_positions': (
+            hvacmon.imgproc.parse_image_hardcoded_positions, images),
+    }
+
+    results = {}
+    for name, (func, items) in cases.items():
+        # Warm up (detector creation, buffer allocation, calibration)
+        for item in items[:2]:
+            try:
+                func(item)
+            except RuntimeError:
+                pass
+        results[name] = time_calls(func, items, repeat)
+        results[name].update(measure_allocations(func, items))
+    return results
+
+def zone_rows(n, start=datetime.datetime(2020, 1, 1)):
+    """
+    Generates `n` consecutive 5 second zone intervals.
+    """
+    rows = []
+    status = np.zeros((4,2), dtype=np.uint8)
+    for i in range(n):
+        status = status.copy()
+        status[i % 4, 0] ^= 1
+        t1 = start + datetime.timedelta(seconds=5*i)
+        rows.append((t1, t1 + datetime.timedelta(seconds=5), status))
+    return rows
+
+def bench_db(n):
+    """
+    Measures database insert throughput (rows per second).
+    """
+    rows = zone_rows(n)
+    temperatures = [(t1, 20.0 + i % 10) for i, (t1, _, _) in enumerate(rows)]
+
+    def run(filename, func, count, **kwargs):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database = hvacmon.db.Database(tmpdir, filename, **kwargs)
+            start = time.perf_counter()
+            func(database)
+            database.close()
+            elapsed = time.perf_counter() - start
+        return {'rows': count, 'seconds': elapsed,
+                'rows_per_s': count/elapsed}
+
+    #
+    # Unbuffered inserts commit every row, so use fewer of them
+    #
+    n_single = min(n, 1000)
+    return {
+        'append_zone_data': run(
+            'single.db',
+            lambda d: [d.append_zone_data(*r) for r in rows[:n_single]],
+            n_single),
+        'append_zone_data_buffered': run(
+            'buffered.db',
+            lambda d: [d.append_zone_data(*r) for r in rows],
+            n, buffer_size=256),
+        'append_zone_data_many': run(
+            'many.db', lambda d: d.append_zone_data_many(rows), n),
+        'append_temperature_data_many': run(
+            'temperature.db',
+            lambda d: d.append_temperature_data_many(temperatures), n),
+    }
+
+def bench_service(frames, n):
+    """
+    Drives the service sampling loop from a fake camera serving the frames.
+
+    The service's log output is discarded (but still produced, since it is
+    part of the loop).
+    """
+    images = [im for group, _, im in frames if group == 'annotated']
+    backend = hvacmon.camera.FakeCameraBackend(images)
+
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        weather_file = os.path.join(tmpdir, 'temperature.json')
+        with open(weather_file, 'w') as f:
+            json.dump({'temperature': 50.0}, f)
+
+        srv = hvacmon.service.Service(
+            tmpdir, None, None, None,
+            weather_provider=hvacmon.weather.FileProvider(weather_file),
+            camera_backend=backend)
+        capture = []
+        process = []
+        start = time.perf_counter()
+        for _ in range(n):
+            t0 = time.perf_counter()
+            frame = srv.capture_frame()
+            t1 = time.perf_counter()
+            srv.process_frame(frame)
+            t2 = time.perf_counter()
+            capture.append(t1 - t0)
+            process.append(t2 - t1)
+        elapsed = time.perf_counter() - start
+        for camera in srv._cameras.values():
+            camera.close()
+        srv._db.close()
+
+    return {
+        'samples': n,
+        'samples_per_s': n/elapsed,
+        'capture_frame': summarize(capture),
+        'process_frame': summarize(process)}
+
+def compare(results, baseline, tolerance, path=''):
+    """
+    Lists the metrics that regressed against a baseline.
+
+    Median latencies ('p50_ms') may not grow and throughputs ('rows_per_s',
+    'samples_per_s') may not shrink by more than `tolerance` (a fraction).
+    """
+    regressions = []
+    for key, value in results.items():
+        name = '%s.%s' % (path, key) if path else key
+        old = baseline.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            regressions += compare(value, old, tolerance, name)
+        elif old is None or not old:
+            continue
+        elif key == 'p50_ms' and value > old*(1 + tolerance):
+            regressions.append((name, old, value))
+        elif (key in ('rows_per_s', 'samples_per_s') and
+              value < old*(1 - tolerance)):
+            regressions.append((name, old, value))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str,
+        default='data/hvacmon_data.h5',
+        help="HDF5 archive of annotated frames (see hvacmon-annotate)")
+    parser.add_argument("-o", "--output", type=str,
+        help="JSON file to write results to (default: stdout)")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+        help="Number of passes over the frames for image processing")
+    parser.add_argument("--db-rows", type=int, default=10000,
+        help="Number of rows inserted per database benchmark")
+    parser.add_argument("--service-samples", type=int, default=200,
+        help="Number of samples taken through the service loop")
+    parser.add_argument("--baseline", type=str,
+        help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="Allowed relative regression against the baseline")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+    frames = load_frames(args.input)
+    if not frames:
+        print("No frames found in %s" % args.input, file=sys.stderr)
+        return 1
+
+    results = {
+        'meta': {
+            'timestamp': datetime.datetime.utcnow().isoformat(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'frames': len(frames)},
+        'imgproc': bench_imgproc(frames, args.repeat),
+        'db': bench_db(args.db_rows),
+        'service': bench_service(frames, args.service_samples),
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, old, new in regressions:
+            print("REGRESSION %s: %.3f -> %.3f" % (name, old, new),
+                  file=sys.stderr)
+        if regressions:
+            return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,25 +1,433 @@
 #!/usr/bin/env python
-import io
+import datetime
+import threading
 import time
-import picamera
-import picamera.array
+
+import hvacmon.metrics
 import hvacmon.util
 
+np = hvacmon.util.lazy_import('numpy')
+cv2 = hvacmon.util.lazy_import('cv2')
+
+_CONFIGURE_SECONDS = hvacmon.metrics.histogram(
+    'hvacmon_camera_configure_seconds',
+    'Time to apply camera settings (including the settle wait)')
+_SHUTTER_CHANGES = hvacmon.metrics.counter(
+    'hvacmon_shutter_changes_total',
+    'Shutter speed adjustments made by exposure control')
+
+#
+# Pixel formats of captured frames: 3 channel BGR, or the luma (Y) plane of
+# YUV420
+#
+FORMAT_BGR = 'bgr'
+FORMAT_YUV = 'yuv'
+
+class FrameRing:
+    """
+    Ring of preallocated frame buffers written to in place by the imager.
+
+    The ring is a writable file-like object: the imager writes the raw data of
+    each frame straight into the next buffer, and `frame()` returns an array
+    view of it without copying. Buffers are reused in turn, so a returned
+    frame stays valid until `size - 1` further frames have been started.
+
+    Unencoded frames are padded by the imager to a width of a multiple of 32
+    and a height of a multiple of 16; the padding is stripped by the view.
+    For FORMAT_YUV only the Y plane is exposed, as a single channel image.
+
+    Methods
+    -------
+    __init__(size=4, format=FORMAT_BGR)
+        Initializes an empty ring.
+    resize(resolution)
+        Sizes the buffers for a capture resolution.
+    advance()
+        Starts writing the next frame into the next buffer.
+    write(data)
+        Appends raw frame data to the current buffer.
+    frame()
+        Gets a view of the current frame.
+    """
+
+    def __init__(self, size=4, format=FORMAT_BGR):
+        """
+        Initializes an empty ring.
+
+        Parameters
+        ----------
+        size : int
+            Number of buffers.
+
+        format : str
+            FORMAT_BGR or FORMAT_YUV.
+        """
+        if size < 2:
+            raise ValueError('A frame ring needs at least 2 buffers.')
+        if format not in (FORMAT_BGR, FORMAT_YUV):
+            raise ValueError('Unsupported pixel format: %s' % format)
+        self.size = size
+        self.format = format
+        self._resolution = None
+        self._buffers = []
+        self._frames = []
+        self._index = 0
+        self._offset = 0
+
+    def resize(self, resolution):
+        """
+        Sizes the buffers for a capture resolution.
+
+        Buffers are only reallocated if the resolution changed.
+
+        Parameters
+        ----------
+        resolution : 2-tuple of int
+            Capture resolution as (width, height).
+        """
+        if resolution == self._resolution:
+            return
+        width, height = resolution
+        padded_width = (width + 31) // 32 * 32
+        padded_height = (height + 15) // 16 * 16
+        if self.format == FORMAT_BGR:
+            nbytes = padded_width*padded_height*3
+            shape = (padded_height, padded_width, 3)
+        else:
+            # Y plane followed by quarter size U and V planes
+            nbytes = padded_width*padded_height*3//2
+            shape = (padded_height, padded_width)
+        self._buffers = [np.empty(nbytes, dtype=np.uint8)
+                         for _ in range(self.size)]
+        self._frames = [buf[:np.prod(shape)].reshape(shape)[:height, :width]
+                        for buf in self._buffers]
+        self._resolution = resolution
+        self._index = 0
+        self._offset = 0
+
+    def advance(self):
+        """
+        Starts writing the next frame into the next buffer.
+        """
+        self._index = (self._index + 1) % self.size
+        self._offset = 0
+
+    def write(self, data):
+        """
+        Appends raw frame data to the current buffer.
+
+        Data beyond the end of the buffer is dropped.
+
+        Returns
+        -------
+        int
+            Number of bytes consumed (all of `data`).
+        """
+        data = memoryview(data).cast('B')
+        buf = self._buffers[self._index]
+        count = min(len(data), len(buf) - self._offset)
+        buf[self._offset:self._offset + count] = data[:count]
+        self._offset += count
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def frame(self):
+        """
+        Gets a view of the current frame.
+
+        Returns
+        -------
+        numpy.ndarray
+            Rows x Cols x 3 (BGR) or Rows x Cols (Y) view of the buffer.
+        """
+        return self._frames[self._index]
+
+class CameraBackend:
+    """
+    Interface between `Camera` and the imager that actually produces frames.
+
+    Backends are opened once per camera session, configured with the imager
+    settings and then asked for any number of frames before being closed.
+
+    Methods
+    -------
+    open()
+        Acquires the imager.
+    configure(resolution, rotation, exposure_mode, shutter_speed, zoom=None)
+        Applies imager settings and waits for them to take effect.
+    set_shutter_speed(shutter_speed)
+        Changes the shutter speed of the open imager.
+    capture()
+        Captures a single frame from the open imager.
+    close()
+        Releases the imager.
+
+    Backends may return frames backed by reused buffers (see `FrameRing`);
+    callers must copy frames they keep beyond the next few captures.
+    """
+
+    def open(self):
+        """
+        Acquires the imager.
+        """
+        raise NotImplementedError
+
+    def configure(self, resolution, rotation, exposure_mode, shutter_speed,
+                  zoom=None):
+        """
+        Applies imager settings and waits for them to take effect.
+
+        Parameters
+        ----------
+        resolution : 2-tuple of int
+            Capture resolution as (width, height).
+
+        rotation : int
+            Camera rotation to apply. Must be one of 0, 90, 180, or 270.
+
+        exposure_mode : str
+            Exposure mode understood by the imager (e.g. 'off').
+
+        shutter_speed : int
+            Shutter speed in microseconds.
+
+        zoom : 4-tuple of float, optional
+            Region of the sensor to capture as normalized (x, y, w, h) in
+            unrotated sensor coordinates. The region is scaled to
+            `resolution`. If None, the full sensor is captured.
+        """
+        raise NotImplementedError
+
+    def set_shutter_speed(self, shutter_speed):
+        """
+        Changes the shutter speed of the open imager.
+
+        Unlike `configure()`, does not wait for the imager to settle; the
+        change takes effect within a few frames.
+
+        Parameters
+        ----------
+        shutter_speed : int
+            Shutter speed in microseconds.
+        """
+        raise NotImplementedError
+
+    def capture(self):
+        """
+        Captures a single frame from the open imager.
+
+        Returns
+        -------
+        ndarray
+            NumPy array containing image data in 'bgr' order, or the luma
+            plane for FORMAT_YUV backends.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases the imager.
+        """
+        raise NotImplementedError
+
+class PiCameraBackend(CameraBackend):
+    """
+    Backend for the raspberry pi camera module.
+
+    picamera is imported when the backend is opened so this module can be
+    used on machines without a camera.
+
+    Frames are captured unencoded straight into a `FrameRing`, so no memory is
+    allocated or copied per frame beyond the imager's own buffers.
+    """
+
+    def __init__(self, use_video_port=False, settle_time=2, camera_num=0,
+                 format=FORMAT_BGR, buffers=4):
+        """
+        Initializes the backend.
+
+        Parameters
+        ----------
+        use_video_port : boolean
+            If set, frames are served from a continuous capture on the video
+            port rather than one still capture per frame. This is much
+            cheaper when the camera is kept open between frames.
+
+        settle_time : float
+            Seconds to wait after configuring the imager.
+
+        camera_num : int
+            Camera port to use on boards with several (e.g. compute modules).
+
+        format : str
+            FORMAT_BGR, or FORMAT_YUV to return only the luma plane.
+
+        buffers : int
+            Number of frame buffers (see `FrameRing`).
+        """
+        self._use_video_port = use_video_port
+        self._settle_time = settle_time
+        self._camera_num = camera_num
+        self._camera = None
+        self._ring = FrameRing(buffers, format)
+        self._frames = None
+
+    def open(self):
+        import picamera
+        self._camera = picamera.PiCamera(camera_num=self._camera_num)
+
+    def configure(self, resolution, rotation, exposure_mode, shutter_speed,
+                  zoom=None):
+        if self._frames is not None:
+            self._frames.close()
+            self._frames = None
+        self._camera.resolution = resolution
+        self._ring.resize(resolution)
+        self._camera.rotation = rotation
+        self._camera.zoom = zoom if zoom is not None else (0.0, 0.0, 1.0, 1.0)
+        self._camera.exposure_mode = exposure_mode
+        self._camera.shutter_speed = shutter_speed
+        time.sleep(self._settle_time)
+
+    def set_shutter_speed(self, shutter_speed):
+        self._camera.shutter_speed = shutter_speed
+
+    def capture(self):
+        self._ring.advance()
+        if self._use_video_port:
+            if self._frames is None:
+                self._frames = self._camera.capture_continuous(
+                    self._ring, format=self._ring.format,
+                    use_video_port=True)
+            next(self._frames)
+        else:
+            self._camera.capture(self._ring, format=self._ring.format)
+        return self._ring.frame()
+
+    def close(self):
+        if self._frames is not None:
+            self._frames.close()
+            self._frames = None
+        if self._camera is not None:
+            self._camera.close()
+            self._camera = None
+
+class FakeCameraBackend(CameraBackend):
+    """
+    In-memory backend serving a fixed sequence of frames.
+
+    Intended for tests and offline runs on machines without a camera. Frames
+    are served in order and repeat once exhausted. The number of times the
+    backend was opened and configured is tracked for inspection.
+
+    Rotation is not simulated; frames are assumed to already be rotated. A
+    configured zoom region is cropped out of the served frames. Like the pi
+    camera backend, frames are served from a `FrameRing`.
+    """
+
+    def __init__(self, frames, format=FORMAT_BGR, buffers=4):
+        """
+        Initializes the backend.
+
+        Parameters
+        ----------
+        frames : list of numpy.ndarray
+            Frames (in 'bgr' order) to serve from `capture()`.
+
+        format : str
+            FORMAT_BGR, or FORMAT_YUV to serve the luma of the frames.
+
+        buffers : int
+            Number of frame buffers (see `FrameRing`).
+        """
+        if len(frames) < 1:
+            raise ValueError('At least one frame is required.')
+        self.frames = list(frames)
+        self.settings = None
+        self.open_count = 0
+        self.configure_count = 0
+        self._index = 0
+        self._is_open = False
+        self._ring = FrameRing(buffers, format)
+
+    def open(self):
+        if self._is_open:
+            raise RuntimeError('Camera is already open.')
+        self._is_open = True
+        self.open_count += 1
+
+    def configure(self, resolution, rotation, exposure_mode, shutter_speed,
+                  zoom=None):
+        self.settings = {
+            'resolution': resolution,
+            'rotation': rotation,
+            'exposure_mode': exposure_mode,
+            'shutter_speed': shutter_speed,
+            'zoom': zoom}
+        self.configure_count += 1
+
+    def set_shutter_speed(self, shutter_speed):
+        self.settings['shutter_speed'] = shutter_speed
+
+    def capture(self):
+        if not self._is_open:
+            raise RuntimeError('Camera is not open.')
+        frame = self.frames[self._index % len(self.frames)]
+        self._index += 1
+        zoom = self.settings['zoom'] if self.settings else None
+        if zoom is not None:
+            rows, cols = frame.shape[:2]
+            top = int(round(zoom[1]*rows))
+            left = int(round(zoom[0]*cols))
+            frame = frame[top:top + int(round(zoom[3]*rows)),
+                          left:left + int(round(zoom[2]*cols))]
+        self._ring.resize((frame.shape[1], frame.shape[0]))
+        self._ring.advance()
+        out = self._ring.frame()
+        if self._ring.format == FORMAT_YUV:
+            out[...] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        else:
+            out[...] = frame
+        return out
+
+    def close(self):
+        self._is_open = False
+
 class Camera:
     """
     Helper for configuring and obtaining images off raspberry pi camera.
 
-    Wraps the picamera module with specific settings.
+    Wraps a camera backend (picamera by default) with specific settings.
+
+    By default the camera is opened, configured and closed for every frame.
+    In persistent mode the camera is opened and configured once and frames are
+    served from the open session until `close()` is called.
+
+    If a region of interest is configured, the imager is asked to capture only
+    that region (via its zoom setting) at the same pixel scale as a full
+    frame, and frames returned by `get_frame()` are cropped to the region.
+
+    The shutter speed can be changed at any time (see `ExposureControl`).
+    The camera may be shared between threads.
+
+    Frames are views of buffers the backend reuses (see `FrameRing`); copy
+    frames that are kept for longer than a few captures.
 
     Methods
     -------
-    __init__(rotation=0)
+    __init__(rotation=0, persistent=False, backend=None, roi=None)
         Initializes the camera object and configures imager settings.
+    open()
+        Opens the camera and applies the imager settings.
+    close()
+        Closes the camera if it is open.
     get_frame()
         Reads frame into an openCV compatible buffer.
     """
 
-    def __init__(self, rotation=0):
+    def __init__(self, rotation=0, persistent=False, backend=None, roi=None):
         """
         Initializes the object and configures the imager
 
@@ -27,46 +435,254 @@ class Camera:
         ----------
         rotation : int
             Camera rotation to apply. Must be one of 0, 90, 180, or 270.
+
+        persistent : boolean
+            Whether to keep the camera open between frames.
+
+        backend : CameraBackend, optional
+            Backend used to capture frames. Defaults to the raspberry pi
+            camera module.
+
+        roi : hvacmon.imgproc.Roi, optional
+            Region of the (rotated) full frame to capture. If None, full
+            frames are captured.
         """
         self._resolution = (1280, 720)
         self._exposure_mode = 'off'
         self._shutter_speed = 16000
         self._rotation = rotation
+        self._persistent = persistent
+        self._roi = roi
+        if backend is None:
+            backend = PiCameraBackend(use_video_port=persistent)
+        self._backend = backend
+        self._is_open = False
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def roi(self):
+        """
+        Region of the full frame captured by the camera (None if full frames).
+        """
+        return self._roi
+
+    @property
+    def shutter_speed(self):
+        """
+        Shutter speed in microseconds.
+
+        Setting it changes the shutter speed of an open camera in place (no
+        settle wait); a closed camera uses it when next opened.
+        """
+        return self._shutter_speed
 
-    def set_settings(self, camera):
+    @shutter_speed.setter
+    def shutter_speed(self, shutter_speed):
+        with self._lock:
+            self._shutter_speed = int(shutter_speed)
+            if self._is_open:
+                self._backend.set_shutter_speed(self._shutter_speed)
+
+    def _get_zoom(self):
+        """
+        Converts the region of interest to a normalized sensor zoom region.
+
+        The ROI is given in rotated output coordinates while the imager crops
+        in unrotated sensor coordinates (rotation is clockwise).
+        """
+        w_full, h_full = self._resolution
+        x = self._roi.left / w_full
+        y = self._roi.top / h_full
+        w = (self._roi.right - self._roi.left) / w_full
+        h = (self._roi.bottom - self._roi.top) / h_full
+        if self._rotation == 90:
+            return (y, 1 - x - w, h, w)
+        elif self._rotation == 180:
+            return (1 - x - w, 1 - y - h, w, h)
+        elif self._rotation == 270:
+            return (1 - y - h, x, h, w)
+        return (x, y, w, h)
+
+    def set_settings(self):
         """
         Sets the imager settings and waits for them to take effect
+        """
+        if self._roi is None:
+            resolution = self._resolution
+            zoom = None
+        else:
+            resolution = (self._roi.right - self._roi.left,
+                          self._roi.bottom - self._roi.top)
+            zoom = self._get_zoom()
+        with _CONFIGURE_SECONDS.time():
+            self._backend.configure(
+                resolution,
+                self._rotation,
+                self._exposure_mode,
+                self._shutter_speed,
+                zoom)
 
-        Parameters
-        ----------
-        camera : picamera.PiCamera
-            Open handle to the camera
+    def open(self):
+        """
+        Opens the camera and applies the imager settings.
+        """
+        with self._lock:
+            if self._is_open:
+                return
+            self._backend.open()
+            self._is_open = True
+            try:
+                self.set_settings()
+            except:
+                self.close()
+                raise
+
+    def close(self):
+        """
+        Closes the camera if it is open.
         """
-        camera.resolution = self._resolution
-        camera.rotation = self._rotation
-        camera.exposure_mode = self._exposure_mode
-        camera.shutter_speed = self._shutter_speed
-        time.sleep(2)
+        with self._lock:
+            if self._is_open:
+                self._is_open = False
+                self._backend.close()
 
     def get_frame(self):
         """
         Reads frame into an openCV compatible buffer.
 
+        In persistent mode the camera is opened on first use. If a capture
+        fails the session is closed so it is reopened on the next call.
+
         Returns
         -------
-        timestamp : str
-            Approximate timestamp associated with the frame capture.
+        timestamp : datetime.datetime
+            Approximate time of the frame capture (UTC).
 
-        image : 3 dimensional ndarray
+        image : ndarray
             NumPy array containing image data. Rows and Cols match configured
-            imager size. Channels are in 'bgr' order for use with OpenCV.
+            imager size (or the region of interest, if configured). Channels
+            are in 'bgr' order for use with OpenCV, or the image has a single
+            (luma) channel if the backend captures FORMAT_YUV.
         """
-        timestamp = hvacmon.util.get_timestamp()
-        stream = io.BytesIO()
-        with picamera.PiCamera() as camera:
-            self.set_settings(camera)
-            with picamera.array.PiRGBArray(camera) as stream:
-                camera.capture(stream, format='bgr')
-                image = stream.array
+        with self._lock:
+            timestamp = datetime.datetime.utcnow()
+            self.open()
+            try:
+                image = self._backend.capture()
+            except:
+                self.close()
+                raise
+            if not self._persistent:
+                self.close()
 
         return timestamp, image
+
+class ExposureControl:
+    """
+    Closed loop control of the shutter speed of a camera.
+
+    Tracks a moving average of the peak brightness of the LED panel region
+    (see `hvacmon.imgproc.frame_brightness`), i.e. of the lit power LED. When
+    it drifts out of the target band, the shutter speed is stepped by a
+    constant factor, within limits, so the LEDs stay bright without
+    saturating into each other as ambient light changes. After a step, a
+    number of frames are observed before the next one to let the imager and
+    the average catch up.
+
+    The object may be shared between threads.
+
+    Methods
+    -------
+    __init__(camera, target=(180, 250), step=1.25, min_shutter=500,
+             max_shutter=60000, holdoff=5, smoothing=0.3)
+        Initializes the controller.
+    observe(peak)
+        Records the peak brightness of a frame, adjusting the shutter speed
+        if needed.
+    """
+
+    def __init__(self, camera, target=(180, 250), step=1.25, min_shutter=500,
+                 max_shutter=60000, holdoff=5, smoothing=0.3):
+        """
+        Initializes the controller.
+
+        Parameters
+        ----------
+        camera : Camera
+            Camera to control.
+
+        target : 2-tuple of float
+            Band (0-255) the average peak brightness is kept within.
+
+        step : float
+            Factor by which the shutter speed is changed at a time.
+
+        min_shutter, max_shutter : int
+            Limits of the shutter speed, in microseconds.
+
+        holdoff : int
+            Number of frames observed after a change before the next one.
+
+        smoothing : float
+            Weight of each new frame in the moving average (0-1).
+        """
+        self._camera = camera
+        self._low, self._high = target
+        self._step = step
+        self._min_shutter = min_shutter
+        self._max_shutter = max_shutter
+        self._holdoff = holdoff
+        self._smoothing = smoothing
+        self._average = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def average(self):
+        """
+        Moving average of the peak brightness (None before any frame).
+        """
+        return self._average
+
+    def observe(self, peak):
+        """
+        Records the peak brightness of a frame, adjusting the shutter speed
+        if needed.
+
+        Parameters
+        ----------
+        peak : float
+            Peak brightness (0-255) of the LED panel region.
+
+        Returns
+        -------
+        int or None
+            New shutter speed if it was changed.
+        """
+        with self._lock:
+            if self._average is None:
+                self._average = peak
+            else:
+                self._average += self._smoothing*(peak - self._average)
+            self._count += 1
+            if self._count < self._holdoff:
+                return None
+
+            shutter = self._camera.shutter_speed
+            if self._average > self._high:
+                shutter = max(self._min_shutter, shutter/self._step)
+            elif self._average < self._low:
+                shutter = min(self._max_shutter, shutter*self._step)
+            shutter = int(round(shutter))
+            if shutter == self._camera.shutter_speed:
+                return None
+            self._count = 0
+        _SHUTTER_CHANGES.inc()
+        self._camera.shutter_speed = shutter
+        return shutter
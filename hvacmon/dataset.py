@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+import hvacmon.util
+
+#
+# numpy and h5py are slow to import; defer them until first used
+#
+np = hvacmon.util.lazy_import('numpy')
+h5py = hvacmon.util.lazy_import('h5py')
+
+#
+# Names of the datasets making up a stacked group
+#
+FRAMES = 'frames'
+TABLE = 'table'
+
+#
+# Frames are compressed one per chunk, so reading a frame decompresses only
+# that frame
+#
+COMPRESSION = 'gzip'
+COMPRESSION_LEVEL = 4
+
+#
+# Longest image name stored in the table
+#
+NAME_LENGTH = 64
+
+def _table_dtype(zones):
+    return np.dtype([
+        ('name', 'S%d' % NAME_LENGTH),
+        ('timestamp', '<i8'),
+        ('status', np.uint8, (zones, 2))])
+
+class FrameDataset:
+    """
+    Archive of annotated frames in an HDF5 file.
+
+    Frames are grouped (e.g. 'annotated' and 'errors', as written by
+    hvacmon-annotate). Each group stores its frames stacked in a single
+    chunked, compressed and resizable N x H x W x 3 dataset ('frames') with a
+    parallel table ('table') holding the name, timestamp (epoch ms, -1 if
+    unknown) and status of every frame. Frames may optionally be cropped to a
+    region of interest before being stored; the region is recorded in the
+    group's 'roi' attribute.
+
+    The file is kept open for the lifetime of the object and frames are read
+    one at a time, so archives much larger than memory can be streamed.
+
+    Groups in the older layout (one dataset per frame, named after the image
+    with the status as its 'status' attribute) are read transparently, so
+    existing archives need not be rebuilt.
+
+    Methods
+    -------
+    __init__(filename, mode='r', roi=None)
+        Opens the archive.
+    close()
+        Closes the archive.
+    groups()
+        Names of the groups in the archive.
+    names(group)
+        Names of the frames of a group.
+    read(group, key)
+        Reads a single frame.
+    iter_frames(group, start=0, stop=None)
+        Lazily iterates over the frames of a group.
+    append(group, name, im, status, timestamp=None)
+        Appends a frame to a group.
+    """
+
+    def __init__(self, filename, mode='r', roi=None):
+        """
+        Opens the archive.
+
+        Parameters
+        ----------
+        filename : str
+            HDF5 file.
+
+        mode : str
+            h5py file mode ('r' to read, 'a' to read and append).
+
+        roi : hvacmon.imgproc.Roi, optional
+            Region frames are cropped to when appended to a group without
+            stacked frames yet (a new group or one in the older layout).
+            Groups with stacked frames keep their own region.
+        """
+        self._file = h5py.File(filename, mode)
+        self._roi = roi
+        self._names = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the archive.
+        """
+        self._file.close()
+
+    def flush(self):
+        """
+        Flushes pending writes to disk.
+        """
+        self._file.flush()
+
+    def groups(self):
+        """
+        Names of the groups in the archive.
+        """
+        return list(self._file.keys())
+
+    def _is_stacked(self, g):
+        return FRAMES in g and isinstance(g[FRAMES], h5py.Dataset)
+
+    def _legacy_names(self, g):
+        """
+        Names of the per-frame datasets of a group (older layout).
+        """
+        return [name for name, obj in g.items()
+                if name not in (FRAMES, TABLE) and
+                isinstance(obj, h5py.Dataset)]
+
+    def __len__(self):
+        return sum(self.count(group) for group in self.groups())
+
+    def count(self, group):
+        """
+        Number of frames in a group.
+        """
+        if group not in self._file:
+            return 0
+        g = self._file[group]
+        n = len(self._legacy_names(g))
+        if self._is_stacked(g):
+            n += g[TABLE].shape[0]
+        return n
+
+    def names(self, group):
+        """
+        Names of the frames of a group, in storage order.
+
+        Only the table is read, not the frames.
+        """
+        g = self._file[group]
+        names = []
+        if self._is_stacked(g):
+            names += [n.decode() for n in g[TABLE].fields('name')[:]]
+        return names + self._legacy_names(g)
+
+    def roi(self, group):
+        """
+        Region of interest frames of a group were cropped to, or None.
+
+        Frames in the older layout are never cropped.
+        """
+        roi = self._file[group].attrs.get('roi')
+        if roi is None:
+            return None
+        import hvacmon.imgproc
+        return hvacmon.imgproc.Roi(*(int(v) for v in roi))
+
+    def _index(self, group, name):
+        """
+        Index of a named frame in a stacked group, or None.
+        """
+        g = self._file[group]
+        if not self._is_stacked(g):
+            return None
+        names = self._names.get(group)
+        if names is None or len(names) != g[TABLE].shape[0]:
+            names = {n.decode(): i for i, n in
+                     enumerate(g[TABLE].fields('name')[:])}
+            self._names[group] = names
+        return names.get(name)
+
+    def read(self, group, key):
+        """
+        Reads a single frame.
+
+        Parameters
+        ----------
+        group : str
+            Group of the frame.
+
+        key : str or int
+            Name of the frame, or its index in the stacked frames.
+
+        Returns
+        -------
+        name : str
+            Name of the frame.
+
+        timestamp : datetime.datetime or None
+            Time of the frame (UTC), if known.
+
+        image : numpy.ndarray
+            Frame (BGR).
+
+        status : numpy.ndarray
+            Annotated status, or None if there is none.
+        """
+        g = self._file[group]
+        if isinstance(key, str):
+            index = self._index(group, key)
+            if index is None:
+                dset = g[key]
+                status = dset.attrs.get('status')
+                return key, None, dset[:], status
+        else:
+            index = key
+        row = g[TABLE][index]
+        timestamp = None
+        if row['timestamp'] >= 0:
+            timestamp = hvacmon.util.from_epoch_ms(int(row['timestamp']))
+        return (row['name'].decode(), timestamp, g[FRAMES][index],
+                row['status'])
+
+    def iter_frames(self, group, start=0, stop=None):
+        """
+        Lazily iterates over the frames of a group.
+
+        Frames are read from disk one at a time as the iterator advances.
+
+        Parameters
+        ----------
+        group : str
+            Group to iterate over.
+
+        start, stop : int, optional
+            Range of frames (in storage order) to iterate over.
+
+        Yields
+        ------
+        4-tuple of (name, timestamp, image, status) as returned by `read()`.
+        """
+        if group not in self._file:
+            return
+        g = self._file[group]
+        n_stacked = g[TABLE].shape[0] if self._is_stacked(g) else 0
+        legacy = self._legacy_names(g)
+        if stop is None:
+            stop = n_stacked + len(legacy)
+        for i in range(start, stop):
+            if i < n_stacked:
+                yield self.read(group, i)
+            else:
+                yield self.read(group, legacy[i - n_stacked])
+
+    def _create(self, group, im, status, roi=None):
+        """
+        Creates the stacked datasets of a group for frames like `im`, cropped
+        to `roi` if given.
+        """
+        g = self._file.require_group(group)
+        if roi is not None:
+            g.attrs['roi'] = np.asarray(roi, dtype=np.int32)
+        g.create_dataset(
+            FRAMES, shape=(0,) + im.shape, maxshape=(None,) + im.shape,
+            dtype=im.dtype, chunks=(1,) + im.shape,
+            compression=COMPRESSION, compression_opts=COMPRESSION_LEVEL,
+            shuffle=True)
+        g.create_dataset(
+            TABLE, shape=(0,), maxshape=(None,),
+            dtype=_table_dtype(len(status)), chunks=(256,))
+        return g
+
+    def append(self, group, name, im, status, timestamp=None):
+        """
+        Appends a frame to a group.
+
+        Parameters
+        ----------
+        group : str
+            Group to append to (created if needed).
+
+        name : str
+            Name of the frame (e.g. the source image name).
+
+        im : numpy.ndarray
+            Frame (BGR). It is cropped to the region of interest of the
+            group, if it has one, unless it already has the region's shape.
+
+        status : numpy.ndarray
+            Annotated status of the frame (zones x 2).
+
+        timestamp : datetime.datetime, optional
+            Time of the frame (UTC).
+        """
+        if len(name.encode()) > NAME_LENGTH:
+            raise ValueError('Frame name longer than %d bytes: %s'
+                % (NAME_LENGTH, name))
+        status = np.asarray(status, dtype=np.uint8)
+
+        #
+        # The first stacked frame of a group (also of one in the older
+        # layout) sets its region; later frames follow it
+        #
+        g = self._file.get(group)
+        stacked = g is not None and self._is_stacked(g)
+        roi = self.roi(group) if stacked else self._roi
+        if roi is not None and im.shape[:2] != roi.shape:
+            im = roi.crop(im)
+        if not stacked:
+            g = self._create(group, im, status, roi)
+
+        frames = g[FRAMES]
+        table = g[TABLE]
+        if im.shape != frames.shape[1:]:
+            raise ValueError('Frame shape %s does not match group %s (%s)'
+                % (im.shape, group, frames.shape[1:]))
+
+        n = frames.shape[0]
+        frames.resize(n + 1, axis=0)
+        frames[n] = im
+        row = np.zeros((), dtype=table.dtype)
+        row['name'] = name.encode()
+        row['timestamp'] = (-1 if timestamp is None
+                            else hvacmon.util.to_epoch_ms(timestamp))
+        row['status'] = status
+        table.resize(n + 1, axis=0)
+        table[n] = row
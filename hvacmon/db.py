@@ -1,20 +1,150 @@
 import os
 import sqlite3
+import threading
+import time
+import hvacmon.metrics
+import hvacmon.util
+
+np = hvacmon.util.lazy_import('numpy')
+
+#
+# Version of the database layout (stored as PRAGMA user_version)
+#   0: ISO8601 TEXT timestamps, one INTEGER column per zone indicator
+#   1: Integer epoch (ms) timestamps, zone status packed in a bitmask, indexed
+#   2: Hourly zone_rollup table maintained on insert
+#   3: Readings and rollup keyed by panel id ('' for single panel setups)
+#   4: Manifest of image files processed offline and the saved tracker state
+#
+SCHEMA_VERSION = 4
+
+MS_PER_HOUR = 3600000
+
+#
+# Rollup periods supported by the aggregation queries, in hours
+#
+PERIODS = {'hour': 1, 'day': 24}
+
+#
+# Pseudo bit in zone_rollup holding the total duration covered by readings
+#
+ROLLUP_COVERAGE = -1
+
+_COMMIT_SECONDS = hvacmon.metrics.histogram(
+    'hvacmon_db_commit_seconds', 'Time to insert and commit a batch of rows')
+
+def pack_status(zoneinfo):
+    """
+    Packs a zone status array into an integer bitmask.
+
+    Bit 2*zone + column holds zoneinfo[zone, column], so for a 4x2 array the
+    bits are (from least significant) one_call, one_valve, two_call, etc.
+
+    Parameters
+    ----------
+    zoneinfo : Nx2 numpy.ndarray
+        Array of status indicators where each row is a zone.
+
+    Returns
+    -------
+    int
+        Packed status.
+    """
+    mask = 0
+    for i, v in enumerate(np.asarray(zoneinfo).flat):
+        if v:
+            mask |= 1 << i
+    return mask
+
+def unpack_status(mask, zones=4):
+    """
+    Unpacks an integer bitmask produced by `pack_status`.
+
+    Parameters
+    ----------
+    mask : int or numpy.ndarray of int
+        Packed status (or array of them).
+
+    zones : int
+        Number of zones packed in the mask.
+
+    Returns
+    -------
+    numpy.ndarray
+        zonesx2 status array (with the shape of `mask` prepended for arrays).
+    """
+    mask = np.asarray(mask, dtype=np.int64)
+    bits = (mask[..., None] >> np.arange(zones*2)) & 1
+    return bits.astype(np.uint8).reshape(mask.shape + (zones, 2))
 
 class Database:
     """
     Helper for acessing the database backing the HVAC Monitor.
 
+    A single connection is kept open for the lifetime of the object. The
+    database uses write-ahead logging with synchronous=NORMAL, so commits do
+    not wait for an fsync (the last few commits may be lost on power loss, but
+    the database is never corrupted).
+
+    Writes can optionally be buffered in memory and committed together once
+    the buffer holds `buffer_size` rows or `flush_interval` seconds have
+    passed since the last flush.
+
+    The object may be shared between threads.
+
+    Timestamps are stored as integer milliseconds since the UNIX epoch (UTC)
+    and the zone status of each reading is packed into a single bitmask (see
+    `pack_status`). Databases using the original layout (ISO8601 TEXT
+    timestamps and one column per indicator) are migrated when opened.
+
+    An hourly rollup of the time each indicator was on is kept up to date on
+    insert, so duty cycle queries never scan the raw readings.
+
+    Zone readings of several LED panels can share a database; every reading
+    and rollup entry is keyed by the id of its panel. Single panel setups use
+    the default (empty) id. Panels may have any number of zones; queries
+    need to be told how many.
+
     Methods
     -------
-    __init__(filepath='/var/lib/hvacmon', filename='hvacmon.db')
+    __init__(filepath='/var/lib/hvacmon', filename='hvacmon.db',
+             buffer_size=0, flush_interval=None)
         Initializes the object and creates the database tables (if needed).
-    append_zone_data(starttime, endtime, zoneinfo)
+    close()
+        Flushes buffered writes and closes the connection.
+    flush()
+        Commits any buffered writes.
+    flush_if_due()
+        Commits buffered writes if `flush_interval` has passed.
+    append_zone_data(starttime, endtime, zoneinfo, panel='')
         Inserts a zoneinfo entry into the database.
+    append_zone_data_many(rows, panel='')
+        Inserts several zoneinfo entries in a single transaction.
     append_temperature_data(timestamp, temperature)
         Inserts a temperature entry into the database.
+    append_temperature_data_many(rows)
+        Inserts several temperature entries in a single transaction.
+    get_zone_data(starttime, endtime, panel='', zones=4)
+        Gets the zone readings overlapping a time range.
+    get_last_zone_time(panel='')
+        Gets the end of the latest zone reading of a panel.
+    get_temperature_data(starttime, endtime)
+        Gets the temperature readings within a time range.
+    get_duty_cycle(starttime, endtime, period='hour', panel='', zones=4)
+        Gets the per-zone call and valve duty cycle over a time range.
+    get_runtime_vs_temperature(starttime, endtime, period='hour', panel='',
+                               zones=4)
+        Gets the per-zone duty cycle alongside the mean outside temperature.
+    rebuild_rollup()
+        Recomputes the hourly rollup from the zone readings.
+    append_processed_files(files, zone_rows=(), state=None, panel='')
+        Records processed image files with their readings and tracker state.
+    get_processed_files()
+        Gets the manifest of processed image files.
+    get_processed_state(panel='', zones=4)
+        Gets the tracker state saved by `append_processed_files`.
     """
-    def __init__(self, filepath='/var/lib/hvacmon', filename='hvacmon.db'):
+    def __init__(self, filepath='/var/lib/hvacmon', filename='hvacmon.db',
+                 buffer_size=0, flush_interval=None):
         """
         Initializes the object.
 
@@ -26,56 +156,370 @@ class Database:
         filename : str
             Name of the SQLite3 database file at the location described by
             `filepath`.
+
+        buffer_size : int
+            Number of buffered rows at which writes are committed. If 0,
+            every append is committed immediately.
+
+        flush_interval : float, optional
+            Seconds after which buffered writes are committed on the next
+            append (or call to `flush_if_due()`), regardless of
+            `buffer_size`.
         """
         self._filename = os.path.join(filepath, filename)
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._zone_buffer = []
+        self._temperature_buffer = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+
+        self._db = sqlite3.connect(self._filename, check_same_thread=False)
+
+        #
+        # New databases release freed pages incrementally (see
+        # `hvacmon.retention`); this can only be set before anything is
+        # written to the file
+        #
+        if not self._db.execute(
+                'SELECT COUNT(*) FROM sqlite_master').fetchone()[0]:
+            self._db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        self._migrate()
+
+    def _migrate(self):
+        """
+        Creates the database tables or upgrades them to SCHEMA_VERSION.
+        """
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(
+                'Database schema version %d is newer than supported (%d).'
+                % (version, SCHEMA_VERSION))
+
+        # DDL is not transactional by default in the sqlite3 module
+        self._db.execute('BEGIN')
+        try:
+            cursor = self._db.cursor()
+            if version < 1:
+                self._migrate_v1(cursor)
+            if version < 2:
+                self._migrate_v2(cursor)
+            if version < 3:
+                self._migrate_v3(cursor)
+            if version < 4:
+                self._migrate_v4(cursor)
+            cursor.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            self._db.commit()
+        except:
+            self._db.rollback()
+            raise
+
+    def _migrate_v1(self, cursor):
+        """
+        Creates the version 1 tables, converting any original layout tables.
+        """
+        columns = [r[1] for r in
+                   cursor.execute('PRAGMA table_info(zone_readings)')]
+        legacy = 'one_call' in columns
+        if legacy:
+            cursor.execute('''
+                ALTER TABLE zone_readings RENAME TO zone_readings_v0''')
+            cursor.execute('''
+                ALTER TABLE temperature_readings
+                RENAME TO temperature_readings_v0''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS "zone_readings"(
+                starttime INTEGER NOT NULL, endtime INTEGER NOT NULL,
+                status INTEGER NOT NULL)''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS "zone_readings_starttime"
+            ON zone_readings(starttime)''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS "temperature_readings"(
+                timestamp INTEGER NOT NULL, temperature REAL)''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS "temperature_readings_timestamp"
+            ON temperature_readings(timestamp)''')
 
-        # Create the tables if they don't already exist
-        with sqlite3.connect(self._filename) as db:
-            cursor = db.cursor()
+        if legacy:
+            #
+            # julianday() understands the ISO8601 strings we stored
+            # (including any UTC offsets) and has millisecond precision
+            #
+            cursor.execute('''
+                INSERT INTO zone_readings(starttime, endtime, status)
+                SELECT
+                    CAST(ROUND((julianday(starttime) - 2440587.5)
+                               * 86400000) AS INTEGER),
+                    CAST(ROUND((julianday(endtime) - 2440587.5)
+                               * 86400000) AS INTEGER),
+                    (one_call != 0) | ((one_valve != 0) << 1) |
+                    ((two_call != 0) << 2) | ((two_valve != 0) << 3) |
+                    ((three_call != 0) << 4) | ((three_valve != 0) << 5) |
+                    ((four_call != 0) << 6) | ((four_valve != 0) << 7)
+                FROM zone_readings_v0 ORDER BY rowid''')
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS "zone_readings"(
-                    starttime TEXT, endtime TEXT,
-                    one_call INTEGER, one_valve INTEGER,
-                    two_call INTEGER, two_valve INTEGER,
-                    three_call INTEGER, three_valve INTEGER,
-                    four_call INTEGER, four_valve INTEGER)''')
+                INSERT INTO temperature_readings(timestamp, temperature)
+                SELECT
+                    CAST(ROUND((julianday(timestamp) - 2440587.5)
+                               * 86400000) AS INTEGER),
+                    temperature
+                FROM temperature_readings_v0 ORDER BY rowid''')
+            cursor.execute('''DROP TABLE zone_readings_v0''')
+            cursor.execute('''DROP TABLE temperature_readings_v0''')
+
+    def _migrate_v2(self, cursor):
+        """
+        Creates the hourly rollup table.
+
+        It is filled from existing readings by `_migrate_v3`, which rebuilds
+        it keyed by panel.
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS "zone_rollup"(
+                hour INTEGER NOT NULL, bit INTEGER NOT NULL,
+                duration INTEGER NOT NULL,
+                PRIMARY KEY(hour, bit)) WITHOUT ROWID''')
+
+    def _migrate_v3(self, cursor):
+        """
+        Keys the zone readings and the rollup by panel.
+
+        Existing readings are assigned to the default panel. The rollup only
+        holds derived data, so it is recreated and refilled from the readings.
+        """
+        columns = [r[1] for r in
+                   cursor.execute('PRAGMA table_info(zone_readings)')]
+        if 'panel' not in columns:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS "temperature_readings"(
-                    timestamp TEXT, temperature REAL)''')
-            db.commit()
+                ALTER TABLE zone_readings
+                ADD COLUMN panel TEXT NOT NULL DEFAULT '' ''')
+        cursor.execute('''DROP INDEX IF EXISTS "zone_readings_starttime"''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS "zone_readings_panel_starttime"
+            ON zone_readings(panel, starttime)''')
+
+        cursor.execute('''DROP TABLE IF EXISTS "zone_rollup"''')
+        cursor.execute('''
+            CREATE TABLE "zone_rollup"(
+                panel TEXT NOT NULL, hour INTEGER NOT NULL,
+                bit INTEGER NOT NULL, duration INTEGER NOT NULL,
+                PRIMARY KEY(panel, hour, bit)) WITHOUT ROWID''')
+        self._fill_rollup(cursor)
+
+    def _migrate_v4(self, cursor):
+        """
+        Creates the tables used to process debug images incrementally.
+
+        processed_files records every image file processed offline (see
+        bin/hvacmon-postprocess) with its mtime and the outcome, and
+        processed_state the state of the status tracker after the last one.
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS "processed_files"(
+                filename TEXT PRIMARY KEY, mtime INTEGER NOT NULL,
+                result TEXT NOT NULL) WITHOUT ROWID''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS "processed_state"(
+                panel TEXT PRIMARY KEY, starttime INTEGER NOT NULL,
+                status INTEGER NOT NULL, lasttime INTEGER NOT NULL)
+                WITHOUT ROWID''')
+
+    def _fill_rollup(self, cursor):
+        """
+        Adds all zone readings to the (empty) rollup, a chunk at a time.
+        """
+        readings = self._db.cursor()
+        readings.execute('''
+            SELECT starttime, endtime, status, panel FROM zone_readings''')
+        while True:
+            zone_rows = readings.fetchmany(10000)
+            if not zone_rows:
+                break
+            self._update_rollup(cursor, zone_rows)
+
+    def rebuild_rollup(self):
+        """
+        Recomputes the hourly rollup from the zone readings.
+
+        Needed after readings were written to the database directly (e.g. by
+        bulk conversion tools) rather than through the append methods.
+        """
+        with self._lock:
+            self.flush()
+            with self._db:
+                cursor = self._db.cursor()
+                cursor.execute('''DELETE FROM zone_rollup''')
+                self._fill_rollup(cursor)
+
+    @staticmethod
+    def _update_rollup(cursor, zone_rows):
+        """
+        Adds prepared zone rows to the hourly rollup.
+
+        Each reading is split at hour boundaries. For every panel and hour the
+        covered duration is accumulated under ROLLUP_COVERAGE and the time
+        each indicator was on under its bit.
+        """
+        totals = {}
+        for starttime, endtime, status, panel in zone_rows:
+            hour = starttime // MS_PER_HOUR
+            t = starttime
+            while t < endtime:
+                end = min(endtime, (hour + 1)*MS_PER_HOUR)
+                duration = end - t
+                keys = [(panel, hour, ROLLUP_COVERAGE)]
+                bit = 0
+                while status >> bit:
+                    if (status >> bit) & 1:
+                        keys.append((panel, hour, bit))
+                    bit += 1
+                for key in keys:
+                    totals[key] = totals.get(key, 0) + duration
+                t = end
+                hour += 1
+
+        cursor.executemany('''
+            INSERT OR IGNORE INTO zone_rollup(panel, hour, bit, duration)
+            VALUES(?,?,?,0)''', totals.keys())
+        cursor.executemany('''
+            UPDATE zone_rollup SET duration = duration + ?
+            WHERE panel = ? AND hour = ? AND bit = ?''',
+            [(d, p, h, b) for (p, h, b), d in totals.items()])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Flushes buffered writes and closes the connection.
+        """
+        with self._lock:
+            if self._db is None:
+                return
+            self.flush()
+            self._db.close()
+            self._db = None
+
+    def flush(self):
+        """
+        Commits any buffered writes.
+
+        Rows stay buffered until they are committed, so if the insert fails
+        (e.g. the database is busy) they are written by a later flush.
+        """
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if self._zone_buffer or self._temperature_buffer:
+                self._insert(self._zone_buffer, self._temperature_buffer)
+                self._zone_buffer = []
+                self._temperature_buffer = []
+
+    def flush_if_due(self):
+        """
+        Commits buffered writes if `flush_interval` has passed since the last
+        flush.
+
+        Appends only check the interval when they are made; call this
+        periodically so that rows are not held back while no more arrive.
+        """
+        with self._lock:
+            if (self._flush_interval is not None and
+                time.monotonic() - self._last_flush >= self._flush_interval):
+                self.flush()
+
+    def _insert(self, zone_rows, temperature_rows):
+        """
+        Inserts prepared rows in a single transaction.
+        """
+        with _COMMIT_SECONDS.time(), self._db:
+            cursor = self._db.cursor()
+            if zone_rows:
+                cursor.executemany('''
+                    INSERT INTO zone_readings(starttime, endtime, status,
+                                              panel)
+                    VALUES(?,?,?,?)''', zone_rows)
+                self._update_rollup(cursor, zone_rows)
+            if temperature_rows:
+                cursor.executemany('''
+                    INSERT INTO temperature_readings(timestamp, temperature)
+                    VALUES(?,?)''', temperature_rows)
 
-    def append_zone_data(self, starttime, endtime, zoneinfo):
+    def _append(self, zone_rows, temperature_rows):
+        """
+        Buffers prepared rows, flushing if a threshold was reached.
+        """
+        with self._lock:
+            self._zone_buffer.extend(zone_rows)
+            self._temperature_buffer.extend(temperature_rows)
+            pending = len(self._zone_buffer) + len(self._temperature_buffer)
+            if pending >= self._buffer_size:
+                self.flush()
+            else:
+                self.flush_if_due()
+
+    @staticmethod
+    def _zone_row(starttime, endtime, zoneinfo, panel=''):
+        return (hvacmon.util.to_epoch_ms(starttime),
+                hvacmon.util.to_epoch_ms(endtime),
+                pack_status(zoneinfo), panel)
+
+    @staticmethod
+    def _temperature_row(timestamp, temperature):
+        return (hvacmon.util.to_epoch_ms(timestamp), float(temperature))
+
+    def append_zone_data(self, starttime, endtime, zoneinfo, panel=''):
         """
         Inserts a zoneinfo entry into the database.
 
         Parameters
         ----------
-        starttime : str
-            Timestamp describing when this HVAC status began
+        starttime : str, datetime.datetime or int
+            Timestamp describing when this HVAC status began (see
+            `hvacmon.util.to_epoch_ms`)
 
-        starttime : str
+        endtime : str, datetime.datetime or int
             Timestamp describing when this HVAC status ended
 
-        zoneinfo : 4x2 numpy.ndarray
+        zoneinfo : Nx2 numpy.ndarray
             Array of status indicators where each row is a zone.
             The first column indicates whether the thermostat is calling.
             The second column indicates whether the zone valve is open.
+
+        panel : str
+            Id of the LED panel the reading was taken from.
         """
-        with sqlite3.connect(self._filename) as db:
-            cursor = db.cursor()
-            cursor.execute('''
-                INSERT INTO zone_readings(starttime, endtime,
-                                          one_call, one_valve,
-                                          two_call, two_valve,
-                                          three_call, three_valve,
-                                          four_call, four_valve)
-                VALUES(?,?,?,?,?,?,?,?,?,?)''',
-                (str(starttime), str(endtime),
-                 int(zoneinfo[0,0]), int(zoneinfo[0,1]),
-                 int(zoneinfo[1,0]), int(zoneinfo[1,1]),
-                 int(zoneinfo[2,0]), int(zoneinfo[2,1]),
-                 int(zoneinfo[3,0]), int(zoneinfo[3,1])))
-            db.commit()
+        self._append(
+            [self._zone_row(starttime, endtime, zoneinfo, panel)], [])
+
+    def append_zone_data_many(self, rows, panel=''):
+        """
+        Inserts several zoneinfo entries in a single transaction.
+
+        Buffered writes are flushed first to preserve ordering.
+
+        Parameters
+        ----------
+        rows : iterable of 3-tuples
+            (starttime, endtime, zoneinfo) entries as accepted by
+            `append_zone_data`.
+
+        panel : str
+            Id of the LED panel the readings were taken from.
+        """
+        zone_rows = [self._zone_row(*r, panel=panel) for r in rows]
+        with self._lock:
+            self.flush()
+            self._insert(zone_rows, [])
 
     def append_temperature_data(self, timestamp, temperature):
         """
@@ -83,15 +527,354 @@ class Database:
 
         Parameters
         ----------
-        timestamp : str
-            Time at which the temperature reading was obtained.
+        timestamp : str, datetime.datetime or int
+            Time at which the temperature reading was obtained (see
+            `hvacmon.util.to_epoch_ms`).
 
         temperature : float
             Temperature reading in degrees F.
         """
-        with sqlite3.connect(self._filename) as db:
-            cursor = db.cursor()
-            cursor.execute('''
-                INSERT INTO temperature_readings(timestamp, temperature)
-                VALUES(?,?)''', (str(timestamp), float(temperature)))
-            db.commit()
+        self._append([], [self._temperature_row(timestamp, temperature)])
+
+    def append_temperature_data_many(self, rows):
+        """
+        Inserts several temperature entries in a single transaction.
+
+        Buffered writes are flushed first to preserve ordering.
+
+        Parameters
+        ----------
+        rows : iterable of 2-tuples
+            (timestamp, temperature) entries as accepted by
+            `append_temperature_data`.
+        """
+        temperature_rows = [self._temperature_row(*r) for r in rows]
+        with self._lock:
+            self.flush()
+            self._insert([], temperature_rows)
+
+    def get_zone_data(self, starttime, endtime, panel='', zones=4):
+        """
+        Gets the zone readings overlapping a time range.
+
+        Parameters
+        ----------
+        starttime : str, datetime.datetime or int
+            Start of the range (see `hvacmon.util.to_epoch_ms`).
+
+        endtime : str, datetime.datetime or int
+            End of the range (exclusive).
+
+        panel : str
+            Id of the LED panel.
+
+        zones : int
+            Number of zones of the panel.
+
+        Returns
+        -------
+        starttimes : N numpy.ndarray of datetime64[ms]
+            Start of each reading.
+
+        endtimes : N numpy.ndarray of datetime64[ms]
+            End of each reading.
+
+        zoneinfo : N x zones x 2 numpy.ndarray
+            Status array of each reading.
+        """
+        start = hvacmon.util.to_epoch_ms(starttime)
+        end = hvacmon.util.to_epoch_ms(endtime)
+        with self._lock:
+            self.flush()
+            cursor = self._db.cursor()
+            #
+            # Both queries are index range scans on (panel, starttime). The
+            # first picks up a reading which started before (but overlaps)
+            # the range.
+            #
+            rows = cursor.execute('''
+                SELECT starttime, endtime, status FROM zone_readings
+                WHERE panel = ? AND starttime < ?
+                ORDER BY starttime DESC LIMIT 1''',
+                (panel, start)).fetchall()
+            rows = [r for r in rows if r[1] > start]
+            rows.extend(cursor.execute('''
+                SELECT starttime, endtime, status FROM zone_readings
+                WHERE panel = ? AND starttime >= ? AND starttime < ?
+                ORDER BY starttime''', (panel, start, end)))
+
+        data = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        return (data[:,0].astype('datetime64[ms]'),
+                data[:,1].astype('datetime64[ms]'),
+                unpack_status(data[:,2], zones))
+
+    def get_last_zone_time(self, panel=''):
+        """
+        Gets the end of the latest zone reading of a panel.
+
+        Parameters
+        ----------
+        panel : str
+            Id of the LED panel.
+
+        Returns
+        -------
+        datetime.datetime or None
+            End of the reading (UTC), or None if there are no readings.
+        """
+        with self._lock:
+            self.flush()
+            row = self._db.execute('''
+                SELECT endtime FROM zone_readings WHERE panel = ?
+                ORDER BY starttime DESC LIMIT 1''', (panel,)).fetchone()
+        if row is None:
+            return None
+        return hvacmon.util.from_epoch_ms(row[0])
+
+    def get_temperature_data(self, starttime, endtime):
+        """
+        Gets the temperature readings within a time range.
+
+        Parameters
+        ----------
+        starttime : str, datetime.datetime or int
+            Start of the range (see `hvacmon.util.to_epoch_ms`).
+
+        endtime : str, datetime.datetime or int
+            End of the range (exclusive).
+
+        Returns
+        -------
+        timestamps : N numpy.ndarray of datetime64[ms]
+            Time of each reading.
+
+        temperatures : N numpy.ndarray
+            Temperature readings in degrees F.
+        """
+        start = hvacmon.util.to_epoch_ms(starttime)
+        end = hvacmon.util.to_epoch_ms(endtime)
+        with self._lock:
+            self.flush()
+            rows = self._db.execute('''
+                SELECT timestamp, temperature FROM temperature_readings
+                WHERE timestamp >= ? AND timestamp < ?
+                ORDER BY timestamp''', (start, end)).fetchall()
+
+        data = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        return (data[:,0].astype(np.int64).astype('datetime64[ms]'),
+                data[:,1])
+
+    def get_duty_cycle(self, starttime, endtime, period='hour', panel='',
+                       zones=4):
+        """
+        Gets the per-zone call and valve duty cycle over a time range.
+
+        Aggregation is done in SQL over the hourly rollup, so the cost does
+        not depend on the number of readings. Periods are aligned to UTC
+        hours/days; the range is widened to whole periods.
+
+        Parameters
+        ----------
+        starttime : str, datetime.datetime or int
+            Start of the range (see `hvacmon.util.to_epoch_ms`).
+
+        endtime : str, datetime.datetime or int
+            End of the range (exclusive).
+
+        period : str
+            One of 'hour' or 'day'.
+
+        panel : str
+            Id of the LED panel.
+
+        zones : int
+            Number of zones of the panel.
+
+        Returns
+        -------
+        periods : N numpy.ndarray of datetime64[ms]
+            Start of each period with readings.
+
+        duty : N x zones x 2 numpy.ndarray
+            Fraction of the observed time in each period that each indicator
+            was on (see `append_zone_data` for the layout).
+
+        observed : N numpy.ndarray
+            Seconds of each period covered by readings.
+        """
+        hours = PERIODS[period]
+        start = hvacmon.util.to_epoch_ms(starttime) // (MS_PER_HOUR*hours)
+        end = -(-hvacmon.util.to_epoch_ms(endtime) // (MS_PER_HOUR*hours))
+        with self._lock:
+            self.flush()
+            rows = self._db.execute('''
+                SELECT hour / ? AS bucket, bit, SUM(duration)
+                FROM zone_rollup WHERE panel = ? AND hour >= ? AND hour < ?
+                GROUP BY bucket, bit ORDER BY bucket''',
+                (hours, panel, start*hours, end*hours)).fetchall()
+
+        data = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        buckets, index = np.unique(data[:,0], return_inverse=True)
+        durations = np.zeros((len(buckets), 1 + zones*2))
+        durations[index, data[:,1] + 1] = data[:,2]
+        observed = durations[:,0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            duty = np.nan_to_num(durations[:,1:] / observed[:,None])
+        return ((buckets*hours*MS_PER_HOUR).astype('datetime64[ms]'),
+                duty.reshape(-1, zones, 2),
+                observed / 1000)
+
+    def get_runtime_vs_temperature(self, starttime, endtime, period='hour',
+                                   panel='', zones=4):
+        """
+        Gets the per-zone duty cycle alongside the mean outside temperature.
+
+        Only periods with both zone and temperature readings are returned.
+
+        Parameters
+        ----------
+        starttime : str, datetime.datetime or int
+            Start of the range (see `hvacmon.util.to_epoch_ms`).
+
+        endtime : str, datetime.datetime or int
+            End of the range (exclusive).
+
+        period : str
+            One of 'hour' or 'day'.
+
+        panel : str
+            Id of the LED panel.
+
+        zones : int
+            Number of zones of the panel.
+
+        Returns
+        -------
+        periods : N numpy.ndarray of datetime64[ms]
+            Start of each period.
+
+        temperature : N numpy.ndarray
+            Mean temperature reading in each period (degrees F).
+
+        duty : N x zones x 2 numpy.ndarray
+            Duty cycle of each indicator (see `get_duty_cycle`).
+        """
+        periods, duty, observed = self.get_duty_cycle(
+            starttime, endtime, period, panel, zones)
+
+        period_ms = PERIODS[period]*MS_PER_HOUR
+        start = hvacmon.util.to_epoch_ms(starttime) // period_ms
+        end = -(-hvacmon.util.to_epoch_ms(endtime) // period_ms)
+        with self._lock:
+            rows = self._db.execute('''
+                SELECT timestamp / ? AS bucket, AVG(temperature)
+                FROM temperature_readings
+                WHERE timestamp >= ? AND timestamp < ?
+                GROUP BY bucket ORDER BY bucket''',
+                (period_ms, start*period_ms, end*period_ms)).fetchall()
+
+        data = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        temperature_periods = (data[:,0].astype(np.int64)*period_ms).astype(
+            'datetime64[ms]')
+        common, zone_index, temperature_index = np.intersect1d(
+            periods, temperature_periods, return_indices=True)
+        return common, data[temperature_index,1], duty[zone_index]
+
+    def append_processed_files(self, files, zone_rows=(), state=None,
+                               panel=''):
+        """
+        Records processed image files with their readings and tracker state.
+
+        Everything is committed in a single transaction (after flushing
+        buffered writes), so a batch of files is either fully recorded along
+        with the readings derived from it or not at all. Files already in
+        the manifest are replaced.
+
+        Parameters
+        ----------
+        files : iterable of 3-tuples
+            (filename, mtime, result) of each file, with the mtime in seconds
+            since the epoch and a short description of the outcome (e.g.
+            'ok' or the parse error).
+
+        zone_rows : iterable of 3-tuples
+            (starttime, endtime, zoneinfo) readings as accepted by
+            `append_zone_data`.
+
+        state : 3-tuple, optional
+            (starttime, zoneinfo, lasttime) of the open tracker interval and
+            the end of the last processed file.
+
+        panel : str
+            Id of the LED panel the files were taken from.
+        """
+        file_rows = [(filename, int(round(mtime*1000)), result)
+                     for filename, mtime, result in files]
+        zone_rows = [self._zone_row(*r, panel=panel) for r in zone_rows]
+        with self._lock:
+            self.flush()
+            with _COMMIT_SECONDS.time(), self._db:
+                cursor = self._db.cursor()
+                if zone_rows:
+                    cursor.executemany('''
+                        INSERT INTO zone_readings(starttime, endtime, status,
+                                                  panel)
+                        VALUES(?,?,?,?)''', zone_rows)
+                    self._update_rollup(cursor, zone_rows)
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO processed_files(filename, mtime,
+                                                           result)
+                    VALUES(?,?,?)''', file_rows)
+                if state is not None:
+                    starttime, zoneinfo, lasttime = state
+                    cursor.execute('''
+                        INSERT OR REPLACE INTO processed_state(
+                            panel, starttime, status, lasttime)
+                        VALUES(?,?,?,?)''',
+                        (panel, hvacmon.util.to_epoch_ms(starttime),
+                         pack_status(zoneinfo),
+                         hvacmon.util.to_epoch_ms(lasttime)))
+
+    def get_processed_files(self):
+        """
+        Gets the manifest of processed image files.
+
+        Returns
+        -------
+        dict
+            (mtime, result) of every recorded file keyed by filename, with
+            the mtime in seconds since the epoch.
+        """
+        with self._lock:
+            rows = self._db.execute('''
+                SELECT filename, mtime, result FROM processed_files''')
+            return {filename: (mtime / 1000, result)
+                    for filename, mtime, result in rows}
+
+    def get_processed_state(self, panel='', zones=4):
+        """
+        Gets the tracker state saved by `append_processed_files`.
+
+        Parameters
+        ----------
+        panel : str
+            Id of the LED panel.
+
+        zones : int
+            Number of zones of the panel.
+
+        Returns
+        -------
+        3-tuple or None
+            (starttime, zoneinfo, lasttime) with datetime.datetime times
+            (UTC), or None if no state was saved.
+        """
+        with self._lock:
+            row = self._db.execute('''
+                SELECT starttime, status, lasttime FROM processed_state
+                WHERE panel = ?''', (panel,)).fetchone()
+        if row is None:
+            return None
+        return (hvacmon.util.from_epoch_ms(row[0]),
+                unpack_status(row[1], zones),
+                hvacmon.util.from_epoch_ms(row[2]))
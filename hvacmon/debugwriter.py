@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+import os
+import queue
+import threading
+import time
+
+import hvacmon.metrics
+import hvacmon.util
+
+#
+# numpy and OpenCV are slow to import; defer them until first used
+#
+np = hvacmon.util.lazy_import('numpy')
+cv2 = hvacmon.util.lazy_import('cv2')
+
+_DROPPED = hvacmon.metrics.counter(
+    'hvacmon_debug_images_dropped_total',
+    'Debug images dropped because the writer was behind')
+_WRITE_SECONDS = hvacmon.metrics.histogram(
+    'hvacmon_debug_image_write_seconds',
+    'Time to encode and write a debug image')
+
+#
+# Debug image categories (subdirectories of the output directory)
+#
+FAILURES = 'failures'
+STATE_CHANGE = 'statechange'
+TIMEOUTS = 'timeouts'
+CATEGORIES = (FAILURES, STATE_CHANGE, TIMEOUTS)
+
+#
+# Supported formats. 'png' and 'jpg' write one file per image. 'npz' and
+# 'h5' write rolling archives laid out like the output of hvacmon-annotate.
+#
+FORMATS = ('png', 'jpg', 'npz', 'h5')
+
+#
+# Archive group of each category, matching hvacmon-annotate
+#
+ARCHIVE_GROUPS = {
+    FAILURES: 'errors',
+    STATE_CHANGE: 'annotated',
+    TIMEOUTS: 'annotated'}
+
+class DebugWriter:
+    """
+    Background writer for debug images.
+
+    Images are handed over with `submit()` and encoded and written to disk by
+    a separate thread, so the sampling loop never waits for PNG encoding. The
+    queue is bounded; when the writer falls behind, new images are dropped
+    rather than delaying sampling or growing memory.
+
+    Only the region of interest is saved. Images are written to the
+    `failures/`, `statechange/` and `timeouts/` subdirectories of the output
+    directory, either as individual images named after the interval
+    (compatible with hvacmon-postprocess) or into rolling archives with the
+    layout produced by hvacmon-annotate, in the 'errors' group for failures
+    and the 'annotated' group otherwise. HDF5 archives are
+    `hvacmon.dataset.FrameDataset` files (failures get an all-zero status);
+    npz archives hold one array per image, named after the interval, plus
+    its status.
+
+    Each subdirectory is pruned of its oldest files when it exceeds a size
+    limit, and of files older than an age limit.
+
+    Methods
+    -------
+    __init__(outdir, fmt='png', roi=None, queue_size=8, max_bytes=None,
+             max_age=None, archive_size=100, jpeg_quality=90, zones=4)
+        Creates the output directories and starts the writer thread.
+    submit(category, name, im, status=None)
+        Queues an image for writing.
+    close()
+        Writes queued images and stops the writer thread.
+    """
+
+    def __init__(self, outdir, fmt='png', roi=None, queue_size=8,
+                 max_bytes=None, max_age=None, archive_size=100,
+                 jpeg_quality=90, zones=4):
+        """
+        Creates the output directories and starts the writer thread.
+
+        Parameters
+        ----------
+        outdir : str
+            Directory containing the debug image subdirectories.
+
+        fmt : str
+            One of FORMATS.
+
+        roi : hvacmon.imgproc.Roi, optional
+            Region of submitted images to save. If None, images are saved
+            whole (e.g. when they are already cropped to the region).
+
+        queue_size : int
+            Number of images waiting to be written before new ones are
+            dropped.
+
+        max_bytes : int, optional
+            Size limit of each subdirectory.
+
+        max_age : float, optional
+            Age limit of files, in seconds.
+
+        archive_size : int
+            Number of images per archive file ('npz' and 'h5' formats).
+
+        jpeg_quality : int
+            JPEG quality (0-100) for the 'jpg' format.
+
+        zones : int
+            Number of zones of the panel (sizes the status of failures in
+            HDF5 archives).
+        """
+        if fmt not in FORMATS:
+            raise ValueError('Unsupported debug image format: %s' % fmt)
+        self._fmt = fmt
+        self._roi = roi
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._archive_size = archive_size
+        self._jpeg_quality = jpeg_quality
+        self._zones = zones
+
+        self._paths = {}
+        for category in CATEGORIES:
+            path = os.path.join(outdir, category)
+            if not os.path.exists(path):
+                print("Creating outdir: %s" % path)
+                os.makedirs(path)
+            self._paths[category] = path
+
+        # Current archive of each category as [filename, image count]
+        self._archives = {}
+        self._h5_files = {}
+        self._npz_buffers = {category: {} for category in CATEGORIES}
+
+        self.dropped = 0
+        self._last_prune = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(
+            target=self._run, name='debugwriter', daemon=True)
+        self._thread.start()
+
+    def submit(self, category, name, im, status=None):
+        """
+        Queues an image for writing.
+
+        The region of interest is copied out of `im` here, so the caller may
+        reuse the buffer.
+
+        Parameters
+        ----------
+        category : str
+            One of CATEGORIES.
+
+        name : str
+            Name of the image (without extension).
+
+        im : numpy.ndarray
+            OpenCV image array (BGR).
+
+        status : 4x2 numpy.ndarray, optional
+            Parsed status of the image, stored with archived images.
+
+        Returns
+        -------
+        boolean
+            False if the image was dropped because the queue is full.
+        """
+        if self._roi is not None:
+            im = self._roi.crop(im)
+        try:
+            self._queue.put_nowait((category, name, im.copy(), status))
+        except queue.Full:
+            self.dropped += 1
+            _DROPPED.inc()
+            print("Debug image writer is behind, dropping %s/%s"
+                % (category, name))
+            return False
+        return True
+
+    def close(self):
+        """
+        Writes queued images and stops the writer thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        for category in CATEGORIES:
+            self._flush_npz(category)
+            data = self._h5_files.pop(category, None)
+            if data is not None:
+                data[1].close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                with _WRITE_SECONDS.time():
+                    self._write(*item)
+                self._prune()
+            except Exception as e:
+                print("Unable to write debug image %s/%s: %r"
+                    % (item[0], item[1], e))
+
+    def _write(self, category, name, im, status):
+        """
+        Writes an image in the configured format.
+        """
+        path = self._paths[category]
+        if self._fmt == 'png':
+            cv2.imwrite(os.path.join(path, '%s.png' % name), im)
+        elif self._fmt == 'jpg':
+            cv2.imwrite(os.path.join(path, '%s.jpg' % name), im,
+                        [cv2.IMWRITE_JPEG_QUALITY, self._jpeg_quality])
+        elif self._fmt == 'npz':
+            self._archive_filename(category, name, 'npz')
+            buf = self._npz_buffers[category]
+            key = '%s/%s' % (ARCHIVE_GROUPS[category], name)
+            buf[key] = im
+            if status is not None:
+                buf[key + '/status'] = np.asarray(status, dtype=np.uint8)
+            if self._archives[category][1] >= self._archive_size:
+                self._flush_npz(category)
+        else:
+            self._write_h5(category, name, im, status)
+
+    def _archive_filename(self, category, name, ext):
+        """
+        Returns the archive to write an image to, starting a new one (named
+        after its first image) when the current one is full.
+        """
+        archive = self._archives.get(category)
+        if archive is None or archive[1] >= self._archive_size:
+            archive = [os.path.join(self._paths[category],
+                                    '%s.%s' % (name, ext)), 0]
+            self._archives[category] = archive
+        archive[1] += 1
+        return archive[0]
+
+    def _write_h5(self, category, name, im, status):
+        """
+        Appends an image to the current HDF5 archive of a category.
+        """
+        import hvacmon.dataset
+        filename = self._archive_filename(category, name, 'h5')
+
+        #
+        # The archive is kept open until it is full
+        #
+        current = self._h5_files.get(category)
+        if current is None or current[0] != filename:
+            if current is not None:
+                current[1].close()
+            current = (filename, hvacmon.dataset.FrameDataset(filename, 'a'))
+            self._h5_files[category] = current
+        if status is None:
+            status = np.zeros((self._zones, 2), dtype=np.uint8)
+        current[1].append(ARCHIVE_GROUPS[category], name, im, status)
+        current[1].flush()
+
+    def _flush_npz(self, category):
+        """
+        Writes the buffered images of a category to its npz archive.
+
+        npz archives cannot be appended to, so images are kept in memory
+        until the archive is full (or the writer is closed). Keys follow the
+        HDF5 layout: '<group>/<name>' for images and '<group>/<name>/status'
+        for their status.
+        """
+        buf = self._npz_buffers[category]
+        if not buf:
+            return
+        np.savez_compressed(self._archives[category][0], **buf)
+        buf.clear()
+
+    def _prune(self):
+        """
+        Enforces the size and age limits, at most once a minute.
+        """
+        if self._max_bytes is None and self._max_age is None:
+            return
+        now = time.monotonic()
+        if self._last_prune is not None and now - self._last_prune < 60:
+            return
+        self._last_prune = now
+
+        for category, path in self._paths.items():
+            current = self._archives.get(category)
+            entries = sorted(
+                (e.stat().st_mtime, e.stat().st_size, e.path)
+                for e in os.scandir(path) if e.is_file())
+
+            cutoff = None
+            if self._max_age is not None:
+                cutoff = time.time() - self._max_age
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, filename in entries:
+                if current is not None and filename == current[0]:
+                    continue
+                if ((cutoff is None or mtime >= cutoff) and
+                        (self._max_bytes is None or total <= self._max_bytes)):
+                    break
+                os.remove(filename)
+                total -= size
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+import array
+import os
+import struct
+import threading
+
+import hvacmon.db
+import hvacmon.util
+
+np = hvacmon.util.lazy_import('numpy')
+
+#
+# Journal records: kind, start and end (epoch ms) and packed status of a run
+#
+_RECORD = struct.Struct('<BqqQ')
+RECORD_CLOSED = 0
+RECORD_OPEN = 1
+
+class StateHistory:
+    """
+    Run-length encoded history of the status of a panel.
+
+    Closed runs (the intervals handed back by `hvacmon.tracker.StatusTracker`)
+    are kept in a fixed-size ring of arrays, merging consecutive runs with the
+    same status, so the recent history and the current state with its
+    duration are available without querying the database. The open run is
+    kept separately and updated on every sample at the cost of a few
+    assignments.
+
+    If a journal file is given, runs are also appended to it. Appends are
+    buffered and only written and fsync'ed by `sync()`, which callers run
+    every few seconds, so at most that much history is lost if the process
+    dies. On startup the journal is replayed: runs not yet in the database
+    are restored along with the last open run, which lets the service resume
+    the current state (see `open_run`).
+
+    Closed runs reach the database in batches through `compact()`, which
+    then rewrites the journal with only what has not been stored.
+
+    The object may be shared between threads.
+
+    Methods
+    -------
+    __init__(journal=None, zones=4, capacity=4096, max_age=24*3600)
+        Initializes the history, replaying the journal if it exists.
+    update(starttime, endtime, status)
+        Records the extent of the open run.
+    append(starttime, endtime, status)
+        Records a closed run.
+    current()
+        Gets the current status and how long it has lasted.
+    runs(since=None)
+        Gets the recent runs.
+    sync()
+        Writes and fsyncs journal appends.
+    compact(database, panel='')
+        Stores closed runs in the database and shrinks the journal.
+    close()
+        Syncs and closes the journal.
+    """
+
+    __slots__ = ('_journal', '_file', '_zones', '_capacity', '_max_age',
+                 '_starts', '_ends', '_masks', '_head', '_count', '_open',
+                 '_uncompacted', '_unsynced', '_lock')
+
+    def __init__(self, journal=None, zones=4, capacity=4096,
+                 max_age=24*3600):
+        """
+        Initializes the history, replaying the journal if it exists.
+
+        Parameters
+        ----------
+        journal : str, optional
+            Journal file.
+
+        zones : int
+            Number of zones of the panel.
+
+        capacity : int
+            Number of (merged) runs kept in memory.
+
+        max_age : float
+            Seconds of history returned by `runs()` by default.
+        """
+        self._journal = journal
+        self._zones = zones
+        self._capacity = capacity
+        self._max_age = max_age
+
+        #
+        # Ring of closed runs: start and end (epoch ms) and packed status
+        #
+        self._starts = array.array('q', bytes(8*capacity))
+        self._ends = array.array('q', bytes(8*capacity))
+        self._masks = array.array('Q', bytes(8*capacity))
+        self._head = 0
+        self._count = 0
+
+        # Open run as (start, end, mask), closed runs not in the database
+        # and records not yet written to the journal
+        self._open = None
+        self._uncompacted = []
+        self._unsynced = []
+        self._lock = threading.Lock()
+
+        self._file = None
+        if journal is not None:
+            if os.path.exists(journal):
+                self._replay()
+            self._file = open(journal, 'ab')
+
+    def _replay(self):
+        """
+        Restores the runs recorded in the journal.
+
+        A partially written last record (from a crash mid-write) is ignored.
+        """
+        with open(self._journal, 'rb') as f:
+            data = f.read()
+        end = len(data) - len(data) % _RECORD.size
+        for kind, start, stop, mask in _RECORD.iter_unpack(data[:end]):
+            if kind == RECORD_CLOSED:
+                self._add(start, stop, mask)
+                self._uncompacted.append((start, stop, mask))
+                if self._open is not None and self._open[0] < stop:
+                    self._open = None
+            else:
+                self._open = (start, stop, mask)
+
+    def _add(self, start, end, mask):
+        """
+        Adds a closed run to the ring, merging it into the last run if it
+        continues it with the same status.
+        """
+        if self._count:
+            last = (self._head - 1) % self._capacity
+            if self._masks[last] == mask and self._ends[last] == start:
+                self._ends[last] = end
+                return
+        self._starts[self._head] = start
+        self._ends[self._head] = end
+        self._masks[self._head] = mask
+        self._head = (self._head + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+    @property
+    def open_run(self):
+        """
+        Open run as (starttime, endtime, status), or None.
+
+        After a restart this is the run that was open when the journal was
+        last synced, ending at the last time its status was seen.
+        """
+        with self._lock:
+            if self._open is None:
+                return None
+            start, end, mask = self._open
+        return (hvacmon.util.from_epoch_ms(start),
+                hvacmon.util.from_epoch_ms(end),
+                hvacmon.db.unpack_status(mask, self._zones))
+
+    def update(self, starttime, endtime, status):
+        """
+        Records the extent of the open run.
+
+        Parameters
+        ----------
+        starttime : str, datetime.datetime or int
+            Start of the open run (see `hvacmon.util.to_epoch_ms`).
+
+        endtime : str, datetime.datetime or int
+            Last time the status was observed.
+
+        status : numpy.ndarray
+            Status of the run (zones x 2).
+        """
+        run = (hvacmon.util.to_epoch_ms(starttime),
+               hvacmon.util.to_epoch_ms(endtime),
+               hvacmon.db.pack_status(status))
+        with self._lock:
+            self._open = run
+
+    def append(self, starttime, endtime, status):
+        """
+        Records a closed run.
+
+        Parameters
+        ----------
+        starttime : str, datetime.datetime or int
+            Start of the run (see `hvacmon.util.to_epoch_ms`).
+
+        endtime : str, datetime.datetime or int
+            End of the run.
+
+        status : numpy.ndarray
+            Status of the run (zones x 2).
+        """
+        start = hvacmon.util.to_epoch_ms(starttime)
+        end = hvacmon.util.to_epoch_ms(endtime)
+        mask = hvacmon.db.pack_status(status)
+        with self._lock:
+            self._add(start, end, mask)
+            self._uncompacted.append((start, end, mask))
+            self._unsynced.append((RECORD_CLOSED, start, end, mask))
+            if self._open is not None and self._open[0] < end:
+                self._open = None
+
+    def current(self):
+        """
+        Gets the current status and how long it has lasted.
+
+        Closed runs continuing into the open run with the same status (e.g.
+        intervals logged on timeouts) count towards its duration.
+
+        Returns
+        -------
+        3-tuple of (status, since, until) or None
+            Status (zones x 2), time it was first seen and time it was last
+            seen, or None if nothing was recorded.
+        """
+        with self._lock:
+            if self._open is not None:
+                since, until, mask = self._open
+                first = 0
+            elif self._count:
+                last = (self._head - 1) % self._capacity
+                since, until, mask = (self._starts[last], self._ends[last],
+                                      self._masks[last])
+                first = 1
+            else:
+                return None
+            for i in range(first, self._count):
+                j = (self._head - 1 - i) % self._capacity
+                if self._masks[j] != mask or self._ends[j] != since:
+                    break
+                since = self._starts[j]
+        return (hvacmon.db.unpack_status(mask, self._zones),
+                hvacmon.util.from_epoch_ms(since),
+                hvacmon.util.from_epoch_ms(until))
+
+    def runs(self, since=None):
+        """
+        Gets the recent runs, including the open run.
+
+        Parameters
+        ----------
+        since : str, datetime.datetime or int, optional
+            Earliest time of interest. Defaults to `max_age` before the end
+            of the last run.
+
+        Returns
+        -------
+        starttimes : N numpy.ndarray of datetime64[ms]
+            Start of each run.
+
+        endtimes : N numpy.ndarray of datetime64[ms]
+            End of each run.
+
+        status : N x zones x 2 numpy.ndarray
+            Status of each run.
+        """
+        with self._lock:
+            order = [(self._head - self._count + i) % self._capacity
+                     for i in range(self._count)]
+            rows = [(self._starts[i], self._ends[i], self._masks[i])
+                    for i in order]
+            if self._open is not None:
+                rows.append(self._open)
+
+        data = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        if since is None:
+            limit = data[-1, 1] - self._max_age*1000 if len(data) else 0
+        else:
+            limit = hvacmon.util.to_epoch_ms(since)
+        data = data[data[:, 1] > limit]
+        return (data[:, 0].astype('datetime64[ms]'),
+                data[:, 1].astype('datetime64[ms]'),
+                hvacmon.db.unpack_status(data[:, 2], self._zones))
+
+    def sync(self):
+        """
+        Writes journal appends (and the current extent of the open run) and
+        fsyncs the journal.
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            records = self._unsynced
+            self._unsynced = []
+            if self._open is not None:
+                records.append((RECORD_OPEN,) + self._open)
+            if not records:
+                return
+            self._file.write(b''.join(_RECORD.pack(*r) for r in records))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def compact(self, database, panel=''):
+        """
+        Stores closed runs in the database and shrinks the journal.
+
+        Runs starting before the end of the last reading of the panel in the
+        database are assumed to be stored already (e.g. when the journal
+        could not be rewritten after they were stored) and are skipped.
+
+        Parameters
+        ----------
+        database : hvacmon.db.Database
+            Database to store runs in.
+
+        panel : str
+            Id of the panel the runs belong to.
+        """
+        with self._lock:
+            runs = self._uncompacted
+            self._uncompacted = []
+        try:
+            last = database.get_last_zone_time(panel)
+            if last is not None:
+                last = hvacmon.util.to_epoch_ms(last)
+                runs = [r for r in runs if r[0] >= last]
+            if runs:
+                database.append_zone_data_many(
+                    ((start, end, hvacmon.db.unpack_status(mask, self._zones))
+                     for start, end, mask in runs), panel)
+        except:
+            with self._lock:
+                self._uncompacted[:0] = runs
+            raise
+
+        #
+        # Rewrite the journal with what is not in the database yet, replacing
+        # it atomically
+        #
+        with self._lock:
+            if self._file is None:
+                return
+            records = [(RECORD_CLOSED,) + r for r in self._uncompacted]
+            if self._open is not None:
+                records.append((RECORD_OPEN,) + self._open)
+            tmp = self._journal + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(b''.join(_RECORD.pack(*r) for r in records))
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp, self._journal)
+            self._file = open(self._journal, 'ab')
+            self._unsynced = []
+
+    def close(self):
+        """
+        Syncs and closes the journal.
+        """
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
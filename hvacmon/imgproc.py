@@ -1,22 +1,259 @@
 #!/usr/bin/env python
-import numpy as np
-import cv2
+import collections
+import threading
 
-def find_leds(im):
+import hvacmon.util
+
+#
+# numpy and OpenCV are slow to import; defer them until first used
+#
+np = hvacmon.util.lazy_import('numpy')
+cv2 = hvacmon.util.lazy_import('cv2')
+
+class Roi(collections.namedtuple('Roi', ['top', 'bottom', 'left', 'right'])):
     """
-    Locates LEDs in a thresholded image.
+    Region of a full camera frame containing the LED panel.
 
-    Parameters
+    Bounds are in pixels of the full frame, in the same convention as NumPy
+    slicing (`top`/`left` inclusive, `bottom`/`right` exclusive).
+    """
+    __slots__ = ()
+
+    @property
+    def shape(self):
+        """
+        (rows, cols) of an image cropped to this region.
+        """
+        return (self.bottom - self.top, self.right - self.left)
+
+    def crop(self, im):
+        """
+        Returns a view of `im` restricted to this region.
+        """
+        return im[self.top:self.bottom, self.left:self.right]
+
+#
+# A fairly liberal ROI around the LED panel in a 1280x720 frame
+#
+DEFAULT_ROI = Roi(170, 330, 630, 755)
+
+#
+# Brightness ('value' channel, i.e. the max over BGR) above which an LED is
+# taken to be lit, unless thresholds adapt to each frame
+#
+THRESHOLD = 75
+
+#
+# Adaptive thresholds sit this fraction of the way from the mean brightness
+# of the region to its peak (the lit power LED), but never below the floor,
+# so frames with no light still fail to segment
+#
+ADAPTIVE_FRACTION = 0.5
+ADAPTIVE_MIN_THRESHOLD = 40
+
+#
+# Error codes reported by parse_images() (and carried by ParseError)
+#
+PARSE_OK = 0
+PARSE_NO_LEDS = 1
+PARSE_POWER_LED_COLOR = 2
+PARSE_OFFSETS_EXCEED_IMAGE = 3
+PARSE_TOLERANCE_EXCEEDED = 4
+PARSE_INVALID_FRAME = 5
+
+class ParseError(RuntimeError):
+    """
+    Raised when LEDs are unable to be parsed from an image.
+
+    Attributes
     ----------
-    im : numpy.ndarray
-        Thresholded image, where blobs correspond to LEDs.
+    code : int
+        One of the PARSE_* error codes.
+    """
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
 
-    Returns
+class LedCalibration:
+    """
+    Learned LED positions used to classify frames without blob detection.
+
+    Every time a frame is parsed with the full blob pipeline the power LED
+    position and the expected zone LED grid are stored. Zone positions are
+    refined with the actual centroid of any LED observed in its slot.
+
+    Following frames are classified by sampling small patches at the learned
+    positions. The fast path is only trusted when the power LED is clearly lit
+    and passes its color check, and every zone patch is clearly on or off;
+    otherwise the caller should fall back to the full pipeline (which
+    recalibrates).
+
+    Methods
     -------
-    2xn numpy.ndarray
-        Array of located LED centroids.
-        ([[r1,c1],[r2,c2],...])
+    __init__(threshold=75, margin=25, patch_radius=1, verify_interval=60)
+        Initializes an empty (uncalibrated) object.
+    update(power_led, zone_leds, observed, threshold=None)
+        Stores LED positions located by the full pipeline.
+    invalidate()
+        Discards the learned positions.
+    classify(im)
+        Classifies a cropped image from the learned positions.
+    """
+
+    def __init__(self, threshold=75, margin=25, patch_radius=1,
+                 verify_interval=60):
+        """
+        Initializes an empty (uncalibrated) object.
+
+        Parameters
+        ----------
+        threshold : int
+            Brightness ('value' channel) above which an LED is lit.
+
+        margin : int
+            Minimum distance of every patch mean from `threshold` for the
+            fast path to be trusted.
+
+        patch_radius : int
+            Half-size of the square patch sampled around each LED.
+
+        verify_interval : int
+            Number of consecutive fast path classifications after which the
+            fast path declines, forcing a full parse to catch slow drift.
+            Zero disables periodic verification.
+        """
+        self._threshold = threshold
+        self._margin = margin
+        self._patch_radius = patch_radius
+        self._verify_interval = verify_interval
+        self._positions = None
+        self._fast_count = 0
+
+        r = np.arange(-patch_radius, patch_radius + 1)
+        self._patch_rows = np.repeat(r, len(r))
+        self._patch_cols = np.tile(r, len(r))
+
+    @property
+    def is_calibrated(self):
+        return self._positions is not None
+
+    @property
+    def positions(self):
+        """
+        (1 + zones*2)x2 array of (row, col) LED positions: the power LED
+        followed by the zone LEDs in row-major status order. None if
+        uncalibrated.
+        """
+        return self._positions
+
+    def invalidate(self):
+        """
+        Discards the learned positions.
+        """
+        self._positions = None
+        self._fast_count = 0
+
+    def update(self, power_led, zone_leds, observed, threshold=None):
+        """
+        Stores LED positions located by the full pipeline.
+
+        Parameters
+        ----------
+        power_led : array-like
+            (row, col) centroid of the power LED.
+
+        zone_leds : Nx2x2 numpy.ndarray
+            Expected (row, col) position of each zone LED.
+
+        observed : Nx2x2 numpy.ndarray
+            Actual centroids of lit zone LEDs. Slots where no LED was
+            observed are NaN and keep their previously learned position if
+            there is one, or the expected position otherwise.
+
+        threshold : float, optional
+            Brightness threshold the full pipeline used for the frame (with
+            adaptive thresholds). Following frames are classified against it.
+        """
+        if threshold is not None:
+            self._threshold = threshold
+        positions = np.empty((1 + zone_leds.size//2, 2))
+        positions[0] = power_led
+        positions[1:] = zone_leds.reshape(-1, 2)
+
+        seen = ~np.isnan(observed.reshape(-1, 2)).any(axis=1)
+        if (self._positions is not None and
+                len(self._positions) == len(positions)):
+            #
+            # Keep refined positions relative to the (possibly moved) power
+            # LED for slots that are not lit in this frame
+            #
+            previous = (self._positions[1:] - self._positions[0] +
+                        positions[0])
+            positions[1:][~seen] = previous[~seen]
+        positions[1:][seen] = observed.reshape(-1, 2)[seen]
+
+        self._positions = positions
+        self._fast_count = 0
+
+    def classify(self, im):
+        """
+        Classifies a cropped image from the learned positions.
+
+        Parameters
+        ----------
+        im : numpy.ndarray
+            OpenCV image array (BGR) cropped to the panel region.
+
+        Returns
+        -------
+        Nx2 numpy.ndarray or None
+            Status array (as returned by `LedParser.parse`), or None if the
+            object is uncalibrated or the classification is not confident.
+        """
+        if self._positions is None:
+            return None
+        if (self._verify_interval and
+            self._fast_count >= self._verify_interval):
+            return None
+
+        centers = np.rint(self._positions).astype(np.intp)
+        rows = centers[:, 0, None] + self._patch_rows
+        cols = centers[:, 1, None] + self._patch_cols
+        if ((rows < 0).any() or (rows >= im.shape[0]).any() or
+            (cols < 0).any() or (cols >= im.shape[1]).any()):
+            return None
+
+        #
+        # Mean of the HSV 'value' channel (max over BGR) for every patch
+        #
+        patches = im[rows, cols]
+        if patches.ndim == 3:
+            patches = patches.max(axis=2)
+        means = patches.mean(axis=1)
+        if (np.abs(means - self._threshold) < self._margin).any():
+            return None
+        if means[0] < self._threshold:
+            return None
+
+        #
+        # Same color check as the full pipeline for the power LED
+        #
+        r, c = centers[0]
+        patch = _green(im)[r-2:r+3, c-2:c+3]
+        if (np.count_nonzero(patch > self._threshold) < 5):
+            return None
+
+        self._fast_count += 1
+        return (means[1:] > self._threshold).astype(np.uint8).reshape(-1, 2)
 
+def create_detector():
+    """
+    Creates the blob detector used to locate LEDs in thresholded images.
+
+    Returns
+    -------
+    cv2.SimpleBlobDetector
+        Detector configured for small, bright LED blobs.
     """
     params = cv2.SimpleBlobDetector_Params()
     params.minThreshold = 0
@@ -30,13 +267,38 @@ def find_leds(im):
     params.filterByInertia = False
     params.filterByColor = False
 
-    detector = cv2.SimpleBlobDetector_create(params)
-    keypoints = detector.detect((im.astype(np.uint8)))
+    return cv2.SimpleBlobDetector_create(params)
+
+def find_leds(im, detector=None):
+    """
+    Locates LEDs in a thresholded image.
+
+    Parameters
+    ----------
+    im : numpy.ndarray
+        Thresholded image, where blobs correspond to LEDs.
+
+    detector : cv2.SimpleBlobDetector, optional
+        Detector returned by `create_detector()`. A new one is created if not
+        specified.
+
+    Returns
+    -------
+    2xn numpy.ndarray
+        Array of located LED centroids.
+        ([[r1,c1],[r2,c2],...])
+
+    """
+    if detector is None:
+        detector = create_detector()
+    if im.dtype != np.uint8:
+        im = im.astype(np.uint8)
+    keypoints = detector.detect(im)
 
     pts = np.asarray([[p.pt[1], p.pt[0]] for p in keypoints])
     return pts
 
-def parse_image_hardcoded_positions(im):
+def parse_image_hardcoded_positions(im, roi=DEFAULT_ROI):
     """
     Parses image based on hardcoded position information.
 
@@ -49,6 +311,10 @@ def parse_image_hardcoded_positions(im):
     im : numpy.ndarray
         OpenCV image array captured from the camera module.
 
+    roi : Roi, optional
+        Region of `im` containing the LED panel. If None, `im` has already
+        been cropped to the region (e.g. captured in ROI mode).
+
     Returns
     -------
     4x2 numpy.ndarray
@@ -62,9 +328,11 @@ def parse_image_hardcoded_positions(im):
         If LEDs are unable to be parsed from the source image.
     """
     #
-    # Crop a fixed ROI and convert to grayscale
+    # Crop a fixed ROI (relative to the panel region) and convert to grayscale
     #
-    im_roi = im[246:296,675:705]
+    if roi is not None:
+        im = roi.crop(im)
+    im_roi = im[76:126,45:75]
     im_roi_gray = cv2.cvtColor(im_roi, cv2.COLOR_BGR2GRAY)
 
     #
@@ -128,15 +396,480 @@ def parse_image_hardcoded_positions(im):
         raise RuntimeError('Unable to parse power/status LED!')
     return status
 
-def parse_image(im):
+class LedParser:
+    """
+    Stateful parser for the HVAC status LEDs.
+
+    Holds the blob detector and scratch buffers so that parsing a stream of
+    frames does not rebuild the detector or allocate full-size temporaries for
+    every frame. Buffers are (re)allocated only when the cropped image size
+    changes.
+
+    Panels have a column of zones below the power LED, each with a call and
+    a valve LED. The number of zones defaults to 4.
+
+    LEDs are segmented with a fixed brightness threshold by default. With
+    adaptive thresholds, the threshold of each frame is placed between the
+    mean and peak brightness of its region instead (see
+    `frame_brightness`), which follows changes in ambient light and
+    exposure. The threshold used for the last frame is kept in
+    `last_threshold`.
+
+    Single channel (luma) images are accepted as well as BGR images. Their
+    brightness is used directly, and the color check of the power LED becomes
+    a brightness check (green dominates luma).
+
+    A parser is not thread-safe; use one per thread.
+
+    Methods
+    -------
+    __init__(roi=DEFAULT_ROI, calibration=None, zones=4, threshold=THRESHOLD)
+        Initializes the parser.
+    parse(im)
+        Parses HVAC status LEDs from an image.
+    parse_batch(stack)
+        Parses HVAC status LEDs from a stack of images.
+    """
+
+    def __init__(self, roi=DEFAULT_ROI, calibration=None, zones=4,
+                 threshold=THRESHOLD):
+        """
+        Initializes the parser.
+
+        Parameters
+        ----------
+        roi : Roi, optional
+            Region of images containing the LED panel. If None, images passed
+            to `parse()` have already been cropped to the region.
+
+        calibration : LedCalibration, optional
+            Learned LED positions used to skip blob detection on steady
+            frames (see `parse_image`).
+
+        zones : int
+            Number of zones of the panel.
+
+        threshold : int or None
+            Brightness above which an LED is lit, or None to adapt the
+            threshold to every frame.
+        """
+        self.roi = roi
+        self.calibration = calibration
+        self.zones = zones
+        self.threshold = threshold
+        self.last_threshold = threshold
+        self._detector = create_detector()
+        self._hsv = None
+        self._value = None
+        self._mask = None
+
+    def parse(self, im):
+        """
+        Parses HVAC status LEDs from an image.
+
+        Parameters
+        ----------
+        im : numpy.ndarray
+            OpenCV image array (BGR or luma) returned from Camera.get_frame()
+
+        Returns
+        -------
+        zonesx2 numpy.ndarray
+            Array of status indicators where each row is a zone.
+            The first column indicates whether the thermostat is calling.
+            The second column indicates whether the zone valve is open.
+
+        Raises
+        ------
+        RuntimeError
+            If LEDs are unable to be parsed from the source image.
+            ParseError (PARSE_INVALID_FRAME) if the image does not contain the
+            region of interest.
+        """
+        return self._parse(im, self.roi, self.calibration)
+
+    def parse_batch(self, stack):
+        """
+        Parses HVAC status LEDs from a stack of images.
+
+        The regions of interest of the whole stack are thresholded in a
+        single pass; blob detection then runs per frame. Errors are reported
+        per frame instead of raised, so one bad frame does not stop the rest.
+        The calibration (if any) is not used.
+
+        Parameters
+        ----------
+        stack : NxHxWx3 numpy.ndarray
+            OpenCV image arrays (BGR) as returned from Camera.get_frame().
+
+        Returns
+        -------
+        status : N x zones x 2 numpy.ndarray
+            Status arrays (see `parse()`). All zero for frames with errors.
+
+        errors : N numpy.ndarray
+            PARSE_* error code for each frame (PARSE_OK if parsed).
+        """
+        if stack.ndim != 4 or stack.shape[3] != 3:
+            raise ValueError('Expected an NxHxWx3 stack of images.')
+        if self.roi is not None:
+            stack = stack[:, self.roi.top:self.roi.bottom,
+                          self.roi.left:self.roi.right]
+
+        status = np.zeros((len(stack), self.zones, 2), dtype=np.uint8)
+        errors = np.zeros(len(stack), dtype=np.uint8)
+        if len(stack) == 0:
+            return status, errors
+
+        #
+        # Threshold on the 'value' channel of HSV (the max over BGR) for the
+        # whole batch, building the 0/255 masks in place
+        #
+        values = stack.max(axis=3)
+        if self.threshold is None:
+            thresholds = _adaptive_threshold(
+                values.mean(axis=(1,2)), values.max(axis=(1,2)))
+        else:
+            thresholds = np.full(len(stack), self.threshold)
+        masks = np.greater(values, thresholds[:,None,None]).view(np.uint8)
+        masks *= 255
+
+        for i in range(len(stack)):
+            try:
+                status[i] = self._parse_mask(stack[i], masks[i],
+                                             threshold=thresholds[i])
+            except ParseError as e:
+                errors[i] = e.code
+        return status, errors
+
+    def _parse(self, im, roi, calibration):
+        #
+        # Crop to the panel region (e.g. images already cropped to it do not
+        # contain it)
+        #
+        if roi is not None:
+            if im.shape[0] < roi.bottom or im.shape[1] < roi.right:
+                raise ParseError(
+                    PARSE_INVALID_FRAME,
+                    'Frame (%dx%d) does not contain the region of interest.'
+                    % im.shape[1::-1])
+            im = roi.crop(im)
+
+        if calibration is not None:
+            status = calibration.classify(im)
+            if status is not None:
+                return status
+            try:
+                return self._parse_blobs(im, calibration)
+            except RuntimeError:
+                calibration.invalidate()
+                raise
+        return self._parse_blobs(im)
+
+    def _threshold(self, im):
+        """
+        Thresholds the 'value' channel of a cropped image into the mask buffer.
+        """
+        if self._mask is None or self._mask.shape != im.shape[:2]:
+            self._mask = np.empty(im.shape[:2], dtype=np.uint8)
+
+        if im.ndim == 2:
+            value = im
+        else:
+            if self._hsv is None or self._hsv.shape != im.shape:
+                self._hsv = np.empty(im.shape, dtype=np.uint8)
+                self._value = np.empty(im.shape[:2], dtype=np.uint8)
+
+            #
+            # Convert to HSV space for filtering
+            #
+            cv2.cvtColor(im, cv2.COLOR_BGR2HSV, dst=self._hsv)
+
+            #
+            # Threshold on the 'value' channel of HSV because it seems to give
+            # a more even response
+            # TODO: This should probably be a grayscale image. Need to learn
+            # about gamma and adjusting for intensities.
+            #
+            cv2.extractChannel(self._hsv, 2, dst=self._value)
+            value = self._value
+        threshold = self.threshold
+        if threshold is None:
+            threshold = _adaptive_threshold(
+                cv2.mean(value)[0], cv2.minMaxLoc(value)[1])
+        self.last_threshold = threshold
+        cv2.threshold(value, threshold, 255, cv2.THRESH_BINARY,
+                      dst=self._mask)
+        return self._mask
+
+    def _parse_blobs(self, im, calibration=None):
+        """
+        Parses HVAC status LEDs from a cropped image with blob detection.
+
+        If `calibration` is given it is updated with the located LED
+        positions.
+        """
+        mask = self._threshold(im)
+        return self._parse_mask(im, mask, calibration, self.last_threshold)
+
+    def _parse_mask(self, im, mask, calibration=None, threshold=THRESHOLD):
+        """
+        Parses HVAC status LEDs from a cropped image and its threshold mask.
+        """
+        leds = find_leds(mask, self._detector)
+
+        if (len(leds) < 1):
+            raise ParseError(PARSE_NO_LEDS, 'No LEDs segmented')
+
+        #
+        # Find and strip out the green power LED (assume it's the lowest row
+        # count)
+        #
+        power_led_idx = np.argmin(leds[:,0])
+        power_led = leds[power_led_idx, :]
+        leds = np.delete(leds, power_led_idx, axis=0)
+
+        #
+        # Sanity test - see if a 3x3 patch of pixels around the 'power led'
+        # does in fact fall within the green color space. Using the 'green'
+        # channel only because when there are no other LEDs on, the imager
+        # tends to saturate all LEDs. This case should not fail.
+        #
+        patch = _green(im)[
+            int(power_led[0])-2:int(power_led[0])+3,
+            int(power_led[1])-2:int(power_led[1])+3]
+        if (np.count_nonzero(patch > threshold) < 5):
+            raise ParseError(
+                PARSE_POWER_LED_COLOR, 'Power LED failed color check.')
+
+        #
+        # Synthesize the ideal LED offsets from the power LED
+        # Spacing is hardcoded and depends on resolution and distance.
+        #
+        led_spacing = (7,7)
+        zone_rows_approx = np.linspace(
+            power_led[0] + led_spacing[0],
+            power_led[0] + led_spacing[0]*self.zones,
+            self.zones)
+
+        zone_cols_approx = np.linspace(
+            power_led[1],
+            power_led[1] + led_spacing[1],
+            2)
+
+        #
+        # Validate that the original ROI is big enough
+        # and that we're not potentially dropping LEDs
+        #
+        if ((zone_rows_approx > im.shape[0]).any() or
+            (zone_cols_approx > im.shape[1]).any()):
+            raise ParseError(
+                PARSE_OFFSETS_EXCEED_IMAGE,
+                'Expected LED offsets exceed image limits.')
+
+        status = np.zeros((self.zones, 2), dtype=np.uint8)
+        observed = np.full((self.zones, 2, 2), np.nan)
+
+        #
+        # For each 'found' LED figure out which approximated LED it's
+        # 'closest' to and mark the value in the status array
+        #
+        for led in leds:
+            row = (np.abs(led[0] - zone_rows_approx)).argmin()
+            col = (np.abs(led[1] - zone_cols_approx)).argmin()
+
+            #
+            # Ensure the closest match we found is within half of the
+            # expected LED spacing. If not, we can't really guarantee the
+            # match is valid.
+            #
+            if ((np.abs(led[0] - zone_rows_approx[row]) >
+                 (led_spacing[0]/2)) or
+                (np.abs(led[1] - zone_cols_approx[col]) >
+                 (led_spacing[1]/2))):
+                raise ParseError(
+                    PARSE_TOLERANCE_EXCEEDED,
+                    'Closest match for LED exceeds tolerance.')
+            status[row, col] = 1
+            observed[row, col] = led
+
+        if calibration is not None:
+            zone_leds = np.stack(
+                np.meshgrid(zone_rows_approx, zone_cols_approx,
+                            indexing='ij'),
+                axis=-1)
+            calibration.update(
+                power_led, zone_leds, observed,
+                None if self.threshold is not None else threshold)
+
+        return status
+
+def _adaptive_threshold(mean, peak):
+    """
+    Brightness threshold for a frame (or array of frames) from the mean and
+    peak brightness of its region.
+    """
+    return np.maximum(mean + ADAPTIVE_FRACTION*(peak - mean),
+                      ADAPTIVE_MIN_THRESHOLD)
+
+def _green(im):
+    """
+    Green channel of a BGR image (a luma image is returned as is).
+    """
+    return im[..., 1] if im.ndim == 3 else im
+
+def _value(im):
+    """
+    HSV 'value' channel (max over BGR) of an image (a luma image is returned
+    as is).
+    """
+    if im.ndim == 2:
+        return im
+    b, g, r = cv2.split(im)
+    return cv2.max(cv2.max(b, g), r)
+
+def frame_brightness(im, roi=None):
+    """
+    Measures the brightness of the LED panel region of an image.
+
+    Parameters
+    ----------
+    im : numpy.ndarray
+        OpenCV image array (BGR or luma).
+
+    roi : Roi, optional
+        Region of `im` containing the LED panel. If None, `im` has already
+        been cropped to the region.
+
+    Returns
+    -------
+    mean : float
+        Mean brightness ('value' channel, 0-255) of the region.
+
+    peak : float
+        Brightness of the brightest pixel, normally the lit power LED.
+    """
+    if roi is not None:
+        im = roi.crop(im)
+    value = _value(im)
+    return cv2.mean(value)[0], cv2.minMaxLoc(value)[1]
+
+class ChangeDetector:
+    """
+    Cheap test for whether the LED panel changed since a reference frame.
+
+    The region of interest (optionally downscaled) is compared to the
+    reference by absolute difference, taking the largest difference over the
+    color channels so a colored LED is not diluted as it would be in gray. This costs
+    a small fraction of a full parse, so at high frame rates most frames can
+    be skipped and only frames that differ are parsed.
+
+    Methods
+    -------
+    __init__(roi=DEFAULT_ROI, threshold=40, min_pixels=2, scale=1)
+        Initializes the detector.
+    reset(im)
+        Makes `im` the reference frame.
+    invalidate()
+        Discards the reference frame.
+    changed(im)
+        Tests whether `im` differs from the reference frame.
+    """
+
+    def __init__(self, roi=DEFAULT_ROI, threshold=40, min_pixels=2, scale=1):
+        """
+        Initializes the detector.
+
+        Parameters
+        ----------
+        roi : Roi, optional
+            Region of images containing the LED panel. If None, images have
+            already been cropped to the region.
+
+        threshold : int
+            Difference in any channel for a pixel to count as changed.
+
+        min_pixels : int
+            Number of changed (downscaled) pixels for the frame to count as
+            changed. An LED turning on or off changes a patch of several
+            pixels while sensor noise changes isolated ones.
+
+        scale : int
+            Downscaling factor applied to the region before comparing.
+        """
+        self.roi = roi
+        self._threshold = threshold
+        self._min_pixels = min_pixels
+        self._scale = scale
+        self._reference = None
+
+    def _reduce(self, im):
+        """
+        Crops and downscales an image.
+        """
+        if self.roi is not None:
+            im = self.roi.crop(im)
+        if self._scale == 1:
+            return im.copy()
+        return cv2.resize(im, None, fx=1/self._scale, fy=1/self._scale,
+                          interpolation=cv2.INTER_AREA)
+
+    def reset(self, im):
+        """
+        Makes `im` the reference frame.
+        """
+        self._reference = self._reduce(im)
+
+    def invalidate(self):
+        """
+        Discards the reference frame, so the next frame counts as changed.
+        """
+        self._reference = None
+
+    def changed(self, im):
+        """
+        Tests whether `im` differs from the reference frame.
+
+        Returns
+        -------
+        boolean
+            True if the frame changed (or there is no reference frame yet).
+        """
+        if self._reference is None:
+            return True
+        reduced = self._reduce(im)
+        if reduced.shape != self._reference.shape:
+            return True
+        diff = _value(cv2.absdiff(reduced, self._reference))
+        return cv2.countNonZero(
+            cv2.threshold(diff, self._threshold, 255,
+                          cv2.THRESH_BINARY)[1]) >= self._min_pixels
+
+#
+# Parsers backing parse_image(), one per thread
+#
+_parsers = threading.local()
+
+def parse_image(im, roi=DEFAULT_ROI, calibration=None):
     """
     Parses HVAC status LEDs from an image.
 
+    Thin wrapper over a per-thread `LedParser`.
+
     Parameters
     ----------
     im : numpy.ndarray
         OpenCV image array (BGR) returned from Camera.get_frame()
 
+    roi : Roi, optional
+        Region of `im` containing the LED panel. If None, `im` has already
+        been cropped to the region (e.g. captured in ROI mode).
+
+    calibration : LedCalibration, optional
+        Learned LED positions. If given and calibrated, the image is first
+        classified from the learned positions and the blob pipeline only runs
+        if that is not confident. Successful full parses update it.
+
     Returns
     -------
     4x2 numpy.ndarray
@@ -148,90 +881,75 @@ def parse_image(im):
     ------
     RuntimeError
         If LEDs are unable to be parsed from the source image.
+        ParseError (PARSE_INVALID_FRAME) if the image does not contain the
+        region of interest.
     """
-    #
-    # Crop a fairly liberal ROI
-    # TODO: Can this be eliminated?
-    #
-    im = im[170:330,630:755]
-
-    #
-    # Convert to HSV space for filtering
-    #
-    im_hsv = cv2.cvtColor(im, cv2.COLOR_BGR2HSV)
-
-    #
-    # Threshold on the 'value' channel of HSV because it seems to give a more
-    # even response
-    # TODO: This should probably be a grayscale image. Need to learn about
-    # gamma and adjusting for intensities.
-    #
-    mask = (im_hsv[:,:,2] > 75).astype(np.uint8)*255
-    leds = find_leds(mask)
-
-    if (len(leds) < 1):
-        raise RuntimeError('No LEDs segmented')
-
-    #
-    # Find and strip out the green power LED (assume it's the lowest row count)
-    #
-    power_led_idx = np.argmin(leds[:,0])
-    power_led = leds[power_led_idx, :]
-    leds = np.delete(leds, power_led_idx, axis=0)
-
-    #
-    # Sanity test - see if a 3x3 patch of pixels around the 'power led'
-    # does in fact fall within the green color space. Using the 'green' channel
-    # only because when there are no other LEDs on, the imager tends to
-    # saturate all LEDs. This case should not fail.
-    #
-    mask_green = (im[:,:,1] > 75)
-    patch = mask_green[
-        int(power_led[0])-2:int(power_led[0])+3,
-        int(power_led[1])-2:int(power_led[1])+3]
-    if (len(patch[patch > 0].flatten()) < 5):
-        raise RuntimeError('Power LED failed color check.')
+    parser = getattr(_parsers, 'parser', None)
+    if parser is None:
+        parser = _parsers.parser = LedParser()
+    return parser._parse(im, roi, calibration)
 
-    #
-    # Synthesize the ideal LED offsets from the power LED
-    # Spacing is hardcoded and depends on resolution and distance.
-    #
-    led_spacing = (7,7)
-    zone_rows_approx = np.linspace(
-        power_led[0] + led_spacing[0],
-        power_led[0] + led_spacing[0]*4,
-        4)
+def parse_images(frames, roi=DEFAULT_ROI, batch_size=64, zones=4):
+    """
+    Parses HVAC status LEDs from a batch of images.
 
-    zone_cols_approx = np.linspace(
-        power_led[1],
-        power_led[1] + led_spacing[1],
-        2)
+    Parameters
+    ----------
+    frames : NxHxWx3 numpy.ndarray or iterable of numpy.ndarray
+        OpenCV image arrays (BGR). Iterables are consumed in batches of
+        `batch_size`; entries that are None (e.g. failed reads) or whose
+        shape differs from the first frame are reported as invalid.
 
-    #
-    # Validate that the original ROI is big enough
-    # and that we're not potentially dropping LEDs
-    #
-    if ((zone_rows_approx > im.shape[0]).any() or
-        (zone_cols_approx > im.shape[1]).any()):
-        raise RuntimeError('Expected LED offsets exceed image limits.')
+    roi : Roi, optional
+        Region of the images containing the LED panel. If None, the images
+        have already been cropped to the region.
 
-    status = np.zeros((4,2), dtype=np.uint8)
+    batch_size : int
+        Number of frames thresholded together when consuming an iterable.
 
-    #
-    # For each 'found' LED figure out which approximated LED it's
-    # 'closest' to and mark the value in the status array
-    #
-    for led in leds:
-        row = (np.abs(led[0] - zone_rows_approx)).argmin()
-        col = (np.abs(led[1] - zone_cols_approx)).argmin()
+    zones : int
+        Number of zones of the panel.
 
-        #
-        # Ensure the closest match we found is within half of the expected
-        # LED spacing. If not, we can't really guarantee the match is valid.
-        #
-        if ((np.abs(led[0] - zone_rows_approx[row]) > (led_spacing[0]/2)) or
-            (np.abs(led[1] - zone_cols_approx[col]) > (led_spacing[1]/2))):
-            raise RuntimeError('Closest match for LED exceeds tolerance.')
-        status[row, col] = 1
+    Returns
+    -------
+    status : N x zones x 2 numpy.ndarray
+        Status arrays (see `parse_image`). All zero for frames with errors.
 
-    return status
+    errors : N numpy.ndarray
+        PARSE_* error code for each frame (PARSE_OK if parsed).
+    """
+    parser = LedParser(roi, zones=zones)
+    if isinstance(frames, np.ndarray):
+        return parser.parse_batch(frames)
+
+    status = [np.zeros((0, zones, 2), dtype=np.uint8)]
+    errors = [np.zeros(0, dtype=np.uint8)]
+    shape = None
+    batch = []
+    for im in frames:
+        if shape is None and im is not None:
+            shape = im.shape
+        batch.append(im)
+        if len(batch) == batch_size:
+            _parse_chunk(parser, batch, shape, status, errors)
+            batch = []
+    if batch:
+        _parse_chunk(parser, batch, shape, status, errors)
+
+    return np.concatenate(status), np.concatenate(errors)
+
+def _parse_chunk(parser, batch, shape, status, errors):
+    """
+    Parses a list of frames with `parser`, appending results to the lists
+    `status` and `errors`. Frames that are None or not of `shape` are
+    reported as invalid.
+    """
+    valid = np.array([im is not None and im.shape == shape and im.ndim == 3
+                      for im in batch])
+    chunk_status = np.zeros((len(batch), parser.zones, 2), dtype=np.uint8)
+    chunk_errors = np.full(len(batch), PARSE_INVALID_FRAME, dtype=np.uint8)
+    if valid.any():
+        stack = np.stack([im for im, v in zip(batch, valid) if v])
+        chunk_status[valid], chunk_errors[valid] = parser.parse_batch(stack)
+    status.append(chunk_status)
+    errors.append(chunk_errors)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+import bisect
+import collections
+import json
+import math
+import os
+import threading
+import time
+
+#
+# Default histogram buckets (seconds), from sub-millisecond parses up to
+# multi-second camera configuration and network requests
+#
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(labels):
+    """
+    Formats a label dict in Prometheus text format.
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                 .replace('\n', '\\n'))
+        for k, v in sorted(labels.items()))
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+class Histogram:
+    """
+    Histogram of observed values (typically durations in seconds).
+
+    Keeps cumulative bucket counts for export in Prometheus format, plus a
+    rolling window of the most recent observations from which quantiles are
+    computed for the stats file. Observing is a bisect and a few additions
+    under a lock.
+
+    Methods
+    -------
+    observe(value)
+        Records a value.
+    time()
+        Context manager recording the duration of its block.
+    quantiles(qs=(0.5, 0.9, 0.99))
+        Quantiles of the recent observations.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, labels=None,
+                 window=1000):
+        """
+        Initializes the histogram.
+
+        Parameters
+        ----------
+        name : str
+            Metric name.
+
+        help : str
+            Description of the metric.
+
+        buckets : sequence of float
+            Upper bounds of the buckets (an infinite bucket is added).
+
+        labels : dict, optional
+            Constant labels distinguishing this histogram from others of the
+            same name.
+
+        window : int
+            Number of recent observations kept for quantiles.
+        """
+        self.name = name
+        self.help = help
+        self.labels = dict(labels or {})
+        self._bounds = tuple(sorted(buckets)) + (math.inf,)
+        self._counts = [0]*len(self._bounds)
+        self._sum = 0.0
+        self._count = 0
+        self._recent = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Records a value.
+        """
+        i = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+            self._count += 1
+            self._recent.append(value)
+
+    def time(self):
+        """
+        Context manager recording the duration of its block (seconds).
+        """
+        return _Timer(self)
+
+    def quantiles(self, qs=(0.5, 0.9, 0.99)):
+        """
+        Quantiles of the recent observations (None if there are none).
+        """
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return [None]*len(qs)
+        return [recent[min(len(recent) - 1, int(q*len(recent)))] for q in qs]
+
+    def samples(self):
+        """
+        Prometheus samples as (suffix, labels, value) tuples.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self._bounds, counts):
+            cumulative += n
+            labels = dict(self.labels, le=_format_value(bound))
+            samples.append(('_bucket', labels, cumulative))
+        samples.append(('_sum', self.labels, total))
+        samples.append(('_count', self.labels, count))
+        return samples
+
+    def snapshot(self):
+        """
+        Summary of the histogram for the stats file.
+        """
+        p50, p90, p99 = self.quantiles()
+        with self._lock:
+            total, count = self._sum, self._count
+        return {'count': count, 'sum': total,
+                'p50': p50, 'p90': p90, 'p99': p99}
+
+class _Timer:
+    """
+    Context manager timing a block into a histogram.
+    """
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.monotonic() - self._start)
+
+class Counter:
+    """
+    Monotonic counter, optionally broken down by the value of one label.
+
+    By Prometheus convention counter names end in '_total'.
+
+    Methods
+    -------
+    inc(value=None, amount=1)
+        Increments the count (for a label value).
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None, labels=None):
+        """
+        Initializes the counter.
+
+        Parameters
+        ----------
+        name : str
+            Metric name.
+
+        help : str
+            Description of the metric.
+
+        label : str, optional
+            Name of the label whose value is passed to `inc()`.
+
+        labels : dict, optional
+            Constant labels distinguishing this counter from others of the
+            same name.
+        """
+        self.name = name
+        self.help = help
+        self.label = label
+        self.labels = dict(labels or {})
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=None, amount=1):
+        """
+        Increments the count (for a label value).
+        """
+        with self._lock:
+            self._counts[value] = self._counts.get(value, 0) + amount
+
+    def samples(self):
+        """
+        Prometheus samples as (suffix, labels, value) tuples.
+        """
+        with self._lock:
+            counts = dict(self._counts)
+        if not counts and self.label is None:
+            counts[None] = 0
+        samples = []
+        for value, n in sorted(counts.items(), key=lambda kv: str(kv[0])):
+            labels = self.labels
+            if self.label is not None:
+                labels = dict(labels, **{self.label: value})
+            samples.append(('', labels, n))
+        return samples
+
+    def snapshot(self):
+        """
+        Counts for the stats file.
+        """
+        with self._lock:
+            if self.label is None:
+                return self._counts.get(None, 0)
+            return {str(k): v for k, v in self._counts.items()}
+
+class Registry:
+    """
+    Collection of metrics, exported together.
+
+    Metrics are created through the registry; asking for a metric that
+    already exists (same name and constant labels) returns it, so modules can
+    declare their metrics at import or construction time.
+
+    Methods
+    -------
+    histogram(name, help, buckets=DEFAULT_BUCKETS, labels=None)
+        Gets or creates a histogram.
+    counter(name, help, label=None, labels=None)
+        Gets or creates a counter.
+    render()
+        Renders all metrics in Prometheus text format.
+    snapshot()
+        Summarizes all metrics as a dict.
+    write(filename)
+        Writes the snapshot to a JSON file.
+    """
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, labels, *args, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = cls(name, *args, labels=labels, **kwargs)
+                self._metrics[key] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric %s already exists as a %s'
+                    % (name, metric.kind))
+        return metric
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, labels=None):
+        """
+        Gets or creates a histogram (see `Histogram`).
+        """
+        return self._get(Histogram, name, labels, help, buckets)
+
+    def counter(self, name, help, label=None, labels=None):
+        """
+        Gets or creates a counter (see `Counter`).
+        """
+        return self._get(Counter, name, labels, help, label)
+
+    def render(self):
+        """
+        Renders all metrics in Prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        described = set()
+        for metric in sorted(metrics, key=lambda m: m.name):
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append('# HELP %s %s' % (metric.name, metric.help))
+                lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append('%s%s%s %s' % (metric.name, suffix,
+                                            _format_labels(labels),
+                                            _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Summarizes all metrics as a dict keyed by name (and constant labels).
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name + _format_labels(metric.labels): metric.snapshot()
+                for metric in metrics}
+
+    def write(self, filename):
+        """
+        Writes the snapshot to a JSON file (atomically replacing it).
+        """
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'time': time.time(), 'metrics': self.snapshot()}, f,
+                      indent=1, sort_keys=True)
+        os.replace(tmp, filename)
+
+#
+# Registry shared by all hvacmon modules
+#
+REGISTRY = Registry()
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS, labels=None):
+    """
+    Gets or creates a histogram in the default registry.
+    """
+    return REGISTRY.histogram(name, help, buckets, labels)
+
+def counter(name, help, label=None, labels=None):
+    """
+    Gets or creates a counter in the default registry.
+    """
+    return REGISTRY.counter(name, help, label, labels)
+
+class MetricsServer:
+    """
+    HTTP server exposing a registry in Prometheus text format at /metrics.
+
+    Runs on a daemon thread. Binds to localhost by default.
+
+    Methods
+    -------
+    __init__(port, host='127.0.0.1', registry=REGISTRY)
+        Starts serving.
+    close()
+        Stops serving.
+    """
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        """
+        Starts serving.
+
+        Parameters
+        ----------
+        port : int
+            Port to listen on (0 picks a free port, see `port`).
+
+        host : str
+            Address to bind to.
+
+        registry : Registry
+            Metrics to expose.
+        """
+        import http.server
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """
+        Stops serving.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
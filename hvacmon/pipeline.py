@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+import queue
+import threading
+import time
+
+import hvacmon.metrics
+
+def call_with_timeout(func, timeout, *args):
+    """
+    Calls a function, giving up on it after a timeout.
+
+    The function runs on a daemon thread which is abandoned (not killed) on
+    timeout, so this is only suitable for calls without side effects on
+    shared state, such as blocking network requests.
+
+    Parameters
+    ----------
+    func : callable
+        Function to call.
+
+    timeout : float
+        Seconds to wait for the call to complete.
+
+    Returns
+    -------
+    object
+        Return value of `func(*args)`.
+
+    Raises
+    ------
+    TimeoutError
+        If the call did not complete in time.
+    """
+    result = {}
+
+    def target():
+        try:
+            result['value'] = func(*args)
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError('%s did not complete within %.1f s'
+            % (getattr(func, '__name__', func), timeout))
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+class Ticker(threading.Thread):
+    """
+    Thread calling a function on a fixed cadence.
+
+    Calls are scheduled against absolute deadlines on the monotonic clock, so
+    the cadence does not drift with the duration of each call. If a call
+    overruns the period, the missed ticks are skipped (and counted) rather
+    than run back to back.
+    """
+
+    def __init__(self, name, period, func, stop):
+        """
+        Initializes the thread.
+
+        Parameters
+        ----------
+        name : str
+            Name of the thread (used in log messages).
+
+        period : float
+            Seconds between calls. The first call is made immediately.
+
+        func : callable
+            Function to call (without arguments).
+
+        stop : threading.Event
+            Event which stops the thread when set.
+        """
+        super().__init__(name=name, daemon=True)
+        self._period = period
+        self._func = func
+        self._stop_event = stop
+        self.missed = 0
+        self._lateness = hvacmon.metrics.histogram(
+            'hvacmon_tick_lateness_seconds',
+            'Delay of ticks past their deadline (sampling jitter)',
+            labels={'ticker': name})
+        self._missed = hvacmon.metrics.counter(
+            'hvacmon_ticks_missed_total', 'Ticks skipped after an overrun',
+            labels={'ticker': name})
+
+    def run(self):
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            self._lateness.observe(max(time.monotonic() - deadline, 0))
+            try:
+                self._func()
+            except Exception as e:
+                print("%s: unhandled error: %r" % (self.name, e))
+
+            deadline += self._period
+            now = time.monotonic()
+            if now > deadline:
+                missed = int((now - deadline) // self._period) + 1
+                print("%s: overran its period, skipping %d tick(s)"
+                    % (self.name, missed))
+                self.missed += missed
+                self._missed.inc(amount=missed)
+                deadline += missed*self._period
+            self._stop_event.wait(deadline - now)
+
+class Stage(threading.Thread):
+    """
+    Thread processing items from a bounded queue.
+
+    Each item taken from `inbox` is passed to the stage function. If the
+    stage has an `outbox`, non-None results are put there, blocking while it
+    is full so backpressure propagates upstream. Items taking longer than
+    `warn_after` to process are reported once they are done. They are not
+    interrupted, so calls which may hang need limits of their own (e.g.
+    `call_with_timeout`).
+
+    When stopped, the stage drains the items already in its inbox before
+    exiting.
+    """
+
+    def __init__(self, name, func, inbox, stop, outbox=None, warn_after=None):
+        """
+        Initializes the thread.
+
+        Parameters
+        ----------
+        name : str
+            Name of the thread (used in log messages).
+
+        func : callable
+            Function called with each item.
+
+        inbox : queue.Queue
+            Queue of items to process.
+
+        stop : threading.Event
+            Event which stops the thread (once the inbox is drained) when set.
+
+        outbox : queue.Queue, optional
+            Queue receiving non-None results.
+
+        warn_after : float, optional
+            Seconds after which processing an item is reported as slow.
+        """
+        super().__init__(name=name, daemon=True)
+        self._func = func
+        self._inbox = inbox
+        self._outbox = outbox
+        self._stop_event = stop
+        self._warn_after = warn_after
+        self._seconds = hvacmon.metrics.histogram(
+            'hvacmon_stage_seconds', 'Time to process an item in a stage',
+            labels={'stage': name})
+        self._depth = hvacmon.metrics.histogram(
+            'hvacmon_stage_queue_depth', 'Items waiting when a stage wakes',
+            buckets=(0, 1, 2, 4, 8, 16, 32, 64), labels={'stage': name})
+
+    def run(self):
+        while not (self._stop_event.is_set() and self._inbox.empty()):
+            try:
+                item = self._inbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            self._depth.observe(self._inbox.qsize())
+            start = time.monotonic()
+            try:
+                result = self._func(item)
+            except Exception as e:
+                print("%s: unhandled error: %r" % (self.name, e))
+                result = None
+            elapsed = time.monotonic() - start
+            self._seconds.observe(elapsed)
+            if self._warn_after is not None and elapsed > self._warn_after:
+                print("%s: took %.2f s (budget %.2f s)"
+                    % (self.name, elapsed, self._warn_after))
+
+            if self._outbox is not None and result is not None:
+                self._outbox.put(result)
+
+class Pipeline:
+    """
+    Set of tickers and stages stopped together.
+
+    Stages each have their own stop event, so that stopping can drain them
+    one after the other, from upstream down.
+
+    Methods
+    -------
+    add_ticker(name, period, func)
+        Adds a thread calling `func` every `period` seconds.
+    add_stage(name, func, inbox, outbox=None, warn_after=None)
+        Adds a thread processing items from `inbox`.
+    start()
+        Starts all threads.
+    stop()
+        Stops all tickers, then all stages in the order they were added.
+    wait()
+        Blocks until the pipeline is stopped.
+    """
+
+    def __init__(self):
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._stages = []
+
+    def add_ticker(self, name, period, func):
+        """
+        Adds a thread calling `func` every `period` seconds (see `Ticker`).
+        """
+        ticker = Ticker(name, period, func, self._stop_event)
+        self._threads.append(ticker)
+        return ticker
+
+    def add_stage(self, name, func, inbox, outbox=None, warn_after=None):
+        """
+        Adds a thread processing items from `inbox` (see `Stage`).
+
+        Stages should be added upstream first so that stopping drains them
+        in order.
+        """
+        stop = threading.Event()
+        stage = Stage(name, func, inbox, stop, outbox, warn_after)
+        self._threads.append(stage)
+        self._stages.append((stage, stop))
+        return stage
+
+    def start(self):
+        """
+        Starts all threads.
+        """
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stops all tickers, then all stages in the order they were added.
+
+        Tickers finish their current call. A stage is only stopped once the
+        tickers and the stages added before it exited, so it drains all the
+        items they produced, not just those already in its inbox.
+        """
+        self._stop_event.set()
+        for thread in self._threads:
+            if isinstance(thread, Ticker) and thread.is_alive():
+                thread.join()
+        for stage, stop in self._stages:
+            stop.set()
+            if stage.is_alive():
+                stage.join()
+
+    def wait(self):
+        """
+        Blocks until the pipeline is stopped.
+        """
+        while not self._stop_event.wait(1):
+            pass
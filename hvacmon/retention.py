@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+import hvacmon.db
+import hvacmon.metrics
+import hvacmon.util
+
+np = hvacmon.util.lazy_import('numpy')
+
+MS_PER_DAY = 24*hvacmon.db.MS_PER_HOUR
+
+#
+# SQLite auto_vacuum modes
+#
+AUTO_VACUUM_INCREMENTAL = 2
+
+_ROWS = hvacmon.metrics.counter(
+    'hvacmon_retention_rows_total',
+    'Readings merged, downsampled or archived by the retention policy',
+    label='action')
+_PASS_SECONDS = hvacmon.metrics.histogram(
+    'hvacmon_retention_seconds', 'Time to apply the retention policy')
+
+class Retention:
+    """
+    Retention policy keeping the database from growing without bounds.
+
+    Every pass (`run()`) applies, in order:
+        - Consecutive zone readings of a panel with the same status and no
+          gap between them (e.g. the intervals logged on timeouts) are
+          merged into a single reading, once they are `merge_after` old.
+        - Temperature readings older than `downsample_after` are replaced by
+          one hourly mean per hour.
+        - Readings older than `archive_after` are moved out of the database
+          into one compressed archive per UTC day in `archive_dir`. The
+          hourly rollup is kept, so duty cycle queries still cover archived
+          periods.
+        - Pages freed by the above are returned to the filesystem with
+          incremental vacuuming.
+
+    The policy uses its own connection to the database and does its work in
+    small transactions, so it can run on a background thread while the
+    service keeps writing; a write only ever waits for one chunk.
+
+    Incremental vacuuming needs the auto_vacuum mode of the database to be
+    INCREMENTAL. New databases are created that way; older ones are converted
+    by `enable_incremental_vacuum()` (see bin/hvacmon-vacuum), which rewrites
+    the whole file and should only be called while nothing else uses it.
+    Without it, freed pages are reused but not returned to the filesystem.
+
+    Archives are npz files named after their day, holding the arrays
+    zone_starttime, zone_endtime, zone_status and zone_panel (as in the
+    zone_readings table) and temperature_timestamp and temperature.
+
+    Methods
+    -------
+    __init__(filepath='/var/lib/hvacmon', filename='hvacmon.db',
+             merge_after=3600, downsample_after=30*24*3600,
+             archive_after=None, archive_dir=None, chunk_size=5000,
+             vacuum_pages=256)
+        Initializes the policy and opens a connection to the database.
+    incremental_vacuum
+        Whether the database uses incremental vacuuming.
+    enable_incremental_vacuum()
+        Switches the database to incremental vacuuming (rewrites the file).
+    run(now=None)
+        Applies the policy once.
+    close()
+        Stops a running pass and closes the connection.
+    """
+
+    def __init__(self, filepath='/var/lib/hvacmon', filename='hvacmon.db',
+                 merge_after=3600, downsample_after=30*24*3600,
+                 archive_after=None, archive_dir=None, chunk_size=5000,
+                 vacuum_pages=256):
+        """
+        Initializes the policy and opens a connection to the database.
+
+        Parameters
+        ----------
+        filepath : str
+            Location of the database (see `hvacmon.db.Database`).
+
+        filename : str
+            Name of the database file.
+
+        merge_after : float, optional
+            Seconds after which consecutive identical zone readings are
+            merged. None to never merge.
+
+        downsample_after : float, optional
+            Seconds after which temperature readings are downsampled to
+            hourly means. None to never downsample.
+
+        archive_after : float, optional
+            Seconds after which readings are archived and removed from the
+            database. None to keep them.
+
+        archive_dir : str, optional
+            Directory for archives. Defaults to 'archive' next to the
+            database.
+
+        chunk_size : int
+            Number of readings processed per transaction.
+
+        vacuum_pages : int
+            Number of free pages released per incremental vacuum step.
+        """
+        self._merge_after = merge_after
+        self._downsample_after = downsample_after
+        self._archive_after = archive_after
+        if archive_dir is None:
+            archive_dir = os.path.join(filepath, 'archive')
+        self._archive_dir = archive_dir
+        self._chunk_size = max(chunk_size, 2)
+        self._vacuum_pages = vacuum_pages
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        # Resume points of the incremental passes: start of the last merged
+        # reading of each panel and end of the last downsampled hour
+        self._merged = {}
+        self._downsampled = None
+
+        self._db = sqlite3.connect(os.path.join(filepath, filename),
+                                   timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Stops a running pass and closes the connection.
+        """
+        self._stop.set()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @property
+    def incremental_vacuum(self):
+        """
+        Whether the database uses incremental vacuuming.
+        """
+        with self._lock:
+            mode = self._db.execute('PRAGMA auto_vacuum').fetchone()[0]
+            return mode == AUTO_VACUUM_INCREMENTAL
+
+    def enable_incremental_vacuum(self):
+        """
+        Switches the database to incremental vacuuming.
+
+        Does nothing if it is already enabled. Otherwise the whole database
+        is rewritten with VACUUM, which blocks all other writers meanwhile.
+
+        Returns
+        -------
+        boolean
+            Whether the database was converted.
+        """
+        with self._lock:
+            mode = self._db.execute('PRAGMA auto_vacuum').fetchone()[0]
+            if mode == AUTO_VACUUM_INCREMENTAL:
+                return False
+            print("(%s) Enabling incremental vacuum (rewriting database)"
+                % hvacmon.util.get_timestamp())
+            self._db.execute(
+                'PRAGMA auto_vacuum = %d' % AUTO_VACUUM_INCREMENTAL)
+            self._db.execute('VACUUM')
+            return True
+
+    def run(self, now=None):
+        """
+        Applies the policy once.
+
+        Parameters
+        ----------
+        now : str, datetime.datetime or int, optional
+            Current time (see `hvacmon.util.to_epoch_ms`), from which ages
+            are measured. Defaults to the current time.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        now = hvacmon.util.to_epoch_ms(now)
+        with self._lock, _PASS_SECONDS.time():
+            if self._db is None:
+                return
+            if self._merge_after is not None:
+                self._merge_zone_readings(now - int(self._merge_after*1000))
+            if self._downsample_after is not None:
+                self._downsample_temperatures(
+                    now - int(self._downsample_after*1000))
+            if self._archive_after is not None:
+                self._archive(now - int(self._archive_after*1000))
+            self._vacuum()
+
+    def _panels(self):
+        """
+        Ids of the panels with zone readings.
+        """
+        return [r[0] for r in self._db.execute('''
+            SELECT DISTINCT panel FROM zone_readings''')]
+
+    def _merge_zone_readings(self, cutoff):
+        """
+        Merges consecutive identical zone readings ending before `cutoff`.
+
+        Readings are scanned a chunk at a time. A run of identical readings
+        reaching the end of a chunk is scanned again with the next chunk, so
+        runs are merged across chunks.
+        """
+        for panel in self._panels():
+            start = self._merged.get(panel, 0)
+            while not self._stop.is_set():
+                rows = self._db.execute('''
+                    SELECT rowid, starttime, endtime, status
+                    FROM zone_readings
+                    WHERE panel = ? AND starttime >= ? AND endtime <= ?
+                    ORDER BY starttime LIMIT ?''',
+                    (panel, start, cutoff, self._chunk_size)).fetchall()
+
+                updates = []
+                deletes = []
+                first = rows[0] if rows else None
+                end = first[2] if rows else None
+                for row in rows[1:]:
+                    if row[3] == first[3] and row[1] == end:
+                        deletes.append((row[0],))
+                        end = row[2]
+                        continue
+                    if end != first[2]:
+                        updates.append((end, first[0]))
+                    first = row
+                    end = row[2]
+                if first is not None and end != first[2]:
+                    updates.append((end, first[0]))
+
+                with self._db:
+                    self._db.executemany('''
+                        UPDATE zone_readings SET endtime = ? WHERE rowid = ?
+                        ''', updates)
+                    self._db.executemany('''
+                        DELETE FROM zone_readings WHERE rowid = ?''', deletes)
+                _ROWS.inc('merged', len(deletes))
+
+                if len(rows) < self._chunk_size:
+                    if first is not None:
+                        start = first[1]
+                    break
+                if first[1] == start and not deletes:
+                    # A chunk full of readings starting at the same time
+                    # (overlapping rows); move past it
+                    start = rows[-1][1] + 1
+                else:
+                    start = first[1]
+            self._merged[panel] = start
+
+    def _downsample_temperatures(self, cutoff):
+        """
+        Replaces temperature readings of the hours ending before `cutoff` by
+        their hourly mean, a day at a time.
+        """
+        hour = hvacmon.db.MS_PER_HOUR
+        cutoff = cutoff // hour * hour
+        start = self._downsampled
+        if start is None:
+            row = self._db.execute('''
+                SELECT MIN(timestamp) FROM temperature_readings''').fetchone()
+            if row[0] is None:
+                return
+            start = row[0] // hour * hour
+
+        while start < cutoff and not self._stop.is_set():
+            end = min(start + MS_PER_DAY, cutoff)
+            rows = self._db.execute('''
+                SELECT rowid, timestamp, temperature FROM temperature_readings
+                WHERE timestamp >= ? AND timestamp < ?''',
+                (start, end)).fetchall()
+            data = np.array(rows, dtype=np.float64).reshape(-1, 3)
+            hours = data[:, 1].astype(np.int64) // hour
+            buckets, index, counts = np.unique(
+                hours, return_inverse=True, return_counts=True)
+
+            #
+            # Hours already holding a single reading on the hour are done
+            #
+            on_hour = data[:, 1].astype(np.int64) % hour == 0
+            done = (counts == 1) & np.bincount(
+                index, weights=on_hour, minlength=len(buckets)).astype(bool)
+            means = np.bincount(index, weights=data[:, 2],
+                                minlength=len(buckets)) / counts
+            replace = ~done[index]
+            inserts = [(int(b)*hour, float(m)) for b, m in
+                       zip(buckets[~done], means[~done])]
+            with self._db:
+                self._db.executemany('''
+                    DELETE FROM temperature_readings WHERE rowid = ?''',
+                    [(int(r),) for r in data[replace, 0]])
+                self._db.executemany('''
+                    INSERT INTO temperature_readings(timestamp, temperature)
+                    VALUES(?,?)''', inserts)
+            _ROWS.inc('downsampled', int(replace.sum()))
+            start = end
+        self._downsampled = start
+
+    def _archive(self, cutoff):
+        """
+        Archives and removes the readings of the UTC days ending before
+        `cutoff`, a day at a time (oldest first).
+        """
+        panels = self._panels()
+        while not self._stop.is_set():
+            #
+            # Oldest reading left (per panel, so the index is used)
+            #
+            oldest = [self._db.execute('''
+                SELECT MIN(starttime) FROM zone_readings WHERE panel = ?''',
+                (panel,)).fetchone()[0] for panel in panels]
+            oldest.extend(self._db.execute('''
+                SELECT MIN(timestamp) FROM temperature_readings''').fetchone())
+            oldest = [t for t in oldest if t is not None]
+            if not oldest:
+                return
+            day = min(oldest) // MS_PER_DAY * MS_PER_DAY
+            if day + MS_PER_DAY > cutoff:
+                return
+            self._archive_day(day, panels)
+
+    def _archive_day(self, day, panels):
+        """
+        Moves the readings of one UTC day into its archive.
+        """
+        end = day + MS_PER_DAY
+        zone_rows = []
+        for panel in panels:
+            zone_rows.extend(self._db.execute('''
+                SELECT rowid, starttime, endtime, status, panel
+                FROM zone_readings
+                WHERE panel = ? AND starttime >= ? AND starttime < ?''',
+                (panel, day, end)))
+        temperature_rows = self._db.execute('''
+            SELECT rowid, timestamp, temperature FROM temperature_readings
+            WHERE timestamp >= ? AND timestamp < ?''', (day, end)).fetchall()
+
+        arrays = {
+            'zone_starttime': np.array([r[1] for r in zone_rows],
+                                       dtype=np.int64),
+            'zone_endtime': np.array([r[2] for r in zone_rows],
+                                     dtype=np.int64),
+            'zone_status': np.array([r[3] for r in zone_rows],
+                                    dtype=np.int64),
+            'zone_panel': np.array([r[4] for r in zone_rows], dtype=str),
+            'temperature_timestamp': np.array(
+                [r[1] for r in temperature_rows], dtype=np.int64),
+            'temperature': np.array(
+                [r[2] for r in temperature_rows], dtype=np.float64)}
+
+        #
+        # Readings of the day may have been archived before (e.g. late
+        # writes); add to that archive. Readings already in it, from a pass
+        # which crashed before deleting them, replace their earlier copy.
+        #
+        os.makedirs(self._archive_dir, exist_ok=True)
+        filename = os.path.join(
+            self._archive_dir, '%s.npz' % hvacmon.util.from_epoch_ms(
+                day).strftime('%Y-%m-%d'))
+        if os.path.exists(filename):
+            with np.load(filename) as previous:
+                previous = dict(previous)
+            zone_keys = set(zip(arrays['zone_panel'].tolist(),
+                                arrays['zone_starttime'].tolist()))
+            keep = {
+                'zone': np.array(
+                    [key not in zone_keys for key in zip(
+                        previous['zone_panel'].tolist(),
+                        previous['zone_starttime'].tolist())], dtype=bool),
+                'temperature': ~np.isin(previous['temperature_timestamp'],
+                                        arrays['temperature_timestamp'])}
+            for key in arrays:
+                kept = previous[key][keep[key.split('_')[0]]]
+                arrays[key] = np.concatenate([kept, arrays[key]])
+
+        #
+        # The archive is in place before the readings are deleted, so a
+        # crash in between loses nothing.
+        #
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+
+        with self._db:
+            self._db.executemany('''
+                DELETE FROM zone_readings WHERE rowid = ?''',
+                [(r[0],) for r in zone_rows])
+            self._db.executemany('''
+                DELETE FROM temperature_readings WHERE rowid = ?''',
+                [(r[0],) for r in temperature_rows])
+        _ROWS.inc('archived', len(zone_rows) + len(temperature_rows))
+
+    def _vacuum(self):
+        """
+        Releases free pages to the filesystem a few at a time.
+        """
+        mode = self._db.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if mode != AUTO_VACUUM_INCREMENTAL:
+            return
+        free = self._db.execute('PRAGMA freelist_count').fetchone()[0]
+        while free and not self._stop.is_set():
+            self._db.execute('PRAGMA incremental_vacuum(%d)'
+                             % self._vacuum_pages).fetchall()
+            remaining = self._db.execute(
+                'PRAGMA freelist_count').fetchone()[0]
+            if remaining >= free:
+                return
+            free = remaining
+            time.sleep(0.01)
@@ -1,38 +1,202 @@
 #!/usr/bin/env python
 import sys
 import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import queue
+import signal
+import threading
 import time
 import os
-import dateutil
-import dateutil.parser
-import schedule
-import numpy as np
-import cv2
 
 import hvacmon.camera
+import hvacmon.debugwriter
+import hvacmon.history
 import hvacmon.imgproc
 import hvacmon.db
+import hvacmon.metrics
+import hvacmon.pipeline
+import hvacmon.retention
+import hvacmon.tracker
 import hvacmon.weather
 import hvacmon.util
 
+np = hvacmon.util.lazy_import('numpy')
+
+_CAPTURE_SECONDS = hvacmon.metrics.histogram(
+    'hvacmon_capture_seconds', 'Time to capture a frame')
+_FRAMES_DROPPED = hvacmon.metrics.counter(
+    'hvacmon_frames_dropped_total', 'Frames dropped because parsing was behind')
+_CAPTURE_TIMEOUTS = hvacmon.metrics.counter(
+    'hvacmon_capture_timeouts_total', 'Captures abandoned after hanging')
+_WRITES_DROPPED = hvacmon.metrics.counter(
+    'hvacmon_db_writes_dropped_total',
+    'Database writes dropped because the database stage was stuck')
+_WRITE_ERRORS = hvacmon.metrics.counter(
+    'hvacmon_db_write_errors_total', 'Database writes which failed')
+
+#
+# Seconds a capture may take before it is abandoned (opening the camera in
+# oneshot mode alone takes a few seconds), and seconds a database write may
+# wait for room in the write queue before it is dropped. A hung SQLite call
+# cannot be interrupted; lock waits are bounded by the connection's busy
+# timeout.
+#
+_CAPTURE_TIMEOUT = 15
+_WRITE_TIMEOUT = 30
+
+#
+# Captured frames waiting to be parsed. Frames are views of reused camera
+# buffers (see `hvacmon.camera.FrameRing`), so no frame is captured while the
+# queue is full: a frame is then only ever followed by the queued frames, the
+# frame being captured and recaptures of frames which failed to parse.
+#
+_FRAME_QUEUE_SIZE = 2
+
+def _frame_buffers(panels, parse_retries):
+    """
+    Number of frame buffers a camera needs for its frames to stay valid until
+    they are parsed, given the number of panels seen by it.
+    """
+    return _FRAME_QUEUE_SIZE + panels*parse_retries + 1
+
+class PanelConfig(collections.namedtuple(
+        'PanelConfig', ['id', 'roi', 'zones', 'camera', 'rotation'],
+        defaults=('', hvacmon.imgproc.DEFAULT_ROI, 4, 0, 0))):
+    """
+    Configuration of a monitored LED panel.
+
+    id : str
+        Panel id, keying its readings in the database ('' for single panel
+        setups).
+    roi : hvacmon.imgproc.Roi
+        Region of the camera frame containing the panel.
+    zones : int
+        Number of zones of the panel.
+    camera : int
+        Camera the panel is seen by (several panels may share one).
+    rotation : int
+        Mounting rotation of the camera (the same for all its panels).
+    """
+
+def load_config(filename):
+    """
+    Loads panel configurations from a JSON file.
+
+    The file holds an object with a list of 'panels', each with an 'id' and
+    optionally a 'roi' ([top, bottom, left, right]), 'zones', 'camera' and
+    'rotation' (see `PanelConfig` for the defaults). E.g.:
+
+        {"panels": [
+            {"id": "north", "roi": [170, 270, 670, 710], "zones": 4},
+            {"id": "south", "roi": [170, 300, 900, 940], "zones": 6},
+            {"id": "garage", "camera": 1, "rotation": 180}]}
+
+    Returns
+    -------
+    list of PanelConfig
+    """
+    with open(filename) as f:
+        config = json.load(f)
+    panels = []
+    for entry in config['panels']:
+        panel = PanelConfig(**entry)
+        panels.append(panel._replace(
+            id=str(panel.id), roi=hvacmon.imgproc.Roi(*panel.roi),
+            zones=int(panel.zones), camera=int(panel.camera),
+            rotation=int(panel.rotation)))
+    return panels
+
+class _Panel:
+    """
+    Parsing and tracking state of a monitored panel.
+
+    The parse stage never parses two frames of the same panel at once, so
+    the parser (and its calibration) need not be shared between threads.
+    """
+
+    def __init__(self, config, roi, tracker, detector, debug_writer, history,
+                 adaptive=False):
+        self.config = config
+        self.id = config.id
+        self.parser = hvacmon.imgproc.LedParser(
+            roi, hvacmon.imgproc.LedCalibration(), zones=config.zones,
+            threshold=None if adaptive else hvacmon.imgproc.THRESHOLD)
+        self.tracker = tracker
+        self.detector = detector
+        self.debug_writer = debug_writer
+        self.history = history
+        self.last_parse = None
+
+        #
+        # Panels are told apart in logs and metrics by their id
+        #
+        self.tag = ' [%s]' % self.id if self.id else ''
+        labels = {'panel': self.id} if self.id else None
+        self.parse_seconds = hvacmon.metrics.histogram(
+            'hvacmon_parse_seconds',
+            'Time to parse the LED status from a frame', labels=labels)
+        self.parse_failures = hvacmon.metrics.counter(
+            'hvacmon_parse_failures_total', 'Frames that could not be parsed',
+            label='reason', labels=labels)
+        self.parse_retries = hvacmon.metrics.counter(
+            'hvacmon_parse_retries_total',
+            'Frames recaptured after failing to parse', labels=labels)
+
 class Service:
     """
     Service wrapper for running HVAC monitor continuously.
 
+    Any number of LED panels, seen by one or more cameras, can be monitored
+    by a single service. Every camera is captured once per sample and the
+    panels are parsed in parallel on a shared pool of worker threads (OpenCV
+    releases the GIL), so throughput scales with cores. All readings go to
+    one database, keyed by panel id.
+
+    The status history of every panel is kept in memory and in a journal
+    file (see `hvacmon.history.StateHistory`). Intervals are stored in the
+    database in batches, and after a restart a panel still in the state it
+    was last seen in carries on with that state rather than starting over.
+
     Methods
     -------
-    __init__(outdir, darksky_api_key, lat, lon, camera_rotation=0, debug=False)
+    __init__(outdir, darksky_api_key, lat, lon, camera_rotation=0, debug=False,
+             camera_persistent=True, roi=hvacmon.imgproc.DEFAULT_ROI,
+             roi_capture=False, sample_rate=None, debounce=3,
+             debug_format='png', debug_max_bytes=None, debug_max_age=None,
+             weather_provider=None, camera_backend=None, metrics_port=None,
+             stats_file=None, panels=None, workers=None,
+             compact_interval=300, adaptive=False, parse_retries=1,
+             camera_format='bgr', retention_interval=None, merge_after=3600,
+             downsample_after=30*24*3600, archive_after=None)
         Initializes the system for use. Creates output directories if needed.
     run()
         Main entry point to the service - blocks indefinitely.
+    get_state(panel='')
+        Gets the current status of a panel and since when it has held.
+    capture_frame()
+        Captures a frame from every camera for `process_frame()`.
+    process_frame(frame)
+        Parses captured frames and logs information to database.
     sample_hvac_status()
         Gets current state of HVAC system and logs information to database.
     sample_temperature()
-        Gets current temperature from DarkSky and logs information to database.
+        Logs new temperature readings to database.
     """
 
     def __init__(self, outdir, darksky_api_key, lat, lon,
-                 camera_rotation=0, debug=False):
+                 camera_rotation=0, debug=False, camera_persistent=True,
+                 roi=hvacmon.imgproc.DEFAULT_ROI, roi_capture=False,
+                 sample_rate=None, debounce=3, debug_format='png',
+                 debug_max_bytes=None, debug_max_age=None,
+                 weather_provider=None, camera_backend=None,
+                 metrics_port=None, stats_file=None, panels=None,
+                 workers=None, compact_interval=300, adaptive=False,
+                 parse_retries=1, camera_format='bgr',
+                 retention_interval=None, merge_after=3600,
+                 downsample_after=30*24*3600, archive_after=None):
         """
         Initializes the system for use. Creates output directories if needed.
 
@@ -51,132 +215,730 @@ class Service:
             Longitude of location to sample weather information.
 
         camera_rotation : int
-            Mounting rotation of camera (one of 90, 180, 270).
+            Mounting rotation of camera (one of 90, 180, 270). Ignored if
+            `panels` is given.
 
         debug : boolean
-            Whether to run in 'debug' mode, which logs pngs of captured images
-            to output for future analysis/debug. This can consume large amounts
-            of disk over time.
+            Whether to run in 'debug' mode, which logs the region of interest
+            of captured images to output for future analysis/debug. This can
+            consume large amounts of disk over time unless limited.
+
+        camera_persistent : boolean
+            Whether to keep the camera open between samples. If not set, the
+            camera is opened and configured for every sample.
+
+        roi : hvacmon.imgproc.Roi
+            Region of the full camera frame containing the LED panel. Ignored
+            if `panels` is given.
+
+        roi_capture : boolean
+            Whether to capture only the region of interest off the imager
+            instead of full frames. Debug images are then ROI-only as well.
+            Requires every camera to see a single panel.
+
+        sample_rate : float, optional
+            If set, runs in high-rate mode, sampling this many frames per
+            second (e.g. 2-10) instead of one every 5 seconds. Frames are only
+            parsed when they differ from the last parsed frame, and intervals
+            are only logged on confirmed changes of state. Requires a
+            persistent camera.
+
+        debounce : int
+            In high-rate mode, number of consecutive frames a new state must
+            be seen in before it is accepted, to reject flicker.
+
+        debug_format : str
+            Format of debug images (see `hvacmon.debugwriter.FORMATS`).
+
+        debug_max_bytes : int, optional
+            Size limit of each debug image directory.
+
+        debug_max_age : float, optional
+            Age limit of debug images, in seconds.
+
+        weather_provider : hvacmon.weather.WeatherProvider, optional
+            Source of temperature readings. Defaults to DarkSky (using
+            `darksky_api_key`, `lat` and `lon`).
+
+        camera_backend : hvacmon.camera.CameraBackend or dict, optional
+            Backend capturing frames, or a dict of backends keyed by camera
+            number when there are several cameras. Defaults to the raspberry
+            pi camera.
+
+        metrics_port : int, optional
+            If set, timing metrics are served in Prometheus text format at
+            http://localhost:<port>/metrics while running.
+
+        stats_file : str, optional
+            If set, a JSON summary of the timing metrics is written to this
+            file every minute while running.
+
+        panels : list of PanelConfig, optional
+            Panels to monitor (see `load_config`). Defaults to a single panel
+            with the default id, seen by camera 0 through `roi` and
+            `camera_rotation`. Debug images of panels with an id are written
+            to a subdirectory named after it.
+
+        workers : int, optional
+            Number of threads parsing panels in parallel. Defaults to one per
+            panel, up to the number of cores.
+
+        compact_interval : float
+            Seconds between batched writes of status intervals to the
+            database. Until then they are only in the journal.
+
+        adaptive : boolean
+            Whether to adapt to ambient light: the shutter speed of every
+            camera is adjusted to keep the LEDs bright but not saturated (see
+            `hvacmon.camera.ExposureControl`) and LED thresholds follow the
+            brightness of each frame.
+
+        parse_retries : int
+            Number of times a frame which fails to parse is recaptured within
+            the same sample before the failure is logged. Not used in
+            high-rate mode, where the next frame follows shortly anyway.
+
+        camera_format : str
+            Pixel format captured off the pi cameras: 'bgr', or 'yuv' to
+            parse the luma plane only (a third of the data, but the power LED
+            is then checked for brightness rather than color).
+
+        retention_interval : float, optional
+            Seconds between passes of the retention policy (see
+            `hvacmon.retention.Retention`), which runs in the background. If
+            None, data is kept as written.
+
+        merge_after, downsample_after, archive_after : float, optional
+            Ages (seconds) after which the retention policy merges identical
+            consecutive zone readings, downsamples temperatures to hourly
+            and archives readings to `outdir`/archive. None to never do so.
         """
+        if sample_rate is not None and not camera_persistent:
+            raise ValueError('High-rate sampling requires a persistent camera.')
+
+        #
+        # OpenCV (and numpy) take seconds to import on small boards. Load
+        # them in the background while we set up and the camera settles;
+        # they are first needed to parse the initial frame.
+        #
+        hvacmon.util.preload('numpy', 'cv2')
+
+        if panels is None:
+            panels = [PanelConfig(roi=roi, rotation=camera_rotation)]
+        ids = [config.id for config in panels]
+        if len(set(ids)) != len(ids):
+            raise ValueError('Panel ids must be unique: %s' % ids)
+
+        #
+        # Panels sharing a camera share its frames, so they must agree on its
+        # rotation and cannot each have the imager capture their region
+        #
+        camera_panels = collections.OrderedDict()
+        for config in panels:
+            camera_panels.setdefault(config.camera, []).append(config)
+        for camera, configs in camera_panels.items():
+            if len(set(config.rotation for config in configs)) > 1:
+                raise ValueError(
+                    'Panels on camera %d have different rotations.' % camera)
+            if roi_capture and len(configs) > 1:
+                raise ValueError('ROI capture requires a single panel per '
+                                 'camera (camera %d has %d).'
+                                 % (camera, len(configs)))
+
+        if isinstance(camera_backend, dict):
+            backends = camera_backend
+        elif len(camera_panels) == 1:
+            backends = {next(iter(camera_panels)): camera_backend}
+        elif camera_backend is None:
+            backends = {}
+        else:
+            raise ValueError('Several cameras need a dict of backends.')
+
+        #
+        # Timestamps are kept as UTC datetimes and only formatted for logging
+        # and storage. Elapsed time is measured with the monotonic clock.
+        #
+        # In high-rate mode, intervals are only closed on (debounced) changes
+        # and steady frames are recognized by frame differencing, with a full
+        # parse forced every minute.
+        #
+        if sample_rate is None:
+            self._sample_period = 5
+            timeout = 60
+            debounce = 1
+            self._parse_retries = parse_retries
+        else:
+            self._sample_period = 1/sample_rate
+            timeout = None
+            self._parse_retries = 0
+        self._verify_period = 60
+
         self._debug = debug
         self._outdir = os.path.join(outdir)
 
         if not os.path.exists(self._outdir):
             print("Creating outdir: %s" % self._outdir)
             os.makedirs(self._outdir)
-        if (self._debug):
-            self._failpath = os.path.join(self._outdir, 'failures')
-            self._changepath = os.path.join(self._outdir, 'statechange')
-            self._timeoutpath = os.path.join(self._outdir, 'timeouts')
-            if not os.path.exists(self._failpath):
-                print("Creating outdir: %s" % self._failpath)
-                os.makedirs(self._failpath)
-            if not os.path.exists(self._changepath):
-                print("Creating outdir: %s" % self._changepath)
-                os.makedirs(self._changepath)
-            if not os.path.exists(self._timeoutpath):
-                print("Creating outdir: %s" % self._timeoutpath)
-                os.makedirs(self._timeoutpath)
-
-        self._camera = hvacmon.camera.Camera(camera_rotation)
+
+        #
+        # When the camera captures the ROI itself, frames are already cropped
+        # and must not be cropped again when parsing.
+        #
+        self._cameras = collections.OrderedDict()
+        for camera, configs in camera_panels.items():
+            backend = backends.get(camera)
+            if backend is None:
+                backend = hvacmon.camera.PiCameraBackend(
+                    use_video_port=camera_persistent, camera_num=camera,
+                    format=camera_format,
+                    buffers=_frame_buffers(len(configs), self._parse_retries))
+            self._cameras[camera] = hvacmon.camera.Camera(
+                configs[0].rotation, persistent=camera_persistent,
+                backend=backend, roi=configs[0].roi if roi_capture else None)
+
+        #
+        # Panels sharing a camera share its exposure control
+        #
+        self._exposure = {}
+        if adaptive:
+            self._exposure = {
+                number: hvacmon.camera.ExposureControl(camera)
+                for number, camera in self._cameras.items()}
         self._db = hvacmon.db.Database(filepath=self._outdir)
-        self._weather = hvacmon.weather.Weather(darksky_api_key, lat, lon)
 
-        self._prev_timestamp = hvacmon.util.get_timestamp()
-        self._prev_status = np.zeros((4,2))
+        #
+        # Weather is fetched in the background and the last good reading is
+        # cached on disk, so a slow or unreachable provider never blocks us.
+        #
+        if weather_provider is None:
+            weather_provider = hvacmon.weather.DarkSkyProvider(
+                darksky_api_key, lat, lon)
+        self._weather = hvacmon.weather.CachedWeather(
+            weather_provider, os.path.join(self._outdir, 'weather.json'),
+            max_age=15*60)
+        reading = self._weather.get_temperature()
+        self._last_temperature = reading[0] if reading else None
+
+        self._panels = []
+        for config in panels:
+            parse_roi = None if roi_capture else config.roi
+
+            #
+            # Debug images are encoded and written off the sampling thread
+            #
+            debug_writer = None
+            if (self._debug):
+                debug_writer = hvacmon.debugwriter.DebugWriter(
+                    os.path.join(self._outdir, config.id), debug_format,
+                    roi=parse_roi, max_bytes=debug_max_bytes,
+                    max_age=debug_max_age, zones=config.zones)
+
+            detector = None
+            if sample_rate is not None:
+                detector = hvacmon.imgproc.ChangeDetector(parse_roi)
+
+            tracker = hvacmon.tracker.StatusTracker(
+                datetime.datetime.utcnow(),
+                np.zeros((config.zones, 2), dtype=np.uint8),
+                timeout=timeout, clock=time.monotonic(), debounce=debounce)
+
+            panel_dir = os.path.join(self._outdir, config.id)
+            if not os.path.exists(panel_dir):
+                os.makedirs(panel_dir)
+            history = hvacmon.history.StateHistory(
+                os.path.join(panel_dir, 'history.journal'), config.zones)
+            self._panels.append(_Panel(config, parse_roi, tracker, detector,
+                                       debug_writer, history, adaptive))
+
+        #
+        # The journal is synced every few seconds, bounding what a crash can
+        # lose. A state seen again within `_resume_gap` seconds of when it
+        # was last journaled is taken to have held throughout.
+        #
+        self._sync_interval = 5
+        self._resume_gap = 60
+        self._compact_interval = compact_interval
+
+        #
+        # The retention policy works through its own connection, in small
+        # transactions, so it can run alongside the sampling loop's writes
+        #
+        self._retention = None
+        self._retention_interval = retention_interval
+        if retention_interval:
+            self._retention = hvacmon.retention.Retention(
+                self._outdir, merge_after=merge_after,
+                downsample_after=downsample_after,
+                archive_after=archive_after)
+
+        #
+        # Panels are parsed in parallel only when there are several of them
+        #
+        if workers is None:
+            workers = min(len(self._panels), os.cpu_count() or 1)
+        self._executor = None
+        if len(self._panels) > 1 and workers > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='parse')
+
+        #
+        # Queue of pending database writes while the pipeline is running
+        # (writes are made directly otherwise)
+        #
+        self._writes = None
+
+        # Completion of an abandoned capture which is still hanging, if any
+        self._hung_capture = None
+
+        self._metrics_port = metrics_port
+        self._stats_file = stats_file
 
     def run(self):
         """
         Main entry point to the service - blocks indefinitely.
 
-        HVAC status is sampled every 5 seconds.
-        Temperature is sampled every 15 minutes.
+        HVAC status is sampled every 5 seconds (or at the high-rate mode
+        sample rate).
+        Temperature is refreshed every 15 minutes (new readings are picked up
+        within a minute).
+
+        Capture, parsing, database writes and weather fetches run on separate
+        threads joined by bounded queues, so the sampling cadence does not
+        depend on the latency of any other stage. If parsing falls behind,
+        frames are dropped; if the database falls behind, parsing blocks.
+        """
+        frame = self.capture_frame()
+        for panel in self._panels:
+            timestamp, clock, im = frame[panel.config.camera]
+            status = np.zeros((panel.config.zones, 2), dtype=np.uint8)
+            try:
+                status = panel.parser.parse(im)
+            except RuntimeError as e:
+                print("(%s)%s Error capturing initial state: %s"
+                    % (hvacmon.util.get_timestamp(timestamp), panel.tag, e))
+            panel.tracker.reset(timestamp, status, clock)
+            if panel.detector is not None:
+                panel.detector.reset(im)
+                panel.last_parse = clock
+
+            print("(%s)%s Initial state: %s"
+                % (hvacmon.util.get_timestamp(timestamp), panel.tag,
+                   status.flatten()))
+            self._resume(panel, timestamp, status, clock)
+            panel.history.compact(self._db, panel.id)
+
+        frames = queue.Queue(maxsize=_FRAME_QUEUE_SIZE)
+        self._writes = queue.Queue(maxsize=64)
+
+        pipeline = hvacmon.pipeline.Pipeline()
+        pipeline.add_ticker('capture', self._sample_period,
+                            lambda: self._offer_frame(frames))
+        pipeline.add_ticker('weather', 60, self.sample_temperature)
+        pipeline.add_ticker('journal', self._sync_interval, self._sync_history)
+        pipeline.add_ticker('flush', self._sync_interval,
+                            lambda: self._write(self._db.flush_if_due))
+        pipeline.add_ticker('compact', self._compact_interval,
+                            lambda: self._write(self._compact_history))
+        pipeline.add_stage('parse', self.process_frame, frames, warn_after=5)
+        pipeline.add_stage('db', self._store, self._writes, warn_after=5)
+        if self._stats_file is not None:
+            pipeline.add_ticker('stats', 60, self._write_stats)
+        if self._retention is not None:
+            if not self._retention.incremental_vacuum:
+                print("Database does not use incremental vacuuming; freed "
+                      "space is reused but not released (convert it offline "
+                      "with hvacmon-vacuum)")
+            pipeline.add_ticker('retention', self._retention_interval,
+                                self._retention.run)
+
+        server = None
+        if self._metrics_port is not None:
+            server = hvacmon.metrics.MetricsServer(self._metrics_port)
+
+        # Stop cleanly (flushing pending writes) when systemd stops us
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        pipeline.start()
+        try:
+            pipeline.wait()
+        finally:
+            if self._retention is not None:
+                self._retention.close()
+            pipeline.stop()
+            self._writes = None
+            if self._executor is not None:
+                self._executor.shutdown()
+
+            # Log the state we were in up to now
+            for panel in self._panels:
+                interval = panel.tracker.close(
+                    datetime.datetime.utcnow(), time.monotonic())
+                if interval is not None:
+                    panel.history.append(*interval)
+                panel.history.compact(self._db, panel.id)
+                panel.history.close()
+                if panel.debug_writer is not None:
+                    panel.debug_writer.close()
+            # A hung capture holds its camera, which cannot be closed then
+            if self._hung_capture is None or self._hung_capture.is_set():
+                for camera in self._cameras.values():
+                    camera.close()
+            self._db.close()
+            if self._stats_file is not None:
+                self._write_stats()
+            if server is not None:
+                server.close()
+
+    def _resume(self, panel, timestamp, status, clock):
+        """
+        Continues the run journaled before a restart if the panel is still in
+        the same state, or closes it at the time it was last seen otherwise.
+        """
+        run = panel.history.open_run
+        if run is not None:
+            start, end, previous = run
+            gap = (timestamp - end).total_seconds()
+            if (previous.shape == status.shape and
+                    (previous == status).all() and
+                    0 <= gap <= self._resume_gap):
+                print("(%s)%s Resuming state held since %s"
+                    % (hvacmon.util.get_timestamp(timestamp), panel.tag,
+                       hvacmon.util.get_timestamp(start)))
+                panel.tracker.reset(start, status, clock)
+            elif start < end:
+                panel.history.append(start, end, previous)
+        panel.history.update(panel.tracker.timestamp, timestamp,
+                             panel.tracker.status)
+
+    def _sync_history(self):
+        """
+        Syncs the journals of all panels.
+        """
+        for panel in self._panels:
+            panel.history.sync()
+
+    def _compact_history(self):
+        """
+        Stores the journaled intervals of all panels in the database.
+        """
+        for panel in self._panels:
+            panel.history.compact(self._db, panel.id)
+
+    def get_state(self, panel=''):
+        """
+        Gets the current status of a panel and since when it has held.
+
+        Answered from memory, without querying the database.
+
+        Parameters
+        ----------
+        panel : str
+            Id of the panel.
+
+        Returns
+        -------
+        3-tuple of (status, since, until) or None
+            See `hvacmon.history.StateHistory.current`.
+        """
+        for p in self._panels:
+            if p.id == panel:
+                return p.history.current()
+        raise KeyError('Unknown panel: %r' % panel)
+
+    def _write_stats(self):
+        """
+        Writes the metrics summary to the stats file.
         """
-        self._prev_timestamp, im = self._camera.get_frame()
         try:
-            self._prev_status = hvacmon.imgproc.parse_image(im)
-        except RuntimeError as e:
-            print("(%s) Error capturing initial state: %s"
-                % (self._prev_timestamp, e))
+            hvacmon.metrics.REGISTRY.write(self._stats_file)
+        except OSError as e:
+            print("Unable to write stats file: %r" % e)
 
-        print("(%s) Initial state: %s" % (self._prev_timestamp,
-                                          self._prev_status.flatten()))
+    def _offer_frame(self, frames):
+        """
+        Captures frames and queues them for parsing, skipping the capture if
+        the queue is full.
 
-        self.sample_temperature()
+        A capture would overwrite a camera buffer still holding a queued
+        frame or the frame being parsed, so frames are dropped before they
+        are captured. Only this ticker adds to the queue, so it cannot fill
+        up between the check and `put_nowait()`.
+        """
+        if frames.full():
+            _FRAMES_DROPPED.inc()
+            print("(%s) Parsing is behind, dropping frame"
+                % hvacmon.util.get_timestamp())
+            return
+        frame = self._capture_with_timeout()
+        if frame is not None:
+            frames.put_nowait(frame)
+
+    def _capture_with_timeout(self):
+        """
+        Captures frames, giving up after `_CAPTURE_TIMEOUT` seconds.
+
+        A capture which hangs is abandoned, and no other is started until it
+        returns (it holds the camera meanwhile). The cameras are then closed,
+        so they are reopened by the next capture.
 
-        schedule.every(5).seconds.do(self.sample_hvac_status)
-        schedule.every(15).minutes.do(self.sample_temperature)
-        while 1:
-            schedule.run_pending()
-            time.sleep(1)
+        Returns
+        -------
+        dict or None
+            Captured frames (see `capture_frame()`), or None if the capture
+            timed out or one is still hanging.
+        """
+        if self._hung_capture is not None:
+            if not self._hung_capture.is_set():
+                return None
+            self._hung_capture = None
+            print("(%s) Hung capture returned, reopening cameras"
+                % hvacmon.util.get_timestamp())
+            for camera in self._cameras.values():
+                camera.close()
+
+        done = threading.Event()
+
+        def capture():
+            try:
+                return self.capture_frame()
+            finally:
+                done.set()
+
+        try:
+            return hvacmon.pipeline.call_with_timeout(
+                capture, _CAPTURE_TIMEOUT)
+        except TimeoutError:
+            _CAPTURE_TIMEOUTS.inc()
+            print("(%s) Capture did not complete within %d s, abandoning it"
+                % (hvacmon.util.get_timestamp(), _CAPTURE_TIMEOUT))
+            self._hung_capture = done
+            return None
+
+    def _write(self, func, *args, **kwargs):
+        """
+        Calls a database write function, through the write queue if the
+        pipeline is running.
+
+        If the queue stays full for `_WRITE_TIMEOUT` seconds (the database
+        stage is stuck), the write is dropped rather than blocking the
+        caller.
+
+        Returns
+        -------
+        boolean
+            Whether the write was made or queued.
+        """
+        if self._writes is None:
+            func(*args, **kwargs)
+            return True
+        try:
+            self._writes.put((func, args, kwargs), timeout=_WRITE_TIMEOUT)
+        except queue.Full:
+            _WRITES_DROPPED.inc()
+            print("(%s) Database writes are stuck, dropping %s"
+                % (hvacmon.util.get_timestamp(), func.__name__))
+            return False
+        return True
+
+    @staticmethod
+    def _store(item):
+        """
+        Performs a queued database write.
+        """
+        func, args, kwargs = item
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            _WRITE_ERRORS.inc()
+            print("(%s) Database write %s failed: %r"
+                % (hvacmon.util.get_timestamp(), func.__name__, e))
+
+    def capture_frame(self):
+        """
+        Captures a frame from every camera for `process_frame()`.
+
+        Returns
+        -------
+        dict
+            3-tuples of (timestamp, clock, image) keyed by camera number,
+            where `clock` is the monotonic clock reading at the time of
+            capture.
+        """
+        frame = {}
+        for number, camera in self._cameras.items():
+            clock = time.monotonic()
+            with _CAPTURE_SECONDS.time():
+                timestamp, im = camera.get_frame()
+            frame[number] = (timestamp, clock, im)
+        return frame
 
     def sample_hvac_status(self):
         """
         Gets current state of HVAC system and logs information to database.
 
-        Previous state information is logged to the database when:
+        Previous state information of a panel is logged to the database when:
             - A change in state is detected.
             - There was an error processing the image (prev state is captured).
             - No state change was observed after a fixed period of time.
 
         If the debug flag was set on the object, images are saved as pngs.
         """
-        timestamp, im = self._camera.get_frame()
-        if (self._debug):
-            t1_str = dateutil.parser.parse(self._prev_timestamp).strftime(
-                "%Y-%m-%d_%H-%M-%S")
-            t2_str = dateutil.parser.parse(timestamp).strftime(
-                "%Y-%m-%d_%H-%M-%S")
-            filename = t1_str + "_" + t2_str
+        self.process_frame(self.capture_frame())
 
-        dt = (dateutil.parser.parse(timestamp) -
-              dateutil.parser.parse(self._prev_timestamp)).total_seconds()
+    def process_frame(self, frame):
+        """
+        Parses captured frames and logs information to database.
 
-        try:
-            status = hvacmon.imgproc.parse_image(im)
-        except RuntimeError as e:
-            print("(%s) Error processing image: %s" % (timestamp, e))
-            if (self._debug):
-                cv2.imwrite(
-                    os.path.join(self._failpath, '%s.png' % filename), im)
-            self._prev_status = np.zeros((4,2))
-            self._prev_timestamp = timestamp
+        Panels are parsed in parallel on the worker pool; their results are
+        then applied in order. See `sample_hvac_status()`.
+
+        Parameters
+        ----------
+        frame : dict
+            Captured frames as returned by `capture_frame()`.
+        """
+        if self._executor is None:
+            results = [self._parse_panel(panel, frame[panel.config.camera])
+                       for panel in self._panels]
+        else:
+            futures = [self._executor.submit(
+                           self._parse_panel, panel,
+                           frame[panel.config.camera])
+                       for panel in self._panels]
+            results = [future.result() for future in futures]
+
+        for panel, result in zip(self._panels, results):
+            self._update_panel(panel, *result)
+
+    def _parse_panel(self, panel, frame):
+        """
+        Parses the status of a panel from a captured frame (may run on a
+        worker thread).
+
+        A frame which fails to parse is replaced by a fresh capture, up to
+        `_parse_retries` times, rather than losing the sample.
+
+        Returns
+        -------
+        3-tuple of (frame, status, error)
+            The frame last parsed, and the parsed status or the RuntimeError
+            raised by the parser. Status and error are both None if the frame
+            was skipped as unchanged.
+        """
+        timestamp, clock, im = frame
+
+        #
+        # In high-rate mode, frames matching the last parsed frame keep the
+        # current state unless a change is waiting to be confirmed.
+        #
+        if (panel.detector is not None and not panel.tracker.pending and
+                panel.last_parse is not None and
+                clock - panel.last_parse < self._verify_period and
+                not panel.detector.changed(im)):
+            return frame, None, None
+
+        retries = self._parse_retries
+        while True:
+            exposure = self._exposure.get(panel.config.camera)
+            if exposure is not None:
+                exposure.observe(
+                    hvacmon.imgproc.frame_brightness(im, panel.parser.roi)[1])
+            start = time.monotonic()
+            try:
+                status = panel.parser.parse(im)
+            except RuntimeError as e:
+                panel.parse_seconds.observe(time.monotonic() - start)
+                if not retries:
+                    return frame, None, e
+                retries -= 1
+                panel.parse_retries.inc()
+                print("(%s)%s Error processing image, recapturing: %s"
+                    % (hvacmon.util.get_timestamp(timestamp), panel.tag, e))
+                clock = time.monotonic()
+                timestamp, im = self._cameras[panel.config.camera].get_frame()
+                frame = (timestamp, clock, im)
+                continue
+            panel.parse_seconds.observe(time.monotonic() - start)
+            return frame, status, None
+
+    def _update_panel(self, panel, frame, status, error):
+        """
+        Tracks the parsed status of a panel and logs information to database.
+        """
+        timestamp, clock, im = frame
+        if status is None and error is None:
+            panel.history.update(panel.tracker.timestamp, timestamp,
+                                 panel.tracker.status)
             return
 
-        if (~(status == self._prev_status).all()):
-            print("(%s) Status change detected: %s" % (timestamp,
-                                                       status.flatten()))
+        if (self._debug):
+            filename = self._debug_filename(panel.tracker.timestamp, timestamp)
+
+        if error is not None:
+            panel.parse_failures.inc(str(error))
+            print("(%s)%s Error processing image: %s"
+                % (hvacmon.util.get_timestamp(timestamp), panel.tag, error))
             if (self._debug):
-                cv2.imwrite(
-                    os.path.join(self._changepath, '%s.png' % filename), im)
+                panel.debug_writer.submit(
+                    hvacmon.debugwriter.FAILURES, filename, im)
+            panel.tracker.fail(timestamp, clock)
+            panel.history.update(timestamp, timestamp, panel.tracker.status)
+            if panel.detector is not None:
+                panel.detector.invalidate()
+            return
 
-            self._db.append_zone_data(
-                self._prev_timestamp, timestamp, self._prev_status)
-            self._prev_status = status
-            self._prev_timestamp = timestamp
+        if panel.detector is not None:
+            panel.detector.reset(im)
+            panel.last_parse = clock
+
+        event, interval = panel.tracker.update(timestamp, status, clock)
+        if (event == hvacmon.tracker.EVENT_CHANGE):
+            print("(%s)%s Status change detected: %s"
+                % (hvacmon.util.get_timestamp(timestamp), panel.tag,
+                   status.flatten()))
+            if (self._debug):
+                panel.debug_writer.submit(
+                    hvacmon.debugwriter.STATE_CHANGE, filename, im, status)
 
-        elif (dt > 60):
-            print("(%s) No status change after 1 min, logging..." % timestamp)
+        elif (event == hvacmon.tracker.EVENT_TIMEOUT):
+            print("(%s)%s No status change after 1 min, logging..."
+                % (hvacmon.util.get_timestamp(timestamp), panel.tag))
             if (self._debug):
-                cv2.imwrite(
-                    os.path.join(self._timeoutpath, '%s.png' % filename), im)
+                panel.debug_writer.submit(
+                    hvacmon.debugwriter.TIMEOUTS, filename, im, status)
 
-            self._db.append_zone_data(
-                self._prev_timestamp, timestamp, self._prev_status)
-            self._prev_status = status
-            self._prev_timestamp = timestamp
+        if interval is not None:
+            panel.history.append(*interval)
+        panel.history.update(panel.tracker.timestamp, timestamp,
+                             panel.tracker.status)
+
+    @staticmethod
+    def _debug_filename(t1, t2):
+        """
+        Builds the debug image name for an interval, in the format expected
+        by hvacmon-postprocess (%Y-%m-%dT%H-%M-%S_%Y-%m-%dT%H-%M-%S).
+        """
+        return (t1.strftime("%Y-%m-%dT%H-%M-%S") + "_" +
+                t2.strftime("%Y-%m-%dT%H-%M-%S"))
 
     def sample_temperature(self):
         """
-        Gets current temperature from DarkSky and logs information to database.
+        Logs new temperature readings to database.
+
+        Never waits on the weather provider: the weather cache refreshes
+        itself in the background and only readings not logged before are
+        written. A reading whose write is dropped is retried on the next
+        call.
         """
-        try:
-            timestamp, temperature = self._weather.get_temperature()
-            print("(%s) Got temperature reading: %f" % (timestamp, temperature))
-            self._db.append_temperature_data(timestamp, temperature)
-        except:
-            e = sys.exc_info()[0]
-            print("Unable to reach DarkSky Service: %s" % e)
+        reading = self._weather.get_temperature()
+        if reading is None or reading[0] == self._last_temperature:
+            return
+        timestamp, temperature = reading
+        print("(%s) Got temperature reading: %f"
+            % (hvacmon.util.get_timestamp(timestamp), temperature))
+        if self._write(self._db.append_temperature_data, timestamp,
+                       temperature):
+            self._last_temperature = timestamp
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -184,8 +946,68 @@ def parse_args():
         help="Camera rotation in degrees", required=False)
     parser.add_argument("-d", "--debug", action='store_true',
         help="Run in debug mode (saves raw images to disk)")
+    parser.add_argument("--debug-format", type=str, default='png',
+        choices=hvacmon.debugwriter.FORMATS,
+        help="Format of debug images (npz and h5 write rolling archives)")
+    parser.add_argument("--debug-max-size", type=float, default=500,
+        help="Size limit of each debug image directory, in MB "
+             "(0 for unlimited)")
+    parser.add_argument("--debug-max-age", type=float, default=30,
+        help="Age limit of debug images, in days (0 for unlimited)")
     parser.add_argument("-o", "--outdir", type=str, default='/var/lib/hvacmon',
         help="Output directory to store database and debug images")
+    parser.add_argument("-c", "--camera-mode", type=str, default='persistent',
+        choices=['persistent', 'oneshot'],
+        help="Keep the camera open between samples (persistent) or open it "
+             "for every sample (oneshot)")
+    parser.add_argument("--roi", type=int, nargs=4,
+        default=list(hvacmon.imgproc.DEFAULT_ROI),
+        metavar=('TOP', 'BOTTOM', 'LEFT', 'RIGHT'),
+        help="Region of the camera frame containing the LED panel")
+    parser.add_argument("--camera-format", type=str, default='bgr',
+        choices=['bgr', 'yuv'],
+        help="Capture color frames (bgr) or only their luma plane (yuv)")
+    parser.add_argument("--roi-capture", action='store_true',
+        help="Capture only the region of interest off the imager")
+    parser.add_argument("--rate", type=float,
+        help="Run in high-rate mode, sampling this many frames per second "
+             "and logging only on confirmed state changes")
+    parser.add_argument("--debounce", type=int, default=3,
+        help="Frames a new state must persist for in high-rate mode")
+    parser.add_argument("--metrics-port", type=int,
+        help="Serve timing metrics (Prometheus format) on this local port")
+    parser.add_argument("--stats-file", type=str,
+        help="Write a JSON summary of timing metrics to this file every "
+             "minute")
+    parser.add_argument("--weather-file", type=str,
+        help="Read temperatures from this JSON file instead of DarkSky")
+    parser.add_argument("--config", type=str,
+        help="JSON file describing the panels to monitor (overrides "
+             "--rotation and --roi)")
+    parser.add_argument("--workers", type=int,
+        help="Number of threads parsing panels in parallel (default: one "
+             "per panel, up to the number of cores)")
+    parser.add_argument("--adaptive", action='store_true',
+        help="Adjust shutter speed and LED thresholds to ambient light")
+    parser.add_argument("--parse-retries", type=int, default=1,
+        help="Times a frame that fails to parse is recaptured before the "
+             "failure is logged")
+    parser.add_argument("--retention-interval", type=float, default=0,
+        help="Seconds between passes of the retention policy, which merges, "
+             "downsamples and archives old readings (default 0: keep all "
+             "data as written)")
+    parser.add_argument("--merge-after", type=float, default=1,
+        help="Age in hours after which identical consecutive zone readings "
+             "are merged (0 for never)")
+    parser.add_argument("--downsample-after", type=float, default=30,
+        help="Age in days after which temperatures are downsampled to "
+             "hourly means (0 for never)")
+    parser.add_argument("--archive-after", type=float, default=0,
+        help="Age in days after which readings are moved to compressed "
+             "archives in <outdir>/archive (0 for never)")
+    parser.add_argument("--compact-interval", type=float, default=300,
+        help="Seconds between batched writes of status intervals to the "
+             "database (they are journaled in the meantime)")
     args = parser.parse_args()
     return args
 
@@ -193,29 +1015,53 @@ def main():
     args = parse_args()
 
     #
-    # Weather parameters stored as env vars.
+    # Weather parameters stored as env vars (unless read from a file).
     #
-    if 'DARKSKY_API_KEY' not in os.environ:
-        raise RuntimeError('Environment variable DARKSKY_API_KEY not set.')
+    darksky_api_key, latitude, longitude = None, None, None
+    weather_provider = None
+    if args.weather_file:
+        weather_provider = hvacmon.weather.FileProvider(args.weather_file)
     else:
-        darksky_api_key = os.environ['DARKSKY_API_KEY']
+        if 'DARKSKY_API_KEY' not in os.environ:
+            raise RuntimeError('Environment variable DARKSKY_API_KEY not set.')
+        else:
+            darksky_api_key = os.environ['DARKSKY_API_KEY']
 
-    if 'HVACMON_LAT' not in os.environ:
-        raise RuntimeError('Environment variable HVACMON_LAT not set.')
-    else:
-        latitude = float(os.environ['HVACMON_LAT'])
+        if 'HVACMON_LAT' not in os.environ:
+            raise RuntimeError('Environment variable HVACMON_LAT not set.')
+        else:
+            latitude = float(os.environ['HVACMON_LAT'])
 
-    if 'HVACMON_LON' not in os.environ:
-        raise RuntimeError('Environment variable HVACMON_LON not set.')
-    else:
-        longitude = float(os.environ['HVACMON_LON'])
+        if 'HVACMON_LON' not in os.environ:
+            raise RuntimeError('Environment variable HVACMON_LON not set.')
+        else:
+            longitude = float(os.environ['HVACMON_LON'])
+
+    panels = None
+    if args.config:
+        panels = load_config(args.config)
 
     #
     # Create and run the service.
     #
     srv = Service(
         args.outdir, darksky_api_key, latitude, longitude,
-        args.rotation, args.debug)
+        camera_rotation=args.rotation, debug=args.debug,
+        camera_persistent=args.camera_mode == 'persistent',
+        roi=hvacmon.imgproc.Roi(*args.roi), roi_capture=args.roi_capture,
+        sample_rate=args.rate, debounce=args.debounce,
+        debug_format=args.debug_format,
+        debug_max_bytes=int(args.debug_max_size*1e6) or None,
+        debug_max_age=args.debug_max_age*24*3600 or None,
+        weather_provider=weather_provider,
+        metrics_port=args.metrics_port, stats_file=args.stats_file,
+        panels=panels, workers=args.workers,
+        compact_interval=args.compact_interval, adaptive=args.adaptive,
+        parse_retries=args.parse_retries, camera_format=args.camera_format,
+        retention_interval=args.retention_interval or None,
+        merge_after=args.merge_after*3600 or None,
+        downsample_after=args.downsample_after*24*3600 or None,
+        archive_after=args.archive_after*24*3600 or None)
     srv.run()
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+import hvacmon.util
+
+np = hvacmon.util.lazy_import('numpy')
+
+EVENT_CHANGE = 'change'
+EVENT_TIMEOUT = 'timeout'
+
+class StatusTracker:
+    """
+    State machine deciding when HVAC status intervals are logged.
+
+    The tracker holds the status and start time of the current (open)
+    interval. The interval is closed and handed back for logging when:
+        - A change in state is detected.
+        - No state change was observed after a fixed period of time.
+
+    A failure to obtain the status discards the open interval and restarts
+    tracking from an all-zero status.
+
+    With debouncing, a new status only counts as a change once it has been
+    observed in a number of consecutive samples. The interval then ends at
+    the first of those samples. Shorter excursions (e.g. LED flicker or a
+    misread frame) are ignored.
+
+    Methods
+    -------
+    __init__(timestamp, status, timeout=60, clock=None, debounce=1)
+        Starts tracking from an initial state.
+    update(timestamp, status, clock=None)
+        Records a new status sample.
+    fail(timestamp, clock=None)
+        Records a failure to obtain the status.
+    close(timestamp, clock=None)
+        Closes the open interval.
+    reset(timestamp, status, clock=None)
+        Discards the open interval and restarts tracking.
+
+    All methods optionally accept a monotonic clock reading (e.g. from
+    `time.monotonic()`) taken alongside the timestamp. When available it is
+    used to measure the age of the open interval, so steps in the wall clock
+    (e.g. from NTP) do not affect the timeout.
+    """
+
+    def __init__(self, timestamp, status, timeout=60, clock=None, debounce=1):
+        """
+        Starts tracking from an initial state.
+
+        Parameters
+        ----------
+        timestamp : datetime.datetime
+            Time at which the initial status was observed (UTC).
+
+        status : 4x2 numpy.ndarray
+            Initial status array (see `hvacmon.imgproc.parse_image`).
+
+        timeout : float or None
+            Seconds after which an unchanged interval is logged anyway. If
+            None, intervals are only closed on a change of status.
+
+        clock : float, optional
+            Monotonic clock reading (seconds) matching `timestamp`.
+
+        debounce : int
+            Number of consecutive samples a new status must be observed in
+            before it is accepted as a change.
+        """
+        if debounce < 1:
+            raise ValueError('debounce must be at least 1.')
+        self._timeout = timeout
+        self._debounce = debounce
+        self.reset(timestamp, status, clock)
+
+    @property
+    def timestamp(self):
+        """
+        Start time of the open interval.
+        """
+        return self._timestamp
+
+    @property
+    def status(self):
+        """
+        Status of the open interval.
+        """
+        return self._status
+
+    @property
+    def pending(self):
+        """
+        Whether a change of status is waiting to be confirmed.
+        """
+        return self._pending is not None
+
+    def reset(self, timestamp, status, clock=None):
+        """
+        Discards the open interval and restarts tracking.
+
+        Parameters
+        ----------
+        timestamp : datetime.datetime
+            Start time of the new interval.
+
+        status : 4x2 numpy.ndarray
+            Status of the new interval.
+
+        clock : float, optional
+            Monotonic clock reading (seconds) matching `timestamp`.
+        """
+        self._timestamp = timestamp
+        self._status = status
+        self._clock = clock
+
+        # (timestamp, status, clock, count) of an unconfirmed change
+        self._pending = None
+
+    def _elapsed(self, timestamp, clock):
+        """
+        Seconds since the start of the open interval.
+        """
+        if clock is not None and self._clock is not None:
+            return clock - self._clock
+        return (timestamp - self._timestamp).total_seconds()
+
+    def update(self, timestamp, status, clock=None):
+        """
+        Records a new status sample.
+
+        Parameters
+        ----------
+        timestamp : datetime.datetime
+            Time at which the status was observed.
+
+        status : 4x2 numpy.ndarray
+            Observed status array.
+
+        clock : float, optional
+            Monotonic clock reading (seconds) matching `timestamp`.
+
+        Returns
+        -------
+        event : str or None
+            EVENT_CHANGE or EVENT_TIMEOUT if the open interval was closed,
+            None otherwise.
+
+        interval : 3-tuple or None
+            (starttime, endtime, status) of the closed interval, if any.
+        """
+        if (status == self._status).all():
+            self._pending = None
+            if (self._timeout is None or
+                    self._elapsed(timestamp, clock) <= self._timeout):
+                return None, None
+            interval = (self._timestamp, timestamp, self._status)
+            self.reset(timestamp, status, clock)
+            return EVENT_TIMEOUT, interval
+
+        #
+        # The change is dated from the first sample showing the new status,
+        # once enough consecutive samples agree on it.
+        #
+        if (self._pending is None or
+                ~(status == self._pending[1]).all()):
+            self._pending = (timestamp, status, clock, 0)
+        start, _, start_clock, count = self._pending
+        count += 1
+        if count < self._debounce:
+            self._pending = (start, status, start_clock, count)
+            return None, None
+
+        interval = (self._timestamp, start, self._status)
+        self.reset(start, status, start_clock)
+        return EVENT_CHANGE, interval
+
+    def fail(self, timestamp, clock=None):
+        """
+        Records a failure to obtain the status.
+
+        The open interval is discarded and tracking restarts at `timestamp`
+        from an all-zero status.
+
+        Parameters
+        ----------
+        timestamp : datetime.datetime
+            Time of the failed sample.
+
+        clock : float, optional
+            Monotonic clock reading (seconds) matching `timestamp`.
+        """
+        self.reset(timestamp, np.zeros_like(self._status), clock)
+
+    def close(self, timestamp, clock=None):
+        """
+        Closes the open interval.
+
+        Tracking continues from `timestamp` with the same status.
+
+        Parameters
+        ----------
+        timestamp : datetime.datetime
+            End time of the interval.
+
+        clock : float, optional
+            Monotonic clock reading (seconds) matching `timestamp`.
+
+        Returns
+        -------
+        3-tuple or None
+            (starttime, endtime, status) of the closed interval, or None if
+            it would be empty.
+        """
+        if timestamp <= self._timestamp:
+            return None
+        interval = (self._timestamp, timestamp, self._status)
+        self.reset(timestamp, self._status, clock)
+        return interval
@@ -1,6 +1,70 @@
 #!/usr/bin/env python
 
-from datetime import datetime
+import importlib
+import numbers
+import threading
+from datetime import datetime, timedelta, timezone
+
+class _LazyModule:
+    """
+    Stand-in for a module which is imported on first attribute access.
+
+    Once imported, the module's attributes are copied onto the stand-in so
+    later lookups are plain attribute reads.
+    """
+
+    def __init__(self, name):
+        self._lazy_name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._lazy_name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._lazy_name
+
+def lazy_import(name):
+    """
+    Defers importing a module until it is first used.
+
+    Used for heavy modules (numpy, OpenCV) so that entry points such as
+    `hvacmon --help` and the database tools start quickly.
+
+    Parameters
+    ----------
+    name : str
+        Name of the module.
+
+    Returns
+    -------
+    object
+        Stand-in for the module, usable as the module itself.
+    """
+    return _LazyModule(name)
+
+def preload(*names):
+    """
+    Imports modules on a background thread.
+
+    Lets slow imports overlap other startup work (e.g. waiting for the camera
+    to settle). Importing a module still being loaded in the background
+    simply waits for it to finish.
+
+    Parameters
+    ----------
+    names : str
+        Names of the modules.
+    """
+    def load():
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+    threading.Thread(target=load, name='preload', daemon=True).start()
+
+np = lazy_import('numpy')
 
 def get_timestamp(t = None):
     """
@@ -23,3 +87,157 @@ def get_timestamp(t = None):
         tzinfo=None).isoformat()
     
     return timestamp
+
+def parse_timestamp(s):
+    """
+    Parses an ISO8601 timestamp as produced by get_timestamp().
+
+    Only the fixed layout YYYY-MM-DDTHH:MM:SS[.ffffff][Z|+HH:MM|-HH:MM] is
+    accepted, which is much cheaper than a general purpose parser such as
+    dateutil.
+
+    Parameters
+    ----------
+    s : str
+        Timestamp to parse.
+
+    Returns
+    -------
+    datetime.datetime
+        Naive datetime in UTC (any UTC offset is applied).
+
+    Raises
+    ------
+    ValueError
+        If the string does not follow the expected layout.
+    """
+    if (len(s) < 19 or s[4] != '-' or s[7] != '-' or s[10] not in 'T ' or
+        s[13] != ':' or s[16] != ':'):
+        raise ValueError('Unsupported timestamp format: %s' % s)
+    t = datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                 int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+    i = 19
+    if i < len(s) and s[i] == '.':
+        j = i + 1
+        while j < len(s) and s[j].isdigit():
+            j += 1
+        t = t.replace(microsecond=int((s[i+1:j] + '000000')[:6]))
+        i = j
+
+    offset = s[i:]
+    if offset == '' or offset == 'Z':
+        return t
+    if len(offset) == 6 and offset[0] in '+-' and offset[3] == ':':
+        delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6]))
+        return t - delta if offset[0] == '+' else t + delta
+    raise ValueError('Unsupported timestamp format: %s' % s)
+
+def parse_timestamps(strings):
+    """
+    Parses a sequence of ISO8601 timestamps to milliseconds since the epoch.
+
+    Vectorized equivalent of `to_epoch_ms(parse_timestamp(s))` for every
+    string, accepting the same fixed layout. The date and time are parsed by
+    numpy and UTC offsets are applied with array arithmetic, so converting
+    large batches costs no per-string Python code.
+
+    Parameters
+    ----------
+    strings : sequence of str
+        Timestamps to parse.
+
+    Returns
+    -------
+    numpy.ndarray of int64
+        Milliseconds since 1970-01-01T00:00:00 UTC.
+
+    Raises
+    ------
+    ValueError
+        If any string does not follow the expected layout.
+    """
+    s = np.asarray(strings, dtype=str).ravel()
+    if len(s) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    #
+    # Work on the UCS4 code points, one row per string
+    #
+    width = s.dtype.itemsize // 4
+    codes = s.view(np.uint32).reshape(len(s), width).copy()
+    lengths = np.char.str_len(s)
+    if (width < 19 or (lengths < 19).any() or (codes[:, 4] != ord('-')).any()
+            or (codes[:, 7] != ord('-')).any()
+            or ((codes[:, 10] != ord('T')) & (codes[:, 10] != ord(' '))).any()
+            or (codes[:, 13] != ord(':')).any()
+            or (codes[:, 16] != ord(':')).any()):
+        raise ValueError('Unsupported timestamp format.')
+
+    #
+    # Split off 'Z' or +HH:MM/-HH:MM offsets
+    #
+    rows = np.arange(len(s))
+    def at(offset):
+        return codes[rows, np.clip(lengths + offset, 0, width - 1)]
+    sign = at(-6)
+    has_offset = ((lengths >= 25) & (at(-3) == ord(':')) &
+                  ((sign == ord('+')) | (sign == ord('-'))))
+    digits = [at(i).astype(np.int64) - ord('0') for i in (-5, -4, -2, -1)]
+    minutes = (digits[0]*10 + digits[1])*60 + digits[2]*10 + digits[3]
+    offsets = np.where(has_offset,
+                       np.where(sign == ord('+'), minutes, -minutes)*60000, 0)
+    ends = np.where(has_offset, lengths - 6,
+                    np.where(at(-1) == ord('Z'), lengths - 1, lengths))
+    codes[np.arange(width) >= ends[:, None]] = 0
+
+    try:
+        local = codes.view('U%d' % width).ravel().astype('datetime64[ms]')
+    except ValueError:
+        raise ValueError('Unsupported timestamp format.')
+    if np.isnat(local).any():
+        raise ValueError('Unsupported timestamp format.')
+    return local.astype(np.int64) - offsets
+
+EPOCH = datetime(1970, 1, 1)
+
+def to_epoch_ms(t):
+    """
+    Converts a timestamp to integer milliseconds since the UNIX epoch.
+
+    Parameters
+    ----------
+    t : datetime.datetime, str or int
+        Timestamp to convert. Naive datetimes (and ISO8601 strings without
+        an offset) are taken to be UTC. Integers (including numpy integers)
+        are taken to be epoch milliseconds already.
+
+    Returns
+    -------
+    int
+        Milliseconds since 1970-01-01T00:00:00 UTC.
+    """
+    if isinstance(t, numbers.Integral):
+        # A plain int, which sqlite3 can bind (unlike numpy integers)
+        return int(t)
+    if isinstance(t, str):
+        t = parse_timestamp(t)
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc).replace(tzinfo=None)
+    return (t - EPOCH) // timedelta(milliseconds=1)
+
+def from_epoch_ms(ms):
+    """
+    Converts milliseconds since the UNIX epoch to a datetime.
+
+    Parameters
+    ----------
+    ms : int
+        Milliseconds since 1970-01-01T00:00:00 UTC.
+
+    Returns
+    -------
+    datetime.datetime
+        Naive datetime in UTC.
+    """
+    return EPOCH + timedelta(milliseconds=int(ms))
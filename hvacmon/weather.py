@@ -1,16 +1,53 @@
 #!/usr/bin/env python
-import forecastio
-from hvacmon import util
+import datetime
+import json
+import os
+import threading
+import time
 
-class Weather:
+import hvacmon.metrics
+import hvacmon.util
+
+_FETCH_SECONDS = hvacmon.metrics.histogram(
+    'hvacmon_weather_fetch_seconds', 'Latency of weather provider requests')
+_FETCH_FAILURES = hvacmon.metrics.counter(
+    'hvacmon_weather_failures_total',
+    'Failed or timed out weather refreshes')
+
+class WeatherProvider:
     """
-    Helper for obtaining weather information through the DarkSky API.
+    Interface to a source of outdoor temperature readings.
 
     Methods
     -------
     get_temperature()
         Gets a current temperature reading.
     """
+
+    def get_temperature(self):
+        """
+        Gets a current temperature reading.
+
+        May block (e.g. on network requests) and raise on failure.
+
+        Returns
+        -------
+        datetime.datetime
+            Time of measurement (UTC).
+
+        float
+            Current temperature information (deg F).
+        """
+        raise NotImplementedError
+
+class DarkSkyProvider(WeatherProvider):
+    """
+    Provider obtaining weather information through the DarkSky API.
+
+    forecastio is imported on first use so this module can be used on
+    machines without it.
+    """
+
     def __init__(self, api_key, lat, lon):
         """
         Initializes the object.
@@ -30,6 +67,40 @@ class Weather:
         self._lat = lat
         self._lon = lon
 
+    def get_temperature(self):
+        import forecastio
+        forecast = forecastio.load_forecast(
+            self._api_key,
+            self._lat,
+            self._lon)
+        currently = forecast.currently()
+        temperature = currently.temperature
+
+        #
+        # Prefer the observation time reported by DarkSky (epoch seconds)
+        #
+        utime = getattr(currently, 'utime', None)
+        if utime is not None:
+            timestamp = datetime.datetime.utcfromtimestamp(int(utime))
+        else:
+            timestamp = datetime.datetime.utcnow()
+        return timestamp, temperature
+
+class Weather(DarkSkyProvider):
+    """
+    Helper for obtaining weather information through the DarkSky API.
+
+    Kept for backward compatibility: `get_temperature()` returns the time of
+    the call as an ISO8601 string (UTC) rather than the time of measurement
+    as a datetime. New code should use `DarkSkyProvider`, behind
+    `CachedWeather`.
+
+    Methods
+    -------
+    get_temperature()
+        Gets a current temperature reading.
+    """
+
     def get_temperature(self):
         """
         Gets current temperature information.
@@ -42,10 +113,220 @@ class Weather:
         float
             Current temperature information (deg F).
         """
-        forecast = forecastio.load_forecast(
-            self._api_key,
-            self._lat,
-            self._lon)
-        temperature = forecast.currently().temperature
-        timestamp = util.get_timestamp()
+        _, temperature = super().get_temperature()
+        timestamp = hvacmon.util.get_timestamp()
         return timestamp, temperature
+
+class FileProvider(WeatherProvider):
+    """
+    Provider reading the temperature from a local JSON file.
+
+    The file holds an object with a 'temperature' (deg F) and optionally a
+    'time' (ISO8601, UTC) of the reading. If no time is given, the time of
+    the last modification of the file is used. Intended for tests and for
+    feeding readings from another source.
+    """
+
+    def __init__(self, path):
+        """
+        Initializes the object.
+
+        Parameters
+        ----------
+        path : str
+            JSON file to read.
+        """
+        self._path = path
+
+    def get_temperature(self):
+        with open(self._path) as f:
+            reading = json.load(f)
+        if 'time' in reading:
+            timestamp = hvacmon.util.parse_timestamp(reading['time'])
+        else:
+            timestamp = datetime.datetime.utcfromtimestamp(
+                os.path.getmtime(self._path))
+        return timestamp, float(reading['temperature'])
+
+class CachedWeather:
+    """
+    Non-blocking cache in front of a weather provider.
+
+    `get_temperature()` always returns immediately with the last good
+    reading. When that reading is older than `max_age`, a refresh is started
+    on a background thread and the cached reading keeps being served until
+    it completes (stale-while-revalidate).
+
+    Failed refreshes are retried with exponential backoff. A refresh that
+    does not complete within `timeout` counts as failed; the hung call is
+    abandoned on its (daemon) thread.
+
+    If a cache file is given, the last good reading is persisted there and
+    reloaded on startup.
+
+    Methods
+    -------
+    __init__(provider, cache_file=None, max_age=900, timeout=30,
+             min_backoff=60, max_backoff=3600, clock=time.monotonic)
+        Initializes the cache, loading the cache file if it exists.
+    get_temperature()
+        Gets the last good temperature reading.
+    """
+
+    def __init__(self, provider, cache_file=None, max_age=900, timeout=30,
+                 min_backoff=60, max_backoff=3600, clock=time.monotonic):
+        """
+        Initializes the cache, loading the cache file if it exists.
+
+        Parameters
+        ----------
+        provider : WeatherProvider
+            Source of readings.
+
+        cache_file : str, optional
+            JSON file the last good reading is persisted to.
+
+        max_age : float
+            Seconds after which the cached reading is refreshed.
+
+        timeout : float
+            Seconds after which a refresh counts as failed.
+
+        min_backoff : float
+            Seconds to wait before retrying after the first failure. The wait
+            doubles with every consecutive failure.
+
+        max_backoff : float
+            Longest wait between retries, in seconds.
+
+        clock : callable
+            Monotonic clock (seconds) used for all scheduling.
+        """
+        self._provider = provider
+        self._cache_file = cache_file
+        self._max_age = max_age
+        self._timeout = timeout
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._reading = None
+        self._fetched = None
+        self._failures = 0
+        self._retry_at = None
+        self._inflight = None
+
+        if cache_file is not None and os.path.exists(cache_file):
+            self._load()
+
+    @property
+    def failures(self):
+        """
+        Number of consecutive failed refreshes.
+        """
+        return self._failures
+
+    def _load(self):
+        """
+        Loads the persisted reading. Its age is taken from its timestamp.
+        """
+        try:
+            with open(self._cache_file) as f:
+                cached = json.load(f)
+            timestamp = hvacmon.util.parse_timestamp(cached['time'])
+            temperature = float(cached['temperature'])
+        except (OSError, ValueError, KeyError) as e:
+            print("Ignoring unreadable weather cache %s: %r"
+                % (self._cache_file, e))
+            return
+        self._reading = (timestamp, temperature)
+        age = (datetime.datetime.utcnow() - timestamp).total_seconds()
+        self._fetched = self._clock() - max(age, 0)
+
+    def _save(self):
+        """
+        Persists the current reading (atomically replacing the cache file).
+        """
+        timestamp, temperature = self._reading
+        tmp = self._cache_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'time': hvacmon.util.get_timestamp(timestamp),
+                       'temperature': temperature}, f)
+        os.replace(tmp, self._cache_file)
+
+    def get_temperature(self):
+        """
+        Gets the last good temperature reading, starting a background refresh
+        if it is stale.
+
+        Returns
+        -------
+        2-tuple of (datetime.datetime, float) or None
+            Time of measurement (UTC) and temperature (deg F), or None if no
+            reading has been obtained yet.
+        """
+        with self._lock:
+            now = self._clock()
+            if self._inflight is not None:
+                thread, started = self._inflight
+                if now - started > self._timeout:
+                    print("Weather refresh timed out after %.0f s"
+                        % self._timeout)
+                    self._inflight = None
+                    self._failed(now)
+                    _FETCH_FAILURES.inc()
+            if (self._inflight is None and
+                    (self._fetched is None or
+                     now - self._fetched >= self._max_age) and
+                    (self._retry_at is None or now >= self._retry_at)):
+                thread = threading.Thread(
+                    target=self._refresh, name='weather', daemon=True)
+                self._inflight = (thread, now)
+                thread.start()
+            return self._reading
+
+    def _failed(self, now):
+        """
+        Schedules the next retry after a failure (lock held).
+        """
+        backoff = min(self._max_backoff,
+                      self._min_backoff*2**self._failures)
+        self._failures += 1
+        self._retry_at = now + backoff
+
+    def _refresh(self):
+        """
+        Fetches a new reading (runs on a background thread).
+        """
+        me = threading.current_thread()
+        start = time.monotonic()
+        try:
+            reading = self._provider.get_temperature()
+        except Exception as e:
+            _FETCH_FAILURES.inc()
+            with self._lock:
+                if self._inflight is not None and self._inflight[0] is me:
+                    self._inflight = None
+                    print("Unable to get weather, retrying in %.0f s: %r"
+                        % (min(self._max_backoff,
+                               self._min_backoff*2**self._failures), e))
+                    self._failed(self._clock())
+            return
+        _FETCH_SECONDS.observe(time.monotonic() - start)
+
+        with self._lock:
+            # A late reading from a timed out refresh is still good
+            if self._inflight is not None and self._inflight[0] is me:
+                self._inflight = None
+            if self._reading is not None and reading[0] < self._reading[0]:
+                return
+            self._reading = reading
+            self._fetched = self._clock()
+            self._failures = 0
+            self._retry_at = None
+            if self._cache_file is not None:
+                try:
+                    self._save()
+                except OSError as e:
+                    print("Unable to write weather cache: %r" % e)
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+from hvacmon import camera, imgproc
+
+def make_frames(n):
+    return [np.full((720,1280,3), i, dtype=np.uint8) for i in range(n)]
+
+def test_persistent_opens_once():
+    backend = camera.FakeCameraBackend(make_frames(3))
+    cam = camera.Camera(90, persistent=True, backend=backend)
+    for i in range(5):
+        timestamp, im = cam.get_frame()
+        assert (im == i % 3).all()
+    assert backend.open_count == 1
+    assert backend.configure_count == 1
+    assert backend.settings['rotation'] == 90
+    cam.close()
+
+def test_oneshot_opens_per_frame():
+    backend = camera.FakeCameraBackend(make_frames(1))
+    cam = camera.Camera(backend=backend)
+    for i in range(3):
+        cam.get_frame()
+    assert backend.open_count == 3
+    assert backend.configure_count == 3
+
+class FlakyBackend(camera.FakeCameraBackend):
+    def __init__(self, frames, fail_on):
+        super().__init__(frames)
+        self._fail_on = fail_on
+        self._captures = 0
+
+    def capture(self):
+        self._captures += 1
+        if self._captures == self._fail_on:
+            raise IOError('Capture failed')
+        return super().capture()
+
+def test_persistent_reopens_after_failure():
+    backend = FlakyBackend(make_frames(1), fail_on=2)
+    with camera.Camera(persistent=True, backend=backend) as cam:
+        cam.get_frame()
+        with pytest.raises(IOError):
+            cam.get_frame()
+        cam.get_frame()
+    assert backend.open_count == 2
+
+def test_roi_capture():
+    frame = np.zeros((720,1280,3), dtype=np.uint8)
+    frame[200:210,700:710] = 255
+    roi = imgproc.Roi(170, 330, 630, 755)
+    backend = camera.FakeCameraBackend([frame])
+    cam = camera.Camera(backend=backend, roi=roi)
+    timestamp, im = cam.get_frame()
+    assert backend.settings['resolution'] == (125, 160)
+    assert im.shape[:2] == roi.shape
+    assert (im == roi.crop(frame)).all()
+
+def test_exposure_control():
+    backend = camera.FakeCameraBackend(make_frames(1))
+    with camera.Camera(persistent=True, backend=backend) as cam:
+        cam.get_frame()
+        initial = backend.settings['shutter_speed']
+        control = camera.ExposureControl(cam, holdoff=2)
+
+        # Saturated LEDs shorten the exposure, after the holdoff
+        assert control.observe(255) is None
+        shutter = control.observe(255)
+        assert shutter is not None and shutter < initial
+        assert backend.settings['shutter_speed'] == shutter
+
+        # Nothing changes within the target band
+        control = camera.ExposureControl(cam, holdoff=1, smoothing=1)
+        assert control.observe(200) is None
+
+def test_frame_ring():
+    ring = camera.FrameRing(size=2)
+    ring.resize((40, 20))
+    ring.advance()
+    # Rows are padded to 64 pixels and the frame to 32 rows by the imager
+    data = np.arange(32*64*3, dtype=np.uint32).astype(np.uint8)
+    for chunk in np.split(data, 4):
+        assert ring.write(chunk.tobytes()) == len(chunk)
+    frame = ring.frame()
+    assert frame.shape == (20, 40, 3)
+    assert (frame == data.reshape(32, 64, 3)[:20, :40]).all()
+
+    # Buffers are reused in turn
+    ring.advance()
+    ring.advance()
+    assert ring.frame().base is frame.base
+
+def test_luma_frames():
+    frame = np.zeros((720,1280,3), dtype=np.uint8)
+    frame[10,20] = (0, 255, 0)
+    backend = camera.FakeCameraBackend([frame], format=camera.FORMAT_YUV)
+    with camera.Camera(persistent=True, backend=backend) as cam:
+        timestamp, im = cam.get_frame()
+    assert im.shape == (720, 1280)
+    assert im[10,20] > 128 and im[0,0] == 0
@@ -0,0 +1,84 @@
+import datetime
+import h5py
+import numpy as np
+from hvacmon import dataset
+from hvacmon.imgproc import Roi
+
+def frame(i):
+    return np.full((72, 128, 3), i, dtype=np.uint8)
+
+def test_append_and_iterate(tmpdir):
+    filename = str(tmpdir.join('data.h5'))
+    t0 = datetime.datetime(2020, 1, 1)
+    status = np.eye(4, 2, dtype=np.uint8)
+    with dataset.FrameDataset(filename, 'a') as data:
+        for i in range(3):
+            data.append('annotated', 'im%d' % i, frame(i), status,
+                        t0 + datetime.timedelta(seconds=i))
+        data.append('errors', 'bad', frame(9), status)
+
+    # Appending after reopening grows the same datasets
+    with dataset.FrameDataset(filename, 'a') as data:
+        data.append('annotated', 'im3', frame(3), status)
+
+    with h5py.File(filename, 'r') as f:
+        frames = f['annotated/frames']
+        assert frames.shape == (4, 72, 128, 3)
+        assert frames.chunks == (1, 72, 128, 3)
+        assert frames.compression == 'gzip'
+
+    with dataset.FrameDataset(filename) as data:
+        assert sorted(data.groups()) == ['annotated', 'errors']
+        assert len(data) == 5
+        assert data.names('annotated') == ['im0', 'im1', 'im2', 'im3']
+        frames = list(data.iter_frames('annotated', start=1))
+        assert [f[0] for f in frames] == ['im1', 'im2', 'im3']
+        assert frames[0][1] == t0 + datetime.timedelta(seconds=1)
+        assert frames[2][1] is None
+        assert (frames[1][2] == 2).all()
+        assert (frames[1][3] == status).all()
+        assert (data.read('errors', 'bad')[2] == 9).all()
+
+def test_roi(tmpdir):
+    filename = str(tmpdir.join('data.h5'))
+    roi = Roi(10, 20, 30, 50)
+    im = np.random.randint(0, 255, (72, 128, 3), dtype=np.uint8)
+    with dataset.FrameDataset(filename, 'a', roi) as data:
+        data.append('annotated', 'a', im, np.zeros((4, 2)))
+        data.append('annotated', 'b', roi.crop(im), np.zeros((4, 2)))
+    with dataset.FrameDataset(filename) as data:
+        assert data.roi('annotated') == roi
+        for _, _, saved, _ in data.iter_frames('annotated'):
+            assert (saved == roi.crop(im)).all()
+
+def test_legacy_layout(tmpdir):
+    filename = str(tmpdir.join('legacy.h5'))
+    status = np.ones((4, 2), dtype=np.uint8)
+    with h5py.File(filename, 'a') as f:
+        dset = f.require_group('annotated').create_dataset('old', data=frame(1))
+        dset.attrs.create('status', status, dtype=np.uint8)
+
+    with dataset.FrameDataset(filename, 'a') as data:
+        data.append('annotated', 'new', frame(2), status)
+        assert data.names('annotated') == ['new', 'old']
+        name, timestamp, im, saved = data.read('annotated', 'old')
+        assert timestamp is None
+        assert (im == 1).all()
+        assert (saved == status).all()
+        assert [f[0] for f in data.iter_frames('annotated')] == ['new', 'old']
+
+def test_legacy_layout_roi(tmpdir):
+    filename = str(tmpdir.join('legacy.h5'))
+    roi = Roi(10, 20, 30, 50)
+    status = np.ones((4, 2), dtype=np.uint8)
+    with h5py.File(filename, 'a') as f:
+        dset = f.require_group('annotated').create_dataset('old', data=frame(1))
+        dset.attrs.create('status', status, dtype=np.uint8)
+
+    with dataset.FrameDataset(filename, 'a', roi) as data:
+        data.append('annotated', 'a', frame(2), status)
+        data.append('annotated', 'b', frame(3), status)
+        assert data.roi('annotated') == roi
+        assert data.read('annotated', 'a')[2].shape == roi.shape + (3,)
+        assert (data.read('annotated', 'b')[2] == 3).all()
+        assert data.read('annotated', 'old')[2].shape == (72, 128, 3)
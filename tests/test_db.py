@@ -0,0 +1,219 @@
+import sqlite3
+import time
+import numpy as np
+import pytest
+from hvacmon import db, util
+
+def count_rows(path, table):
+    with sqlite3.connect(str(path)) as conn:
+        return conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+def test_append_many(tmp_path):
+    database = db.Database(str(tmp_path))
+    status = np.eye(4, 2, dtype=np.uint8)
+    database.append_zone_data_many(
+        ('2019-01-01T00:00:%02d' % i, '2019-01-01T00:00:%02d' % (i + 1),
+         status) for i in range(10))
+    database.append_temperature_data_many(
+        [('2019-01-01T00:00:00', 40.0), ('2019-01-01T00:15:00', 41.5)])
+    database.close()
+
+    assert count_rows(tmp_path / 'hvacmon.db', 'zone_readings') == 10
+    assert count_rows(tmp_path / 'hvacmon.db', 'temperature_readings') == 2
+
+def test_buffered_writes(tmp_path):
+    database = db.Database(str(tmp_path), buffer_size=3)
+    status = np.zeros((4,2))
+    for i in range(2):
+        database.append_zone_data(
+            '2019-01-01T00:00:00', '2019-01-01T00:00:05', status)
+    assert count_rows(tmp_path / 'hvacmon.db', 'zone_readings') == 0
+
+    database.append_temperature_data('2019-01-01T00:00:00', 40.0)
+    assert count_rows(tmp_path / 'hvacmon.db', 'zone_readings') == 2
+
+    database.append_zone_data(
+        '2019-01-01T00:00:05', '2019-01-01T00:00:10', status)
+    database.close()
+    assert count_rows(tmp_path / 'hvacmon.db', 'zone_readings') == 3
+
+def test_failed_flush(tmp_path):
+    database = db.Database(str(tmp_path), buffer_size=10, flush_interval=0.05)
+    status = np.zeros((4,2))
+    database.append_zone_data(0, 5000, status)
+
+    # A lock held by another connection makes the flush fail
+    database._db.execute('PRAGMA busy_timeout = 0')
+    other = sqlite3.connect(str(tmp_path / 'hvacmon.db'))
+    other.execute('BEGIN IMMEDIATE')
+    with pytest.raises(sqlite3.OperationalError):
+        database.flush()
+    other.rollback()
+    other.close()
+
+    # The rows are still buffered and flushed once the interval passed
+    database.append_zone_data(5000, 10000, status)
+    database.flush_if_due()
+    assert count_rows(tmp_path / 'hvacmon.db', 'zone_readings') == 0
+    time.sleep(0.05)
+    database.flush_if_due()
+    assert count_rows(tmp_path / 'hvacmon.db', 'zone_readings') == 2
+    database.close()
+
+def test_pack_status():
+    status = np.array([[1,0],[0,1],[1,1],[0,0]], dtype=np.uint8)
+    mask = db.pack_status(status)
+    assert mask == 0b00111001
+    assert (db.unpack_status(mask) == status).all()
+    assert db.unpack_status([mask, 0]).shape == (2,4,2)
+
+def test_migrate_legacy(tmp_path):
+    with sqlite3.connect(str(tmp_path / 'hvacmon.db')) as conn:
+        conn.execute('''
+            CREATE TABLE "zone_readings"(
+                starttime TEXT, endtime TEXT,
+                one_call INTEGER, one_valve INTEGER,
+                two_call INTEGER, two_valve INTEGER,
+                three_call INTEGER, three_valve INTEGER,
+                four_call INTEGER, four_valve INTEGER)''')
+        conn.execute('''
+            CREATE TABLE "temperature_readings"(
+                timestamp TEXT, temperature REAL)''')
+        conn.execute('''
+            INSERT INTO zone_readings VALUES(
+                '2019-01-01T00:00:00.250000', '2019-01-01T00:01:00',
+                1, 0, 0, 1, 1, 1, 0, 0)''')
+        conn.execute('''
+            INSERT INTO temperature_readings VALUES(
+                '2019-01-01T00:00:00-05:00', 12.5)''')
+
+    db.Database(str(tmp_path)).close()
+
+    with sqlite3.connect(str(tmp_path / 'hvacmon.db')) as conn:
+        zone_rows = conn.execute(
+            'SELECT starttime, endtime, status FROM zone_readings').fetchall()
+        temperature_rows = conn.execute(
+            'SELECT * FROM temperature_readings').fetchall()
+    assert zone_rows == [(1546300800250, 1546300860000, 0b00111001)]
+    assert temperature_rows == [(1546318800000, 12.5)]
+
+def test_queries(tmp_path):
+    database = db.Database(str(tmp_path))
+    on = np.zeros((4,2), dtype=np.uint8)
+    on[1] = 1
+    off = np.zeros((4,2), dtype=np.uint8)
+
+    #
+    # Zone two runs for the first 45 minutes of each 90 minute cycle
+    #
+    rows = []
+    for cycle in range(4):
+        t = cycle*90*60*1000
+        rows.append((t, t + 45*60*1000, on))
+        rows.append((t + 45*60*1000, t + 90*60*1000, off))
+    database.append_zone_data_many(rows)
+    database.append_temperature_data_many(
+        [(0, 30.0), (30*60*1000, 32.0), (5*3600*1000, 40.0)])
+
+    starttimes, endtimes, status = database.get_zone_data(
+        10*60*1000, 100*60*1000)
+    assert len(starttimes) == 3
+    assert starttimes[0] == np.datetime64(0, 'ms')
+    assert (status[1] == off).all()
+
+    periods, duty, observed = database.get_duty_cycle(0, 6*3600*1000)
+    assert len(periods) == 6
+    assert (observed == 3600).all()
+    assert np.allclose(duty[:,1,0], [0.75, 0.5, 0.25, 0.75, 0.5, 0.25])
+    assert (duty[:,0] == 0).all()
+
+    periods, duty, observed = database.get_duty_cycle(
+        0, 6*3600*1000, period='day')
+    assert len(periods) == 1
+    assert np.allclose(duty[0,1], 0.5)
+
+    periods, temperature, duty = database.get_runtime_vs_temperature(
+        0, 6*3600*1000)
+    assert (periods == np.array([0, 5*3600*1000], dtype='datetime64[ms]')).all()
+    assert np.allclose(temperature, [31.0, 40.0])
+    assert np.allclose(duty[:,1,1], [0.75, 0.25])
+    database.close()
+
+def test_panels(tmp_path):
+    database = db.Database(str(tmp_path))
+    status = np.ones((6,2), dtype=np.uint8)
+    database.append_zone_data(0, 3600*1000, np.eye(4, 2))
+    database.append_zone_data_many([(0, 1800*1000, status)], panel='south')
+
+    starttimes, _, zoneinfo = database.get_zone_data(
+        0, 3600*1000, panel='south', zones=6)
+    assert len(starttimes) == 1
+    assert (zoneinfo[0] == status).all()
+
+    periods, duty, observed = database.get_duty_cycle(
+        0, 3600*1000, panel='south', zones=6)
+    assert duty.shape == (1,6,2)
+    assert (duty == 1).all()
+    assert observed[0] == 1800
+
+    periods, duty, observed = database.get_duty_cycle(0, 3600*1000)
+    assert (duty[0] == np.eye(4, 2)).all()
+    assert observed[0] == 3600
+    database.close()
+
+def test_migrate_v2(tmp_path):
+    path = str(tmp_path / 'hvacmon.db')
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('''
+            CREATE TABLE zone_readings(starttime INTEGER NOT NULL,
+                endtime INTEGER NOT NULL, status INTEGER NOT NULL)''')
+        conn.execute('''
+            CREATE INDEX zone_readings_starttime ON zone_readings(starttime)''')
+        conn.execute('''
+            CREATE TABLE temperature_readings(timestamp INTEGER NOT NULL,
+                temperature REAL)''')
+        conn.execute('''
+            CREATE TABLE zone_rollup(hour INTEGER NOT NULL,
+                bit INTEGER NOT NULL, duration INTEGER NOT NULL,
+                PRIMARY KEY(hour, bit)) WITHOUT ROWID''')
+        # Half an hour of zone one calling, and a stale rollup
+        conn.execute('INSERT INTO zone_readings VALUES(0, 1800000, 1)')
+        conn.execute('INSERT INTO zone_rollup VALUES(0, 0, 3600000)')
+        conn.execute('PRAGMA user_version = 2')
+    conn.close()
+
+    # The rollup is rebuilt from the readings, keyed by the default panel
+    calling = np.zeros((4, 2))
+    calling[0, 0] = 1
+    database = db.Database(str(tmp_path))
+    starttimes, _, zoneinfo = database.get_zone_data(0, 3600*1000)
+    assert len(starttimes) == 1
+    assert (zoneinfo[0] == calling).all()
+    periods, duty, observed = database.get_duty_cycle(0, 3600*1000)
+    assert (duty[0] == calling).all()
+    assert observed[0] == 1800
+    database.close()
+
+    conn = sqlite3.connect(path)
+    assert conn.execute('''
+        SELECT panel, hour, bit, duration FROM zone_rollup
+        ORDER BY bit''').fetchall() == [
+        ('', 0, -1, 1800000), ('', 0, 0, 1800000)]
+    conn.close()
+
+def test_processed_files(tmp_path):
+    database = db.Database(str(tmp_path))
+    assert database.get_processed_state() is None
+    status = np.eye(4, 2, dtype=np.uint8)
+    database.append_processed_files(
+        [('a.png', 1.5, 'ok'), ('b.png', 2.0, 'No LEDs segmented')],
+        [(0, 5000, status)], (5000, status, 10000))
+
+    assert database.get_processed_files() == {
+        'a.png': (1.5, 'ok'), 'b.png': (2.0, 'No LEDs segmented')}
+    starttime, zoneinfo, lasttime = database.get_processed_state()
+    assert util.to_epoch_ms(lasttime) == 10000
+    assert (zoneinfo == status).all()
+    assert count_rows(str(tmp_path / 'hvacmon.db'), 'zone_readings') == 1
+    database.close()
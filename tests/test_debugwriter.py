@@ -0,0 +1,57 @@
+import os
+import time
+import cv2
+import numpy as np
+from hvacmon import dataset, debugwriter
+from hvacmon.imgproc import Roi
+
+def test_png_roi(tmpdir):
+    im = np.random.randint(0, 255, (720, 1280, 3), dtype=np.uint8)
+    writer = debugwriter.DebugWriter(str(tmpdir), roi=Roi(10, 20, 30, 50))
+    assert writer.submit(debugwriter.FAILURES, 'a', im)
+    writer.close()
+    files = os.listdir(str(tmpdir.join('failures')))
+    assert files == ['a.png']
+    saved = cv2.imread(str(tmpdir.join('failures', 'a.png')))
+    assert (saved == im[10:20, 30:50]).all()
+
+def test_archives(tmpdir):
+    status = np.eye(4, 2, dtype=np.uint8)
+    for fmt in ('h5', 'npz'):
+        outdir = tmpdir.mkdir(fmt)
+        writer = debugwriter.DebugWriter(str(outdir), fmt, archive_size=2)
+        for i in range(3):
+            writer.submit(debugwriter.STATE_CHANGE, 'im%d' % i,
+                          np.full((4, 4, 3), i, dtype=np.uint8), status)
+        writer.close()
+        path = outdir.join('statechange')
+        assert sorted(os.listdir(str(path))) == ['im0.' + fmt, 'im2.' + fmt]
+
+    filename = str(tmpdir.join('h5', 'statechange', 'im0.h5'))
+    with dataset.FrameDataset(filename) as f:
+        assert f.names('annotated') == ['im0', 'im1']
+        name, _, im, saved_status = f.read('annotated', 'im1')
+        assert (im == 1).all()
+        assert (saved_status == status).all()
+    with np.load(str(tmpdir.join('npz', 'statechange', 'im0.npz'))) as f:
+        assert (f['annotated/im1'] == 1).all()
+        assert (f['annotated/im1/status'] == status).all()
+
+def test_archive_failure_zones(tmpdir):
+    writer = debugwriter.DebugWriter(str(tmpdir), 'h5', zones=6)
+    writer.submit(debugwriter.FAILURES, 'bad', np.zeros((4, 4, 3), np.uint8))
+    writer.close()
+    filename = str(tmpdir.join('failures', 'bad.h5'))
+    with dataset.FrameDataset(filename) as f:
+        _, _, _, status = f.read(f.groups()[0], 'bad')
+        assert status.shape == (6, 2)
+
+def test_retention(tmpdir):
+    writer = debugwriter.DebugWriter(str(tmpdir), max_age=50)
+    path = tmpdir.join('timeouts')
+    old = path.join('old.png')
+    old.write('x')
+    os.utime(str(old), (time.time() - 100,)*2)
+    writer.submit(debugwriter.TIMEOUTS, 'new', np.zeros((4, 4, 3), np.uint8))
+    writer.close()
+    assert os.listdir(str(path)) == ['new.png']
@@ -0,0 +1,58 @@
+import datetime
+import numpy as np
+from hvacmon import db, history
+
+on = np.eye(4, 2, dtype=np.uint8)
+off = np.zeros((4,2), dtype=np.uint8)
+
+def test_runs_and_current():
+    h = history.StateHistory(capacity=3)
+    h.append(0, 1000, off)
+    h.append(1000, 2000, on)
+    h.append(2000, 3000, on)
+    h.update(3000, 3500, on)
+
+    status, since, until = h.current()
+    assert (status == on).all()
+    assert since == datetime.datetime(1970, 1, 1, 0, 0, 1)
+    assert until == datetime.datetime(1970, 1, 1, 0, 0, 3, 500000)
+
+    # The ring keeps the latest runs, merged
+    for i in range(3, 8):
+        h.append(i*1000, (i + 1)*1000, on if i % 2 else off)
+    starttimes, endtimes, status = h.runs(since=0)
+    assert len(starttimes) == 3
+    assert endtimes[-1] == np.datetime64(8000, 'ms')
+    assert (status[-1] == on).all()
+
+def test_journal_replay(tmp_path):
+    journal = str(tmp_path / 'history.journal')
+    database = db.Database(str(tmp_path))
+
+    h = history.StateHistory(journal)
+    h.append(0, 1000, off)
+    h.compact(database)
+    h.append(1000, 2000, on)
+    h.update(2000, 2500, off)
+    h.sync()
+    h.update(2000, 4000, off)
+    # Crash without syncing, leaving a torn record behind
+    with open(journal, 'ab') as f:
+        f.write(b'\x01\x02')
+
+    h = history.StateHistory(journal)
+    start, end, status = h.open_run
+    assert end == datetime.datetime(1970, 1, 1, 0, 0, 2, 500000)
+    assert (status == off).all()
+
+    # Compacting again after a crash between storing and rewriting the
+    # journal does not duplicate readings
+    h.compact(database)
+    h = history.StateHistory(journal)
+    h.append(0, 1000, off)
+    h.compact(database)
+    starttimes, _, status = database.get_zone_data(0, 10000)
+    assert len(starttimes) == 2
+    assert (status[1] == on).all()
+    h.close()
+    database.close()
@@ -1,21 +1,85 @@
 import cv2
-import h5py
 import numpy as np
 from os import listdir
 import pytest
-from hvacmon import imgproc
+from hvacmon import dataset, imgproc
 
-def test_eval(test_dset):
-    with h5py.File('data/hvacmon_data.h5', 'r') as f:
-        g = f['annotated']
-        im = g[test_dset][:]
-        annotated_status = g[test_dset].attrs['status']
+DATA_FILE = 'data/hvacmon_data.h5'
+
+@pytest.fixture(scope='module')
+def data():
+    with dataset.FrameDataset(DATA_FILE) as data:
+        yield data
+
+def test_eval(data, test_dset):
+    _, _, im, annotated_status = data.read('annotated', test_dset)
 
     status = imgproc.parse_image(im)
     assert (status == annotated_status).all()
 
+def test_eval_calibrated(data):
+    calibration = imgproc.LedCalibration()
+    for _ in range(2):
+        for _, _, im, annotated_status in data.iter_frames('annotated'):
+            status = imgproc.parse_image(im, calibration=calibration)
+            assert (status == annotated_status).all()
+
+def test_parse_images(data):
+    ims = [im for _, _, im, _ in data.iter_frames('annotated')]
+    annotated_status = np.array(
+        [status for _, _, _, status in data.iter_frames('annotated')])
+
+    status, errors = imgproc.parse_images(np.stack(ims))
+    assert (errors == imgproc.PARSE_OK).all()
+    assert (status == annotated_status).all()
+
+    #
+    # A bad frame is reported without affecting the rest of the batch
+    #
+    ims[0] = None
+    status, errors = imgproc.parse_images(iter(ims), batch_size=4)
+    assert errors[0] == imgproc.PARSE_INVALID_FRAME
+    assert (errors[1:] == imgproc.PARSE_OK).all()
+    assert (status[1:] == annotated_status[1:]).all()
+
+def test_parse_cropped(data):
+    _, _, im, annotated_status = next(data.iter_frames('annotated'))
+    cropped = imgproc.DEFAULT_ROI.crop(im)
+    assert (imgproc.parse_image(cropped, roi=None) == annotated_status).all()
+    with pytest.raises(imgproc.ParseError) as e:
+        imgproc.parse_image(cropped)
+    assert e.value.code == imgproc.PARSE_INVALID_FRAME
+
+def test_adaptive_threshold(data):
+    parser = imgproc.LedParser(threshold=None)
+    for _, _, im, annotated_status in data.iter_frames('annotated'):
+        dim = (im * 0.25).astype(np.uint8)
+        status = parser.parse(dim)
+        assert (status == annotated_status).all()
+        assert parser.last_threshold < imgproc.THRESHOLD
+
+def test_luma(data):
+    parser = imgproc.LedParser()
+    for _, _, im, annotated_status in data.iter_frames('annotated'):
+        luma = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+        assert (parser.parse(luma) == annotated_status).all()
+
+def test_change_detector(data):
+    frames = data.iter_frames('annotated')
+    _, _, first, first_status = next(frames)
+    detector = imgproc.ChangeDetector()
+    assert detector.changed(first)
+    detector.reset(first)
+    assert not detector.changed(first.copy())
+    for _, _, im, status in frames:
+        if (status != first_status).any():
+            assert detector.changed(im)
+    detector.invalidate()
+    assert detector.changed(first)
+
 def pytest_generate_tests(metafunc):
-    with h5py.File('data/hvacmon_data.h5', 'r') as f:
-        g = f['annotated']
-        dsets = list(g.keys())
-    metafunc.parametrize("test_dset", dsets)
\ No newline at end of file
+    if 'test_dset' not in metafunc.fixturenames:
+        return
+    with dataset.FrameDataset(DATA_FILE) as data:
+        dsets = data.names('annotated')
+    metafunc.parametrize("test_dset", dsets)
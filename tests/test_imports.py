@@ -0,0 +1,68 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#
+# Seconds allowed for importing the service and database modules (on top of
+# interpreter startup). numpy and OpenCV alone take several times this.
+#
+IMPORT_BUDGET = 0.5
+
+HEAVY_MODULES = ('numpy', 'cv2', 'h5py', 'forecastio', 'picamera',
+                 'http.server')
+
+def run_python(code):
+    output = subprocess.check_output(
+        [sys.executable, '-c', code], cwd=ROOT, universal_newlines=True)
+    return json.loads(output.splitlines()[-1])
+
+def test_import_budget():
+    result = run_python('''
+import json, sys, time
+start = time.perf_counter()
+import hvacmon.service, hvacmon.db
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': list(sys.modules)}))
+''')
+    assert not set(HEAVY_MODULES) & set(result['modules'])
+    assert result['elapsed'] < IMPORT_BUDGET
+
+def test_help_is_light():
+    result = run_python('''
+import contextlib, io, json, runpy, sys
+sys.argv = ['hvacmon', '--help']
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        runpy.run_module('hvacmon', run_name='__main__')
+    except SystemExit:
+        pass
+print(json.dumps({'modules': list(sys.modules)}))
+''')
+    assert not set(HEAVY_MODULES) & set(result['modules'])
+
+def test_scripts_help_is_light():
+    for script in ('hvacmon-postprocess', 'hvacmon-local-to-utc',
+                   'hvacmon-annotate', 'hvacmon-vacuum'):
+        result = run_python('''
+import contextlib, io, json, runpy, sys, time
+sys.argv = [%r, '--help']
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        runpy.run_path(%r, run_name='__main__')
+    except SystemExit:
+        pass
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': list(sys.modules)}))
+''' % (script, os.path.join('bin', script)))
+        assert not set(HEAVY_MODULES) & set(result['modules']), script
+        assert result['elapsed'] < IMPORT_BUDGET, script
+
+def test_lazy_import():
+    from hvacmon import util
+    lazy = util.lazy_import('json')
+    assert lazy.loads('[1]') == [1]
+    assert lazy.dumps is json.dumps
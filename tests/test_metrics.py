@@ -0,0 +1,43 @@
+import json
+import urllib.request
+from hvacmon import metrics
+
+def test_render():
+    registry = metrics.Registry()
+    h = registry.histogram('t_seconds', 'Test', buckets=(0.1, 1),
+                           labels={'stage': 'a'})
+    for value in (0.05, 0.5, 0.5, 5):
+        h.observe(value)
+    c = registry.counter('t_failures_total', 'Failures', label='reason')
+    c.inc('no "leds"')
+    c.inc('no "leds"')
+    assert registry.histogram('t_seconds', 'Test',
+                              labels={'stage': 'a'}) is h
+
+    lines = registry.render().splitlines()
+    assert 't_seconds_bucket{le="0.1",stage="a"} 1.0' in lines
+    assert 't_seconds_bucket{le="1.0",stage="a"} 3.0' in lines
+    assert 't_seconds_bucket{le="+Inf",stage="a"} 4.0' in lines
+    assert 't_seconds_count{stage="a"} 4.0' in lines
+    assert 't_failures_total{reason="no \\"leds\\""} 2.0' in lines
+    assert '# TYPE t_failures_total counter' in lines
+
+    snapshot = registry.snapshot()
+    assert snapshot['t_seconds{stage="a"}']['p50'] == 0.5
+    assert snapshot['t_failures_total'] == {'no "leds"': 2}
+
+def test_server_and_stats_file(tmpdir):
+    registry = metrics.Registry()
+    registry.counter('t_total', 'Test').inc()
+    server = metrics.MetricsServer(0, registry=registry)
+    try:
+        url = 'http://127.0.0.1:%d/metrics' % server.port
+        body = urllib.request.urlopen(url).read().decode()
+    finally:
+        server.close()
+    assert 't_total 1.0' in body.splitlines()
+
+    filename = str(tmpdir.join('stats.json'))
+    registry.write(filename)
+    with open(filename) as f:
+        assert json.load(f)['metrics'] == {'t_total': 1}
@@ -0,0 +1,68 @@
+import queue
+import threading
+import time
+import pytest
+from hvacmon import pipeline
+
+def test_call_with_timeout():
+    assert pipeline.call_with_timeout(lambda x: x + 1, 1, 1) == 2
+    with pytest.raises(TimeoutError):
+        pipeline.call_with_timeout(time.sleep, 0.05, 1)
+    with pytest.raises(ValueError):
+        pipeline.call_with_timeout(int, 1, 'x')
+
+def test_pipeline_drains_on_stop():
+    items = queue.Queue(maxsize=4)
+    results = queue.Queue()
+    ticks = []
+
+    def tick():
+        ticks.append(time.monotonic())
+        items.put(len(ticks))
+
+    p = pipeline.Pipeline()
+    p.add_ticker('tick', 0.02, tick)
+    p.add_stage('double', lambda x: 2*x, items, outbox=results)
+    p.start()
+    time.sleep(0.2)
+    p.stop()
+
+    assert len(ticks) >= 5
+    out = [results.get_nowait() for _ in range(results.qsize())]
+    assert out == [2*(i + 1) for i in range(len(ticks))]
+
+def test_pipeline_drains_stages_in_order():
+    items = queue.Queue(maxsize=4)
+    writes = queue.Queue(maxsize=4)
+    written = []
+
+    def slow_parse(x):
+        time.sleep(0.05)
+        return x
+
+    p = pipeline.Pipeline()
+    p.add_stage('parse', slow_parse, items, outbox=writes)
+    p.add_stage('db', written.append, writes)
+    p.start()
+    for i in range(3):
+        items.put(i)
+    p.stop()
+
+    # The db stage outlives the parse stage and stores its last results
+    assert written == [0, 1, 2]
+
+def test_ticker_skips_missed_ticks():
+    stop = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(time.monotonic())
+        time.sleep(0.05)
+
+    ticker = pipeline.Ticker('slow', 0.02, slow, stop)
+    ticker.start()
+    time.sleep(0.2)
+    stop.set()
+    ticker.join()
+    assert ticker.missed > 0
+    assert len(calls) <= 5
@@ -0,0 +1,85 @@
+import os
+import shutil
+import sqlite3
+import numpy as np
+from hvacmon import db, retention
+
+H = db.MS_PER_HOUR
+on = np.eye(4, 2, dtype=np.uint8)
+off = np.zeros((4,2), dtype=np.uint8)
+
+def test_retention(tmp_path):
+    database = db.Database(str(tmp_path))
+    # Readings logged every minute for 3 days, changing state every hour
+    minutes = 3*24*60
+    database.append_zone_data_many(
+        (i*60000, (i + 1)*60000, on if (i // 60) % 2 else off)
+        for i in range(minutes))
+    database.append_temperature_data_many(
+        (i*15*60000 + 1, float(i % 4)) for i in range(3*24*4))
+    now = minutes*60000
+    _, duty, _ = database.get_duty_cycle(0, now, period='day')
+
+    policy = retention.Retention(
+        str(tmp_path), merge_after=3600, downsample_after=24*3600,
+        archive_after=2*24*3600, chunk_size=100)
+    policy.run(now)
+    policy.run(now)
+
+    # The first day is archived and the rest merged into one reading per
+    # hour, except for the last hour
+    starttimes, endtimes, status = database.get_zone_data(0, now)
+    assert len(starttimes) == 47 + 60
+    assert (endtimes[:-1] == starttimes[1:]).all()
+    assert (status[1] == on).all()
+    with np.load(str(tmp_path / 'archive' / '1970-01-01.npz')) as archive:
+        assert len(archive['zone_starttime']) == 24
+        assert len(archive['temperature']) == 24
+
+    # Temperatures older than a day are hourly means
+    timestamps, temperatures = database.get_temperature_data(0, now)
+    assert len(timestamps) == 24 + 24*4
+    assert temperatures[0] == 1.5
+
+    # The rollup still covers everything
+    _, archived_duty, _ = database.get_duty_cycle(0, now, period='day')
+    assert (archived_duty == duty).all()
+    policy.close()
+    database.close()
+
+def test_archive_after_crash(tmp_path):
+    database = db.Database(str(tmp_path))
+    database.append_zone_data_many(
+        (i*H, (i + 1)*H, on if i % 2 else off) for i in range(48))
+    database.append_temperature_data_many(
+        (i*H + 1, float(i)) for i in range(48))
+    database.close()
+    filename = str(tmp_path / 'hvacmon.db')
+    shutil.copy(filename, filename + '.orig')
+
+    # Crash after writing the archive but before deleting the readings
+    with retention.Retention(str(tmp_path), merge_after=None,
+                             downsample_after=None,
+                             archive_after=24*3600) as policy:
+        policy.run(48*H)
+    shutil.copy(filename + '.orig', filename)
+
+    with retention.Retention(str(tmp_path), merge_after=None,
+                             downsample_after=None,
+                             archive_after=24*3600) as policy:
+        policy.run(48*H)
+    with np.load(str(tmp_path / 'archive' / '1970-01-01.npz')) as archive:
+        assert (archive['zone_starttime'] == np.arange(24)*H).all()
+        assert (archive['temperature'] == np.arange(24)).all()
+
+def test_enable_incremental_vacuum(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'hvacmon.db'))
+    conn.execute('CREATE TABLE t(x)')
+    conn.close()
+    db.Database(str(tmp_path)).close()
+
+    with retention.Retention(str(tmp_path)) as policy:
+        assert not policy.incremental_vacuum
+        assert policy.enable_incremental_vacuum()
+        assert policy.incremental_vacuum
+        assert not policy.enable_incremental_vacuum()
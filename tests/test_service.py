@@ -0,0 +1,170 @@
+import datetime
+import json
+import queue
+import threading
+import time
+import numpy as np
+import pytest
+from hvacmon import camera, service, weather
+from hvacmon.imgproc import Roi
+
+def draw_panel(im, origin, status):
+    """
+    Draws the LEDs of a panel with its power LED at `origin`.
+    """
+    top, left = origin
+    im[top - 1:top + 2, left - 1:left + 2] = (0, 255, 0)
+    for zone, led in zip(*np.nonzero(status)):
+        row, col = top + 7*(zone + 1), left + 7*led
+        im[row - 1:row + 2, col - 1:col + 2] = (0, 0, 255)
+
+@pytest.fixture
+def weather_provider(tmp_path):
+    path = tmp_path / 'weather.json'
+    path.write_text(json.dumps(
+        {'temperature': 50.0, 'time': '2019-01-01T00:00:00'}))
+    return weather.FileProvider(str(path))
+
+def test_dropped_frames(tmp_path, weather_provider):
+    frames = [np.full((16, 32, 3), i, dtype=np.uint8) for i in range(10)]
+    backend = camera.FakeCameraBackend(
+        frames, buffers=service._frame_buffers(1, 1))
+    srv = service.Service(str(tmp_path / 'out'), None, None, None,
+                          weather_provider=weather_provider,
+                          camera_backend=backend)
+
+    #
+    # Frames dropped while parsing is behind are never captured, so neither
+    # the frame being parsed nor the queued frames are overwritten, even
+    # after a recapture
+    #
+    parsing = srv.capture_frame()[0][2]
+    frames = queue.Queue(maxsize=service._FRAME_QUEUE_SIZE)
+    for _ in range(6):
+        srv._offer_frame(frames)
+    queued = [frames.get_nowait()[0][2] for _ in range(frames.qsize())]
+    _, recaptured = srv._cameras[0].get_frame()
+
+    assert (parsing == 0).all()
+    assert [im[0, 0, 0] for im in queued] == [1, 2]
+    assert (queued[0] == 1).all() and (queued[1] == 2).all()
+    assert (recaptured == 3).all()
+    srv._db.close()
+
+class HangingBackend(camera.FakeCameraBackend):
+    """
+    Fake backend whose captures block while `hang` is set.
+    """
+
+    def __init__(self, frames, **kwargs):
+        super().__init__(frames, **kwargs)
+        self.hang = threading.Event()
+        self.release = threading.Event()
+
+    def capture(self):
+        if self.hang.is_set():
+            self.release.wait()
+        return super().capture()
+
+def test_capture_timeout(tmp_path, weather_provider, monkeypatch):
+    monkeypatch.setattr(service, '_CAPTURE_TIMEOUT', 0.1)
+    frames = [np.full((16, 32, 3), i, dtype=np.uint8) for i in range(10)]
+    backend = HangingBackend(frames, buffers=service._frame_buffers(1, 1))
+    srv = service.Service(str(tmp_path / 'out'), None, None, None,
+                          weather_provider=weather_provider,
+                          camera_persistent=True, camera_backend=backend)
+    frames = queue.Queue(maxsize=service._FRAME_QUEUE_SIZE)
+
+    # A hung capture is abandoned, and no other started until it returns
+    srv._offer_frame(frames)
+    backend.hang.set()
+    srv._offer_frame(frames)
+    srv._offer_frame(frames)
+    assert frames.qsize() == 1
+    assert backend.open_count == 1
+
+    # Once it returned, the camera is reopened
+    backend.hang.clear()
+    backend.release.set()
+    while not srv._hung_capture.wait(0.01):
+        pass
+    srv._offer_frame(frames)
+    assert frames.qsize() == 2
+    assert backend.open_count == 2
+    srv._db.close()
+
+def test_dropped_writes(tmp_path, weather_provider, monkeypatch):
+    monkeypatch.setattr(service, '_WRITE_TIMEOUT', 0.01)
+    srv = service.Service(str(tmp_path / 'out'), None, None, None,
+                          weather_provider=weather_provider,
+                          camera_backend=camera.FakeCameraBackend(
+                              [np.zeros((16, 32, 3), dtype=np.uint8)]))
+
+    # Writes are dropped rather than blocking while the queue is full
+    srv._writes = queue.Queue(maxsize=1)
+    assert srv._write(srv._db.flush_if_due)
+    assert not srv._write(srv._db.flush_if_due)
+
+    # A temperature reading whose write was dropped is retried
+    srv._last_temperature = None
+    srv.sample_temperature()
+    assert srv._last_temperature is None
+    srv._writes.get_nowait()
+    srv.sample_temperature()
+    assert srv._last_temperature is not None
+    srv._db.close()
+
+def test_load_config(tmp_path):
+    path = tmp_path / 'panels.json'
+    path.write_text(json.dumps({'panels': [
+        {'id': 'north', 'roi': [170, 270, 670, 710], 'zones': 4},
+        {'id': 2, 'zones': '6', 'camera': 1, 'rotation': 180}]}))
+    north, south = service.load_config(str(path))
+    assert north == service.PanelConfig('north', Roi(170, 270, 670, 710))
+    assert south == service.PanelConfig('2', zones=6, camera=1,
+                                        rotation=180)
+    assert isinstance(south.roi, Roi)
+
+def test_panels(tmp_path, weather_provider):
+    # Two panels seen by one camera: 'a' with 4 zones, 'b' with 6
+    statuses = []
+    frames = []
+    for i in range(2):
+        a = np.roll(np.eye(4, 2, dtype=np.uint8), i, axis=0)
+        b = np.zeros((6, 2), dtype=np.uint8)
+        b[5 - i] = 1
+        im = np.zeros((120, 160, 3), dtype=np.uint8)
+        draw_panel(im, (20, 20), a)
+        draw_panel(im, (20, 80), b)
+        statuses.append((a, b))
+        frames.append(im)
+    panels = [service.PanelConfig('a', Roi(10, 60, 10, 40)),
+              service.PanelConfig('b', Roi(10, 70, 70, 100), zones=6)]
+    srv = service.Service(str(tmp_path), None, None, None,
+                          weather_provider=weather_provider,
+                          camera_backend=camera.FakeCameraBackend(frames),
+                          panels=panels, workers=2)
+    assert srv._executor is not None
+
+    for i in range(3):
+        frame = srv.capture_frame()
+        assert list(frame) == [0]
+        srv.process_frame(frame)
+        for panel, status in zip(('a', 'b'), statuses[i % 2]):
+            assert (srv.get_state(panel)[0] == status).all()
+        time.sleep(0.01)
+
+    # Each panel's intervals are stored under its id, with its zones
+    srv._compact_history()
+    end = datetime.datetime.utcnow()
+    _, _, zoneinfo = srv._db.get_zone_data(0, end, panel='b', zones=6)
+    assert len(zoneinfo) == 3
+    assert (zoneinfo[1] == statuses[0][1]).all()
+    assert (zoneinfo[2] == statuses[1][1]).all()
+    _, _, zoneinfo = srv._db.get_zone_data(0, end, panel='a')
+    assert (zoneinfo[2] == statuses[1][0]).all()
+
+    srv._executor.shutdown()
+    for panel in srv._panels:
+        panel.history.close()
+    srv._db.close()
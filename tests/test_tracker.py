@@ -0,0 +1,58 @@
+import datetime
+import numpy as np
+from hvacmon import tracker
+
+T0 = datetime.datetime(2019, 1, 1)
+
+def at(seconds):
+    return T0 + datetime.timedelta(seconds=seconds)
+
+def test_change_and_timeout():
+    off = np.zeros((4,2), dtype=np.uint8)
+    on = off.copy()
+    on[0] = 1
+    t = tracker.StatusTracker(at(0), off)
+    assert t.update(at(5), off) == (None, None)
+
+    event, interval = t.update(at(10), on)
+    assert event == tracker.EVENT_CHANGE
+    assert interval[:2] == (at(0), at(10))
+    assert (interval[2] == off).all()
+
+    event, interval = t.update(at(75), on)
+    assert event == tracker.EVENT_TIMEOUT
+    assert interval[:2] == (at(10), at(75))
+    assert (interval[2] == on).all()
+
+def test_fail_and_close():
+    on = np.ones((4,2), dtype=np.uint8)
+    t = tracker.StatusTracker(at(0), on)
+    t.fail(at(5))
+    assert t.timestamp == at(5)
+    assert (t.status == 0).all()
+    assert t.close(at(5)) is None
+    assert t.close(at(10))[:2] == (at(5), at(10))
+
+def test_debounce():
+    off = np.zeros((4,2), dtype=np.uint8)
+    on = off.copy()
+    on[1] = 1
+    t = tracker.StatusTracker(at(0), off, timeout=None, debounce=3)
+
+    # A single flickering sample is ignored
+    assert t.update(at(1), on) == (None, None)
+    assert t.pending
+    assert t.update(at(2), off) == (None, None)
+    assert not t.pending
+
+    # The change is dated from the first of the confirming samples
+    assert t.update(at(3), on) == (None, None)
+    assert t.update(at(4), on) == (None, None)
+    event, interval = t.update(at(5), on)
+    assert event == tracker.EVENT_CHANGE
+    assert interval[:2] == (at(0), at(3))
+    assert (interval[2] == off).all()
+    assert t.timestamp == at(3)
+
+    # Without a timeout, steady intervals stay open
+    assert t.update(at(1000), on) == (None, None)
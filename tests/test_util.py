@@ -0,0 +1,34 @@
+from datetime import datetime
+import numpy as np
+import pytest
+from hvacmon import util
+
+def test_parse_timestamp_roundtrip():
+    t = datetime(2019, 1, 2, 3, 4, 5, 678901)
+    assert util.parse_timestamp(util.get_timestamp(t)) == t
+    assert util.parse_timestamp('2019-01-02T03:04:05') == t.replace(
+        microsecond=0)
+
+def test_parse_timestamp_offsets():
+    assert (util.parse_timestamp('2019-01-01T20:00:00.5-05:00') ==
+            datetime(2019, 1, 2, 1, 0, 0, 500000))
+    assert (util.parse_timestamp('2019-01-01T20:00:00+01:30') ==
+            datetime(2019, 1, 1, 18, 30))
+    with pytest.raises(ValueError):
+        util.parse_timestamp('01/01/2019 20:00')
+
+def test_epoch_ms():
+    t = datetime(2019, 1, 1, 0, 0, 0, 250000)
+    assert util.to_epoch_ms(t) == 1546300800250
+    assert util.from_epoch_ms(1546300800250) == t
+    ms = util.to_epoch_ms(np.int64(1546300800250))
+    assert type(ms) is int and ms == 1546300800250
+
+def test_parse_timestamps():
+    strings = ['2019-01-01T20:00:00.5-05:00', '2019-01-01 20:00:00+01:30',
+               '2019-01-02T03:04:05.678901Z', '2019-01-02T03:04:05']
+    expected = [util.to_epoch_ms(util.parse_timestamp(s)) for s in strings]
+    assert util.parse_timestamps(strings).tolist() == expected
+    assert len(util.parse_timestamps([])) == 0
+    with pytest.raises(ValueError):
+        util.parse_timestamps(['2019-01-01T20:00:00', '01/01/2019 20:00'])
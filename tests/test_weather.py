@@ -0,0 +1,102 @@
+import datetime
+import json
+import sys
+import threading
+import types
+from hvacmon import util, weather
+
+class FakeProvider(weather.WeatherProvider):
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+        self.release = threading.Event()
+        self.release.set()
+
+    def get_temperature(self):
+        self.calls += 1
+        self.release.wait()
+        if self.error:
+            raise self.error
+        return datetime.datetime(2020, 1, 1, 0, self.calls), float(self.calls)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def wait_idle(cache):
+    while cache._inflight is not None:
+        cache._inflight[0].join(1)
+
+def test_stale_while_revalidate(tmpdir):
+    provider = FakeProvider()
+    clock = FakeClock()
+    cache_file = str(tmpdir.join('weather.json'))
+    cache = weather.CachedWeather(provider, cache_file, max_age=900,
+                                  clock=clock)
+    assert cache.get_temperature() is None
+    wait_idle(cache)
+    assert cache.get_temperature()[1] == 1.0
+
+    # A slow refresh serves the cached reading meanwhile
+    clock.now = 1000
+    provider.release.clear()
+    assert cache.get_temperature()[1] == 1.0
+    assert cache.get_temperature()[1] == 1.0
+    assert provider.calls == 2
+    provider.release.set()
+    wait_idle(cache)
+    assert cache.get_temperature()[1] == 2.0
+
+    # The last good reading survives a restart
+    cache = weather.CachedWeather(FakeProvider(), cache_file, clock=clock)
+    assert cache._reading == (datetime.datetime(2020, 1, 1, 0, 2), 2.0)
+
+def test_backoff():
+    provider = FakeProvider()
+    provider.error = OSError('unreachable')
+    clock = FakeClock()
+    cache = weather.CachedWeather(provider, min_backoff=60, clock=clock)
+    for now, calls in ((0, 1), (30, 1), (60, 2), (150, 2), (180, 3)):
+        clock.now = now
+        cache.get_temperature()
+        wait_idle(cache)
+        assert provider.calls == calls
+    assert cache.failures == 3
+
+    # Hung calls count as failures
+    provider.error = None
+    provider.release.clear()
+    clock.now = 420
+    cache.get_temperature()
+    clock.now = 451
+    cache.get_temperature()
+    assert cache.failures == 4
+    provider.release.set()
+
+def test_file_provider(tmpdir):
+    path = tmpdir.join('t.json')
+    path.write(json.dumps({'time': '2020-01-01T12:00:00Z',
+                           'temperature': 12.5}))
+    provider = weather.FileProvider(str(path))
+    assert provider.get_temperature() == (
+        datetime.datetime(2020, 1, 1, 12), 12.5)
+
+def test_legacy_weather(monkeypatch):
+    currently = types.SimpleNamespace(temperature=41.5, utime=0)
+    forecast = types.SimpleNamespace(currently=lambda: currently)
+    calls = []
+
+    def load_forecast(*args):
+        calls.append(args)
+        return forecast
+
+    monkeypatch.setitem(sys.modules, 'forecastio',
+                        types.SimpleNamespace(load_forecast=load_forecast))
+    timestamp, temperature = weather.Weather('key', 1.0, 2.0).get_temperature()
+    assert calls == [('key', 1.0, 2.0)]
+    assert temperature == 41.5
+    assert isinstance(timestamp, str)
+    assert util.parse_timestamp(timestamp) > datetime.datetime(2020, 1, 1)